@@ -0,0 +1,80 @@
+"""
+    Chat log benchmark: write throughput of the chat log with and
+without fsync, the time append takes on the caller's side (what the
+server's event loop pays per message), and the read throughput of a
+scan of the whole log through mmap.
+
+        off       -- no fsync, the page cache decides when data hits the disk
+        group     -- one fsync per batch the writer thread finds queued
+        message   -- the caller waits for the fsync of every message,
+                     what a log written from the event loop would cost
+
+    python bench/bench_chatlog.py --messages 100000 --size 64 --dir /tmp/chatlog-bench
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import common  # noqa: F401 -- puts the repository root on sys.path
+from chatlog import ChatLog
+from protocol import encode_frame
+
+
+def run(directory, mode, messages, frames):
+    shutil.rmtree(directory, ignore_errors=True)
+    log = ChatLog(directory, sync=mode != 'off')
+    append = log.append
+    room = b'lobby'
+
+    t0 = time.perf_counter()
+    worst = 0.0
+    for _ in range(messages):
+        t = time.perf_counter()
+        append(room, frames)
+        if mode == 'message':
+            log.flush()
+        worst = max(worst, time.perf_counter() - t)
+    appended = time.perf_counter() - t0
+    log.flush()
+    elapsed = time.perf_counter() - t0
+    batches = log.batches
+    log.close()
+
+    reader = ChatLog(directory, readonly=True)
+    t0 = time.perf_counter()
+    count = sum(1 for _ in reader.records())
+    scanned = time.perf_counter() - t0
+    assert count == messages
+    return elapsed, appended, worst, batches, scanned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=64, help="bytes per message")
+    parser.add_argument("--dir", default=None, help="where to write the log, a temporary directory by default")
+    parser.add_argument("--modes", nargs='+', choices=("off", "group", "message"), default=["off", "group", "message"])
+    args = parser.parse_args()
+
+    base = args.dir or tempfile.mkdtemp(prefix="chatlog-bench-")
+    frames = encode_frame(b'alice') + encode_frame(b'x' * args.size)
+    print(f"{'fsync':>8} {'msgs/s':>10} {'MB/s':>7} {'append us':>10} {'worst append ms':>16} {'msgs/batch':>11}"
+          f" {'scan msgs/s':>12}")
+    try:
+        for mode in args.modes:
+            # a per-message fsync is orders of magnitude slower, keep its run short
+            messages = args.messages if mode != 'message' else min(args.messages, 2000)
+            elapsed, appended, worst, batches, scanned = run(os.path.join(base, mode), mode, messages, frames)
+            print(f"{mode:>8} {messages / elapsed:>10.0f} {messages * len(frames) / elapsed / 1e6:>7.1f}"
+                  f" {appended / messages * 1e6:>10.2f} {worst * 1e3:>16.2f} {messages / max(batches, 1):>11.1f}"
+                  f" {messages / scanned:>12.0f}")
+    finally:
+        if args.dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+    DBSearchBox benchmark: time to the first results of a search, and the
+memory its results take, over a synthetic SQLite table of users, for the
+three ways the box can search:
+
+    full    -- every matching row is fetched (not paged), scanning the table
+    paged   -- the first page only, keyset pagination, scanning the table
+    fts     -- the first page only, through the FTS5 trigram index
+
+    The searches go through the SearchWorker and TableQuery of the box,
+without the Tk widget: the time is taken from submit to the lines of
+the first results. Memory is the peak of the Python allocations
+(tracemalloc) during the search, in a second run so that tracing
+doesn't slow the first one. The table and its FTS5 index are built once
+and kept in --db.
+
+    python bench/bench_dbsearch.py --rows 1000000 --texts e ken qzxw
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+import tracemalloc
+
+import common  # noqa: F401 -- puts the repository root on sys.path
+from xtra_widgets import SearchWorker, TableQuery, create_fts_index
+
+
+MODES = ('full', 'paged', 'fts')
+
+
+def build_table(path, rows):
+    """Creates the users table with rows random names, unless path already has it"""
+
+    db = sqlite3.connect(path)
+    try:
+        count = db.execute("SELECT count(*) FROM users").fetchone()[0]
+    except sqlite3.OperationalError:
+        count = None
+    if count != rows:
+        db.executescript("DROP TABLE IF EXISTS users_fts; DROP TABLE IF EXISTS users;"
+                         "CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, email TEXT)")
+        rng = random.Random(1)
+
+        def word():
+            return ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9)))
+
+        t0 = time.perf_counter()
+        db.executemany("INSERT INTO users (name, email) VALUES (?, ?)",
+                       ((word().capitalize() + ' ' + word().capitalize(), word() + '@example.org')
+                        for _ in range(rows)))
+        db.commit()
+        print(f"table: {rows} rows in {time.perf_counter() - t0:.1f} s")
+    t0 = time.perf_counter()
+    create_fts_index(db, 'users', 'name')
+    print(f"fts index: {time.perf_counter() - t0:.1f} s, database {os.path.getsize(path) / 2 ** 20:.0f} MiB")
+    db.close()
+
+
+def first_results(path, mode, text, page_size):
+    """Seconds to the first lines of text and their number"""
+
+    query = TableQuery('users', 'name', ('id', 'name', 'email'), None if mode == 'full' else page_size,
+                       fts=mode == 'fts')
+    worker = SearchWorker(lambda: sqlite3.connect(path), query, query.format, query.matcher, 0,
+                          query.page_size, query.keyset)
+    try:
+        t0 = time.perf_counter()
+        worker.submit(text)
+        _, _, _, lines, _ = worker.results.get()
+        elapsed = time.perf_counter() - t0
+    finally:
+        worker.close(wait=True)
+    if isinstance(lines, Exception):
+        raise lines
+    return elapsed, len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), 'bench_dbsearch.sqlite3'))
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--texts", nargs='+', default=['e', 'ken', 'qzxw'],
+                        help="search strings, from common to rare")
+    parser.add_argument("--modes", nargs='+', choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    build_table(args.db, args.rows)
+    print(f"{'mode':>6} {'text':>8} {'first ms':>10} {'lines':>9} {'peak MiB':>9}")
+    for text in args.texts:
+        for mode in args.modes:
+            elapsed, lines = first_results(args.db, mode, text, args.page_size)
+            tracemalloc.start()
+            first_results(args.db, mode, text, args.page_size)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{mode:>6} {text:>8} {elapsed * 1000:>10.1f} {lines:>9} {peak / 2 ** 20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
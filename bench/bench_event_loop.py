@@ -0,0 +1,151 @@
+"""
+    Event loop benchmark: starts a headless server, connects N clients
+and measures broadcast throughput (messages/sec and deliveries/sec) and
+end-to-end delivery latency percentiles.
+
+    python bench/bench_event_loop.py --clients 100 1000 10000
+"""
+
+import argparse
+import selectors
+import socket
+import time
+
+from common import raise_fd_limit, start_server, stop_server, percentile
+from protocol import FrameDecoder, encode_frame
+
+
+class Receiver:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder(262144)
+        self.username = None
+
+    def frames(self):
+        return self.decoder.read_from(self.sock)
+
+
+def drain(selector, timeout):
+    """Reads and discards server notices, returns the number of sockets that were readable"""
+
+    events = selector.select(timeout)
+    for key, _ in events:
+        receiver = key.data
+        try:
+            frames = receiver.frames()
+        except BlockingIOError:
+            continue
+        if len(frames) % 2:
+            receiver.username = None if receiver.username is not None else frames[-1]
+    return len(events)
+
+
+def run(host, port, n_clients, n_messages, window):
+    selector = selectors.DefaultSelector()
+    receivers = []
+    t0 = time.perf_counter()
+    for i in range(n_clients):
+        sock = socket.create_connection((host, port), timeout=30)
+        sock.sendall(encode_frame(f"bench{i}".encode('utf-8')))
+        sock.setblocking(False)
+        receiver = Receiver(sock)
+        receivers.append(receiver)
+        selector.register(sock, selectors.EVENT_READ, receiver)
+        if i % 50 == 0:
+            drain(selector, 0)
+    connect_time = time.perf_counter() - t0
+
+    expected = n_clients - 1
+    pending = {}
+    latencies = []
+    sent = completed = 0
+    sender = receivers[0].sock
+    sender.setblocking(True)
+
+    # let the join notices settle before measuring
+    while drain(selector, 0.5):
+        pass
+
+    start = time.perf_counter()
+    while completed < n_messages:
+        while sent < n_messages and len(pending) < window:
+            pending[sent] = expected
+            sender.sendall(encode_frame(f"{sent} {time.perf_counter()}".encode('utf-8')))
+            sent += 1
+
+        events = selector.select(10)
+        if not events:
+            raise RuntimeError(f"stalled with {len(pending)} messages in flight ({completed}/{n_messages} done)")
+        for key, _ in events:
+            receiver = key.data
+            try:
+                frames = receiver.frames()
+            except BlockingIOError:
+                continue
+            now = time.perf_counter()
+            for frame in frames:
+                if receiver.username is None:
+                    receiver.username = frame
+                    continue
+                username, receiver.username = receiver.username, None
+                if username == b'SERVER':
+                    continue
+                seq, stamp = frame.split(b' ')
+                seq = int(seq)
+                latencies.append(now - float(stamp))
+                pending[seq] -= 1
+                if not pending[seq]:
+                    del pending[seq]
+                    completed += 1
+    elapsed = time.perf_counter() - start
+
+    for receiver in receivers:
+        selector.unregister(receiver.sock)
+        receiver.sock.close()
+    selector.close()
+    latencies.sort()
+
+    return {
+        "clients": n_clients,
+        "connect_time_s": round(connect_time, 3),
+        "messages_per_s": round(n_messages / elapsed, 1),
+        "deliveries_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--clients", type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=None,
+                        help="messages to broadcast per run (default: 200000 deliveries worth)")
+    parser.add_argument("--window", type=int, default=16, help="maximum messages in flight")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    print(f"{'clients':>8} {'connect s':>10} {'msg/s':>10} {'deliv/s':>12} {'p50 ms':>9} {'p99 ms':>9}")
+    for n_clients in args.clients:
+        if n_clients + 64 > limit:
+            print(f"{n_clients:>8} skipped: RLIMIT_NOFILE is {limit}")
+            continue
+        messages = args.messages or max(20, 200000 // n_clients)
+        # a single client sends as fast as it can, the rate limits would drop most of it
+        server = start_server(args.host, args.port, args.workers, ('--rate', '0', '--user-rate', '0'))
+        try:
+            result = run(args.host, args.port, n_clients, messages, args.window)
+        except RuntimeError as e:
+            print(f"{n_clients:>8} failed: {e}")
+            continue
+        finally:
+            stop_server(server)
+        print(f"{result['clients']:>8} {result['connect_time_s']:>10} {result['messages_per_s']:>10} "
+              f"{result['deliveries_per_s']:>12} {result['p50_ms']:>9} {result['p99_ms']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+    Fan-out microbenchmark: cost per recipient of broadcasting a burst of
+messages, comparing the legacy per-recipient concatenation and send()
+with the encode-once outbox and sendmsg flush of ChatServer.
+
+    python bench/bench_fanout.py --recipients 1000 --burst 1 10
+"""
+
+import argparse
+import selectors
+import socket
+import time
+
+import common  # noqa: F401 -- puts the repository root on sys.path
+from server_core import ChatServer
+
+
+def make_pairs(n):
+    pairs = [socket.socketpair() for _ in range(n)]
+    for a, b in pairs:
+        for sock in (a, b):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        b.setblocking(False)
+    return pairs
+
+
+def drain(pairs):
+    for _, b in pairs:
+        try:
+            while b.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def legacy(pairs, burst, rounds):
+    user = {'header': f"{5:<10}".encode('utf-8'), 'data': b'alice'}
+    message = {'header': f"{64:<10}".encode('utf-8'), 'data': b'x' * 64}
+    sockets = [a for a, _ in pairs]
+    elapsed = 0.0
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(burst):
+            for client_socket in sockets:
+                client_socket.send(user['header'] + user['data'] + message['header'] + message['data'])
+        elapsed += time.perf_counter() - t0
+        drain(pairs)
+    return elapsed
+
+
+def encode_once(pairs, burst, rounds):
+    server = ChatServer()
+    server.selector = selectors.DefaultSelector()
+    sender = server._register(pairs[0][0], b'alice', server.new_decoder())
+    for a, _ in pairs[1:]:
+        server._register(a, b'bob', server.new_decoder())
+    message = b'x' * 64
+    elapsed = 0.0
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(burst):
+            # the sender is also a recipient in the legacy loop, so count it here too
+            server._broadcast_message(sender, message, exclude=False)
+        server._flush_pending()
+        elapsed += time.perf_counter() - t0
+        drain(pairs)
+    for a, _ in pairs:
+        server.selector.unregister(a)
+        a.setblocking(True)
+    server.selector.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--burst", type=int, nargs='+', default=[1, 10], help="messages broadcast per loop iteration")
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    pairs = make_pairs(args.recipients)
+    print(f"{'burst':>6} {'legacy us/recipient':>20} {'encode-once us/recipient':>25} {'speedup':>8}")
+    for burst in args.burst:
+        deliveries = args.recipients * burst * args.rounds
+        before = legacy(pairs, burst, args.rounds) / deliveries * 1e6
+        after = encode_once(pairs, burst, args.rounds) / deliveries * 1e6
+        print(f"{burst:>6} {before:>20.3f} {after:>25.3f} {before / after:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+    Federation benchmark: aggregate throughput of 1, 2, 4... nodes linked
+in a full mesh on loopback, each with the same number of clients.
+
+    Every client joins a room and sends a burst of messages, the time is
+taken until every member of every room got all of them. By default the
+rooms of a node only have members on that node, the sharded workload a
+federation scales best with: the peers only number the relayed messages
+into their histories. With --spread every room has members on every
+node, so every message is delivered by all of them.
+
+    Nodes run in their own processes, the numbers only grow with the node
+count on a machine with at least that many free cores (the load
+generator takes one too).
+
+    python bench/bench_federation.py --nodes 1 2 4 --clients 200 --rooms 20 --messages 20
+"""
+
+import argparse
+import selectors
+import socket
+import time
+
+import common
+from common import start_server, stop_server
+from protocol import FrameDecoder, encode_frame
+
+
+def start_nodes(host, port, federation_port, nodes):
+    procs = []
+    for i in range(1, nodes + 1):
+        args = ['--node-id', str(i), '--federation-port', str(federation_port + i), '--rate', '0',
+                '--user-rate', '0']
+        for j in range(1, i):
+            args += ['--peer', f"{host}:{federation_port + j}"]
+        procs.append(start_server(host, port + i, extra_args=args))
+    return procs
+
+
+def connect(host, port, username, room):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(encode_frame(username) + encode_frame(b'/join ' + room))
+    return sock
+
+
+def read_until(selector, counts, wanted, timeout):
+    """Reads every client, counting the frames each one gets, until all have wanted or timeout"""
+
+    deadline = time.perf_counter() + timeout
+    missing = sum(1 for sock in counts if counts[sock][1] < wanted[sock])
+    while missing and time.perf_counter() < deadline:
+        for key, _ in selector.select(0.1):
+            sock = key.fileobj
+            decoder, count = counts[sock]
+            try:
+                frames = decoder.read_from(sock)
+            except BlockingIOError:
+                continue
+            before = count < wanted[sock]
+            count += len(frames)
+            counts[sock][1] = count
+            if before and count >= wanted[sock]:
+                missing -= 1
+    return not missing
+
+
+def run(host, port, federation_port, nodes, clients, rooms, messages, size, spread):
+    procs = start_nodes(host, port, federation_port, nodes)
+    selector = selectors.DefaultSelector()
+    socks = []
+    try:
+        members = {}
+        for node in range(1, nodes + 1):
+            for i in range(clients):
+                room = f"r{i % rooms}" if spread else f"n{node}r{i % rooms}"
+                sock = connect(host, port + node, f"u{node}_{i}".encode(), room.encode())
+                socks.append(sock)
+                members.setdefault(room, []).append(sock)
+
+        # let the logins and joins spread over the federation, then drop what they sent the clients
+        time.sleep(1.0)
+        for sock in socks:
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+        counts = {sock: [FrameDecoder(), 0] for sock in socks}
+        read_until(selector, counts, {sock: float('inf') for sock in socks}, 2.0)
+
+        message = encode_frame(b'x' * size)
+        wanted = {}
+        for room_members in members.values():
+            for sock in room_members:
+                # username + message frames of every message of the other members
+                wanted[sock] = 2 * messages * (len(room_members) - 1)
+        for sock in counts:
+            counts[sock][1] = 0
+
+        t0 = time.perf_counter()
+        burst = message * messages
+        for sock in socks:
+            sock.setblocking(True)
+            sock.sendall(burst)
+            sock.setblocking(False)
+        done = read_until(selector, counts, wanted, 60.0)
+        elapsed = time.perf_counter() - t0
+        deliveries = sum(min(counts[sock][1], wanted[sock]) for sock in socks) // 2
+        return deliveries, elapsed, done
+    finally:
+        selector.close()
+        for sock in socks:
+            sock.close()
+        for proc in procs:
+            stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5600, help="node i serves clients on port + i")
+    parser.add_argument("--federation-port", type=int, default=5700, help="node i listens for peers on port + i")
+    parser.add_argument("--nodes", type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=200, help="clients per node")
+    parser.add_argument("--rooms", type=int, default=20, help="rooms per node (shared by all nodes with --spread)")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by every client")
+    parser.add_argument("--size", type=int, default=64, help="bytes per message")
+    parser.add_argument("--spread", action="store_true", help="put members of every room on every node")
+    args = parser.parse_args()
+    common.raise_fd_limit()
+
+    print(f"{'nodes':>6} {'clients':>8} {'deliveries':>11} {'seconds':>8} {'deliveries/s':>13} {'per node':>10}")
+    for nodes in args.nodes:
+        deliveries, elapsed, done = run(args.host, args.port, args.federation_port, nodes, args.clients,
+                                        args.rooms, args.messages, args.size, args.spread)
+        rate = deliveries / elapsed
+        print(f"{nodes:>6} {nodes * args.clients:>8} {deliveries:>11} {elapsed:>8.2f} {rate:>13.0f}"
+              f" {rate / nodes:>10.0f}{'' if done else '  (timed out)'}")
+
+
+if __name__ == "__main__":
+    main()
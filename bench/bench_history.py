@@ -0,0 +1,69 @@
+"""
+    Room history benchmark: cost of recording a message in the history
+of its room, and of replaying the history to a client that joins, as
+frames queued and flushed with ChatServer's scatter-gather write.
+
+    python bench/bench_history.py --replay 50 500 --size 64
+"""
+
+import argparse
+import selectors
+import socket
+import time
+
+import common  # noqa: F401 -- puts the repository root on sys.path
+from server_core import ChatServer
+
+
+def drain(sock):
+    try:
+        while sock.recv(1 << 20):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", type=int, nargs='+', default=[50, 500], help="messages replayed per join")
+    parser.add_argument("--size", type=int, default=64, help="bytes per message")
+    parser.add_argument("--joins", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'replay':>7} {'record us/msg':>14} {'replay us/join':>15} {'room history KiB':>17}")
+    for replay in args.replay:
+        server = ChatServer(history=replay, history_bytes=1 << 30, replay=replay)
+        server.selector = selectors.DefaultSelector()
+        a, b = socket.socketpair()
+        for sock in (a, b):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        b.setblocking(False)
+        session = server._register(a, b'alice', server.new_decoder())
+
+        # the sender is alone in the room, so this times the numbering and recording only
+        message = b'x' * args.size
+        t0 = time.perf_counter()
+        for _ in range(replay * 4):
+            server._broadcast_message(session, message)
+        record = (time.perf_counter() - t0) / (replay * 4)
+        server._pending.clear()
+
+        elapsed = 0.0
+        for _ in range(args.joins):
+            t0 = time.perf_counter()
+            server._replay(session)
+            server._flush_pending()
+            elapsed += time.perf_counter() - t0
+            drain(b)
+
+        history = server.history.history_of(session.room)
+        print(f"{replay:>7} {record * 1e6:>14.2f} {elapsed / args.joins * 1e6:>15.1f} {history.size / 1024:>17.1f}")
+        server.selector.unregister(a)
+        server.selector.close()
+        a.close()
+        b.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+    Protocol benchmark: bytes on the wire and decode cost per chat
+message for protocol v1 (ASCII length headers, username repeated in
+every message) and v2 (binary headers, numeric sender id).
+
+    With --batch it also measures v2 with compression: bytes on the
+wire per message and the CPU spent compressing and decompressing it,
+when the server compresses that many queued messages per block.
+
+    python bench/bench_protocol.py --username alice --size 16 64 256 --batch 1 10 100
+"""
+
+import argparse
+import random
+import time
+
+import common  # noqa: F401 -- puts the repository root on sys.path
+from protocol import (FrameDecoder, FrameDecoderV2, encode_frame, encode_frame_v2, make_compressor,
+                      make_decompressor, compress_block, V2_HEADER, USER_ID, MSG_MESSAGE)
+
+WORDS = b'the a to and hello is you it of what for in ok lol yes no that on my so this meeting today'.split()
+
+
+def v1_frames(username, text):
+    """What a client sends and what every recipient gets for one message"""
+    return encode_frame(text), encode_frame(username) + encode_frame(text)
+
+
+def v2_frames(username, text):
+    return (encode_frame_v2(MSG_MESSAGE, text),
+            V2_HEADER.pack(USER_ID.size + len(text), MSG_MESSAGE) + USER_ID.pack(1234) + text)
+
+
+def decode_cost(decoder_class, stream, count, repeat):
+    """Nanoseconds per message to split a stream of count messages with a fresh decoder"""
+
+    best = None
+    for _ in range(repeat):
+        decoder = decoder_class()
+        t0 = time.perf_counter_ns()
+        for i in range(0, len(stream), 65536):
+            decoder.feed(stream[i:i + 65536])
+        elapsed = time.perf_counter_ns() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count
+
+
+def chat_text(rng, size):
+    """Roughly size bytes of chat-like text, compressing random bytes would tell nothing"""
+
+    words = []
+    length = 0
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return b' '.join(words)[:size]
+
+
+def compression_cost(size, batch, count):
+    """(wire bytes, compress ns, decompress ns) per message of a stream of count messages"""
+
+    rng = random.Random(size)
+    frames = [V2_HEADER.pack(USER_ID.size + size, MSG_MESSAGE) + USER_ID.pack(rng.randrange(1, 1000))
+              + chat_text(rng, size) for _ in range(count)]
+    blocks = []
+    compressor = make_compressor()
+    t0 = time.perf_counter_ns()
+    for i in range(0, count, batch):
+        blocks.append(compress_block(compressor, b''.join(frames[i:i + batch])))
+    compress_ns = time.perf_counter_ns() - t0
+
+    decompressor = make_decompressor()
+    t0 = time.perf_counter_ns()
+    for block in blocks:
+        decompressor.decompress(block)
+    decompress_ns = time.perf_counter_ns() - t0
+    return sum(map(len, blocks)) / count, compress_ns / count, decompress_ns / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username", default="alice")
+    parser.add_argument("--size", type=int, nargs='+', default=[16, 64, 256], help="message sizes in bytes")
+    parser.add_argument("--count", type=int, default=100000, help="messages per decode run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--batch", type=int, nargs='*', default=[], help="messages per compressed block")
+    args = parser.parse_args()
+
+    username = args.username.encode('utf-8')
+    print(f"{'size':>6} {'v1 up B':>8} {'v2 up B':>8} {'v1 down B':>10} {'v2 down B':>10} "
+          f"{'v1 ns/msg':>10} {'v2 ns/msg':>10}")
+    for size in args.size:
+        text = b'x' * size
+        v1_up, v1_down = v1_frames(username, text)
+        v2_up, v2_down = v2_frames(username, text)
+
+        # a v1 message reaches a recipient as two frames, a v2 message as one
+        v1_cost = decode_cost(FrameDecoder, v1_down * args.count, args.count, args.repeat)
+        v2_cost = decode_cost(FrameDecoderV2, v2_down * args.count, args.count, args.repeat)
+        print(f"{size:>6} {len(v1_up):>8} {len(v2_up):>8} {len(v1_down):>10} {len(v2_down):>10} "
+              f"{v1_cost:>10.1f} {v2_cost:>10.1f}")
+
+    if not args.batch:
+        return
+    print()
+    print(f"{'size':>6} {'batch':>6} {'plain B':>8} {'zlib B':>8} {'ratio':>6} {'comp ns':>8} {'decomp ns':>10}")
+    for size in args.size:
+        plain = V2_HEADER.size + USER_ID.size + size
+        for batch in args.batch:
+            wire, compress_ns, decompress_ns = compression_cost(size, batch, min(args.count, 20000))
+            print(f"{size:>6} {batch:>6} {plain:>8} {wire:>8.1f} {plain / wire:>6.2f} "
+                  f"{compress_ns:>8.0f} {decompress_ns:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
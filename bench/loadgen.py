@@ -0,0 +1,312 @@
+"""
+    Load generator for the chat protocol: spawns thousands of simulated
+clients (no Tk) over several processes, lets some of them send
+timestamped messages at a fixed rate and measures:
+
+    - connection setup rate and connect latency
+    - messages sent/sec and deliveries/sec
+    - end-to-end broadcast latency percentiles
+    - server RSS (server and worker processes)
+
+    The results are printed and, with --report, appended as one JSON
+line to a file, so runs can be compared over time:
+
+    python bench/loadgen.py --clients 2000 --senders 20 --rate 10 --report bench/results.jsonl
+    python bench/loadgen.py --compare bench/results.jsonl
+
+    With --rooms N the clients are spread over N rooms right after
+logging in, so every message only reaches the members of one room.
+
+    Latency is measured with CLOCK_MONOTONIC, so the load generator and
+the server must run on the same host (loopback).
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import selectors
+import socket
+import time
+
+from common import raise_fd_limit, start_server, stop_server, process_rss, percentile, git_revision
+from client_core import ChatProtocol, encode_login
+from protocol import ProtocolError, ConnectionClosed
+
+
+USERNAME_PREFIX = 'lg'
+SAMPLE_LIMIT = 100000       # latency samples kept per client process
+
+
+class SimClient:
+
+    def __init__(self, sock, name, version):
+        self.sock = sock
+        self.name = name
+        self.protocol = ChatProtocol(name, version)
+        self.out = bytearray()
+        self.seq = 0
+
+    def flush(self):
+        if self.out:
+            try:
+                sent = self.sock.send(self.out)
+            except BlockingIOError:
+                return
+            del self.out[:sent]
+
+
+class LatencySample:
+
+    """Reservoir sample of latencies, so memory stays bounded on long runs"""
+
+    def __init__(self, limit=SAMPLE_LIMIT):
+        self.limit = limit
+        self.values = []
+        self.seen = 0
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.limit:
+            self.values.append(value)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.limit:
+                self.values[i] = value
+
+
+def room_of(client_index, rooms):
+    return b'r%d' % (client_index % rooms)
+
+
+def room_sizes(clients, rooms):
+    base, extra = divmod(clients, rooms)
+    return {room_of(i, rooms): base + (i < extra) for i in range(rooms)}
+
+
+def client_process(index, args, first, n_clients, n_senders, barrier, results):
+    raise_fd_limit()
+    selector = selectors.DefaultSelector()
+    clients = []
+    connect_ns = []
+    errors = 0
+    latencies = LatencySample()
+    received = 0
+
+    def receive(timeout):
+        nonlocal received, errors
+        events = selector.select(timeout)
+        now = time.monotonic_ns()
+        for key, _ in events:
+            client = key.data
+            try:
+                messages = client.protocol.read_from(client.sock)
+            except BlockingIOError:
+                continue
+            except (OSError, ConnectionClosed, ProtocolError):
+                selector.unregister(client.sock)
+                errors += 1
+                continue
+            for message in messages:
+                # the room messages of v2, the messages of the other clients for v1 (not the server notices)
+                if message.seq is not None or message.sender.startswith(USERNAME_PREFIX):
+                    received += 1
+                    latencies.add(now - int(message.text.split(' ', 2)[1]))
+            client.out += client.protocol.take_control()
+        return len(events)
+
+    sizes = room_sizes(args.clients, args.rooms) if args.rooms else None
+    for i in range(n_clients):
+        name = f"{USERNAME_PREFIX}{index}_{i}".encode('utf-8')
+        client = SimClient(None, name, args.protocol)
+        t0 = time.monotonic_ns()
+        try:
+            sock = socket.create_connection((args.host, args.port), timeout=30)
+            # the login and the join are pipelined, the server reads the join once the login is done
+            join = client.protocol.encode(f"/join {room_of(first + i, args.rooms).decode()}") if args.rooms else b''
+            sock.sendall(encode_login(name, args.protocol) + join)
+        except OSError:
+            errors += 1
+            continue
+        connect_ns.append(time.monotonic_ns() - t0)
+        sock.setblocking(False)
+        client.sock = sock
+        clients.append(client)
+        selector.register(sock, selectors.EVENT_READ, client)
+        if i % 50 == 0:
+            receive(0)
+
+    barrier.wait()                      # everyone connected
+    while receive(0.5):                 # join notices
+        pass
+    barrier.wait()
+
+    senders = clients[:n_senders]
+    interval = 1e9 / args.rate
+    start = time.monotonic_ns()
+    end = start + int(args.duration * 1e9)
+    next_send = [start + random.random() * interval for _ in senders]
+    payload = 'x' * max(0, args.size)
+    sent = 0
+    expected = 0
+    now = start
+    while now < end:
+        for i, client in enumerate(senders):
+            while next_send[i] <= now:
+                client.out += client.protocol.encode(f"{client.seq} {time.monotonic_ns()} {payload}")
+                client.seq += 1
+                sent += 1
+                if sizes:
+                    expected += sizes[room_of(first + i, args.rooms)] - 1
+                next_send[i] += interval
+            client.flush()
+        receive(max(0.0, min(min(next_send, default=end), end) - time.monotonic_ns()) / 1e9)
+        now = time.monotonic_ns()
+
+    while any(client.out for client in senders):
+        for client in senders:
+            client.flush()
+        receive(0.01)
+    while receive(1.0):                 # drain deliveries still in flight
+        pass
+
+    results.put({'connect_ns': connect_ns, 'latency_ns': latencies.values, 'latency_seen': latencies.seen,
+                 'sent': sent, 'expected': expected, 'received': received, 'errors': errors})
+    for client in clients:
+        client.sock.close()
+
+
+def run(args):
+    server = None
+    if not args.external:
+        # the load is set by --rate, not by the server's rate limits
+        server = start_server(args.host, args.port, args.workers, ('--rate', '0', '--user-rate', '0'))
+    try:
+        return _run(args, server)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+
+def _run(args, server):
+    procs = max(1, min(args.procs, args.clients))
+    barrier = multiprocessing.Barrier(procs + 1, timeout=600)
+    results = multiprocessing.Queue()
+
+    base, extra = divmod(args.clients, procs)
+    sbase, sextra = divmod(min(args.senders, args.clients), procs)
+    workers = []
+    first = 0
+    for i in range(procs):
+        n_clients = base + (i < extra)
+        p = multiprocessing.Process(target=client_process, daemon=True,
+                                    args=(i, args, first, n_clients, sbase + (i < sextra), barrier, results))
+        workers.append(p)
+        first += n_clients
+
+    rss_idle = process_rss(server.pid) if server else 0
+    t0 = time.monotonic()
+    for p in workers:
+        p.start()
+    barrier.wait()
+    connect_time = time.monotonic() - t0
+    rss_connected = process_rss(server.pid) if server else 0
+    barrier.wait()
+
+    rss_peak = rss_connected
+    run_end = time.monotonic() + args.duration
+    while time.monotonic() < run_end:
+        time.sleep(0.25)
+        if server:
+            rss_peak = max(rss_peak, process_rss(server.pid))
+
+    merged = [results.get() for _ in workers]
+    for p in workers:
+        p.join()
+
+    connect_ns = sorted(v for r in merged for v in r['connect_ns'])
+    latency_ns = sorted(v for r in merged for v in r['latency_ns'])
+    sent = sum(r['sent'] for r in merged)
+    received = sum(r['received'] for r in merged)
+    connected = len(connect_ns)
+    # without rooms every message goes to every other client
+    expected = sum(r['expected'] for r in merged) if args.rooms else sent * (connected - 1)
+
+    def ms(values, p):
+        return round(percentile(values, p) / 1e6, 3)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'label': args.label,
+        'params': {'clients': args.clients, 'senders': args.senders, 'rate': args.rate, 'size': args.size,
+                   'duration': args.duration, 'procs': procs, 'workers': args.workers, 'protocol': args.protocol,
+                   'rooms': args.rooms},
+        'connected': connected,
+        'errors': sum(r['errors'] for r in merged),
+        'connect_rate_per_s': round(connected / connect_time, 1),
+        'connect_p50_ms': ms(connect_ns, 50),
+        'connect_p99_ms': ms(connect_ns, 99),
+        'messages_sent_per_s': round(sent / args.duration, 1),
+        'deliveries_per_s': round(received / args.duration, 1),
+        'delivery_ratio': round(received / expected, 4) if expected else 0.0,
+        'latency_p50_ms': ms(latency_ns, 50),
+        'latency_p90_ms': ms(latency_ns, 90),
+        'latency_p99_ms': ms(latency_ns, 99),
+        'latency_p999_ms': ms(latency_ns, 99.9),
+        'latency_max_ms': round(latency_ns[-1] / 1e6, 3) if latency_ns else 0.0,
+        'server_rss_idle_mb': round(rss_idle / 2 ** 20, 1),
+        'server_rss_connected_mb': round(rss_connected / 2 ** 20, 1),
+        'server_rss_peak_mb': round(rss_peak / 2 ** 20, 1),
+    }
+
+
+SUMMARY_FIELDS = ('connect_rate_per_s', 'messages_sent_per_s', 'deliveries_per_s', 'delivery_ratio',
+                  'latency_p50_ms', 'latency_p99_ms', 'latency_p999_ms', 'server_rss_peak_mb')
+
+
+def compare(path):
+    with open(path) as f:
+        reports = [json.loads(line) for line in f if line.strip()]
+    print(f"{'revision':>10} {'label':>12} {'clients':>8} " + ' '.join(f"{name[:18]:>18}" for name in SUMMARY_FIELDS))
+    for report in reports:
+        print(f"{str(report['revision']):>10} {str(report['label'])[:12]:>12} {report['params']['clients']:>8} "
+              + ' '.join(f"{report[name]:>18}" for name in SUMMARY_FIELDS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5060)
+    parser.add_argument("--external", action="store_true", help="use a server that is already running")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=10, help="clients that send messages")
+    parser.add_argument("--rate", type=float, default=5.0, help="messages/sec per sender")
+    parser.add_argument("--size", type=int, default=32, help="padding bytes per message")
+    parser.add_argument("--rooms", type=int, default=0, help="spread the clients over this many rooms")
+    parser.add_argument("--protocol", type=int, choices=(1, 2), default=1, help="wire protocol of the clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--procs", type=int, default=multiprocessing.cpu_count(), help="client processes")
+    parser.add_argument("--label", default=None, help="free text stored in the report")
+    parser.add_argument("--report", default=None, help="append the JSON report to this file")
+    parser.add_argument("--compare", metavar="REPORT", default=None, help="print a table of the runs in REPORT")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    limit = raise_fd_limit()
+    if args.clients + 64 > limit:
+        parser.error(f"--clients {args.clients} needs a higher RLIMIT_NOFILE (currently {limit})")
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""
+    Chat Log: durable, append-only log of the messages of the chat
+server, and a command line tool to read it.
+
+    python chatlog.py tail LOGDIR [-n 20] [--room lobby] [-f]
+    python chatlog.py search LOGDIR PATTERN [--room lobby] [--since "2024-05-01 10:00"] [--until ...]
+"""
+
+import argparse
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from protocol import FrameDecoder, ProtocolError
+
+
+SEGMENT_SIZE = 64 * 1024 * 1024     # bytes per segment file before a new one is started
+INDEX_INTERVAL = 64 * 1024          # bytes of records between two entries of the sparse index
+
+# seq, time (ns since the epoch), crc32 of room + data, length of room, length of data
+RECORD = struct.Struct('!QqIHI')
+# seq, time, offset of the record in its segment
+INDEX_ENTRY = struct.Struct('!QqQ')
+
+
+class Segment:
+
+    """One segment file of the log and its sparse index"""
+
+    __slots__ = ('first_seq', 'path', 'size', 'seqs', 'times', 'offsets')
+
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, f"{first_seq:020d}.log")
+        self.size = 0
+        self.seqs = []
+        self.times = []
+        self.offsets = []
+
+    @property
+    def index_path(self):
+        return self.path[:-4] + '.idx'
+
+    def add_index(self, seq, timestamp, offset):
+        self.seqs.append(seq)
+        self.times.append(timestamp)
+        self.offsets.append(offset)
+
+    def start_offset(self, since_seq=None, since_time=None):
+        """Offset of the last indexed record before since_seq / since_time, reading from there finds them"""
+
+        if since_seq is not None:
+            i = bisect.bisect_right(self.seqs, since_seq) - 1
+        elif since_time is not None:
+            i = bisect.bisect_left(self.times, since_time) - 1
+        else:
+            return 0
+        return self.offsets[i] if i >= 0 else 0
+
+
+def scan(buffer, offset, end):
+    """
+        Yields (offset, seq, time, room, data) for every valid record of
+    buffer[offset:end], stopping at the first incomplete or corrupt one.
+    """
+
+    header_size = RECORD.size
+    while end - offset >= header_size:
+        seq, timestamp, crc, room_length, data_length = RECORD.unpack_from(buffer, offset)
+        body = offset + header_size
+        body_end = body + room_length + data_length
+        if body_end > end or zlib.crc32(buffer[body:body_end]) != crc:
+            return
+        yield offset, seq, timestamp, bytes(buffer[body:body + room_length]), bytes(buffer[body + room_length:body_end])
+        offset = body_end
+
+
+class ChatLog:
+
+    """
+        Chat Log: append-only log of chat messages, split into segment
+    files of segment_size bytes named after the sequence number of
+    their first record.
+
+        Every record holds a sequence number, the time it was appended,
+    the room and the raw wire frames of the message (the v1 encoding,
+    username frame + text frame), protected by a CRC. Every
+    index_interval bytes of records a (seq, time, offset) entry is
+    added to the sparse index of the segment (a .idx file next to it),
+    so reads by sequence number or time start close to the first record
+    they want. Reads go through mmap.
+
+        append only queues the record and returns its sequence number,
+    it never touches the disk: a writer thread writes everything that
+    was queued with a single write and, with sync, a single fsync (group
+    commit), so the event loop of the server never waits for the disk
+    however slow fsync is. flush waits until what was appended is
+    written.
+
+        A torn record at the end of the last segment (crash during a
+    write) is cut off when the log is opened. With readonly nothing is
+    written nor repaired, so a log that a running server writes to can
+    be read by another process.
+    """
+
+    def __init__(self, directory, sync=True, segment_size=SEGMENT_SIZE, index_interval=INDEX_INTERVAL,
+                 readonly=False):
+        self.directory = directory
+        self.sync = sync
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.readonly = readonly
+
+        self.segments = []
+        self.next_seq = 1
+        self.written_seq = 0        # every record up to this one is written (and synced with sync)
+        self.batches = 0            # write calls of the writer thread, each covering a whole batch
+        self._queue = []
+        self._closing = False
+        self.error = None           # OSError that stopped the writer thread, raised by append and flush
+        self._cond = threading.Condition()
+        self._file = None
+        self._index_file = None
+        self._writer = None
+
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self._load()
+        if not readonly:
+            self._open_last()
+            self._writer = threading.Thread(target=self._write_loop, name="chatlog-writer", daemon=True)
+            self._writer.start()
+
+    # ---- opening ----
+
+    def _load(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith('.log')) \
+            if os.path.isdir(self.directory) else []
+        self.segments = []
+        for name in names:
+            segment = Segment(self.directory, int(name[:-4]))
+            segment.size = os.path.getsize(segment.path)
+            self._load_index(segment)
+            self.segments.append(segment)
+        if self.segments:
+            self._recover(self.segments[-1])
+            last = self.segments[-1]
+            self.next_seq = last.first_seq
+            if last.offsets:
+                self.next_seq = last.seqs[-1] + 1
+                with open(last.path, 'rb') as f:
+                    f.seek(last.offsets[-1])
+                    tail = f.read()
+                for _, seq, _, _, _ in scan(tail, 0, len(tail)):
+                    self.next_seq = seq + 1
+        self.written_seq = self.next_seq - 1
+
+    def _load_index(self, segment):
+        """Loads the .idx file of segment, or rebuilds the index from the records if there is none"""
+
+        try:
+            with open(segment.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._rebuild_index(segment, 0)
+            return
+        for i in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            seq, timestamp, offset = INDEX_ENTRY.unpack_from(data, i)
+            if offset >= segment.size:
+                break
+            segment.add_index(seq, timestamp, offset)
+
+    def _rebuild_index(self, segment, offset):
+        """Indexes the records of segment from offset on, returns where the valid records end"""
+
+        with open(segment.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = offset
+        last_indexed = segment.offsets[-1] if segment.offsets else None
+        for record_offset, seq, timestamp, room, payload in scan(data, 0, len(data)):
+            record_offset += offset
+            if last_indexed is None or record_offset - last_indexed >= self.index_interval:
+                if record_offset != last_indexed:
+                    segment.add_index(seq, timestamp, record_offset)
+                last_indexed = record_offset
+            end = record_offset + RECORD.size + len(room) + len(payload)
+        return end
+
+    def _recover(self, segment):
+        """Finds the end of the valid records of the last segment and, unless readonly, cuts off the rest"""
+
+        start = segment.offsets[-1] if segment.offsets else 0
+        end = self._rebuild_index(segment, start)
+        if end < segment.size and not self.readonly:
+            with open(segment.path, 'r+b') as f:
+                f.truncate(end)
+        segment.size = end
+        if not self.readonly:
+            with open(segment.index_path, 'wb') as f:
+                f.write(b''.join(INDEX_ENTRY.pack(*entry)
+                                 for entry in zip(segment.seqs, segment.times, segment.offsets)))
+
+    def _open_last(self):
+        if not self.segments:
+            self.segments.append(Segment(self.directory, self.next_seq))
+        segment = self.segments[-1]
+        self._file = open(segment.path, 'ab')
+        self._index_file = open(segment.index_path, 'ab')
+
+    def refresh(self):
+        """Reloads the segments, for readonly logs that another process appends to"""
+
+        self._load()
+
+    # ---- writing ----
+
+    def append(self, room: bytes, data: bytes, timestamp=None):
+        """Queues a record for the writer thread, returns its sequence number"""
+
+        with self._cond:
+            if self.error is not None:
+                raise self.error
+            seq = self.next_seq
+            self.next_seq += 1
+            self._queue.append((seq, time.time_ns() if timestamp is None else timestamp, room, data))
+            if len(self._queue) == 1:
+                self._cond.notify_all()
+        return seq
+
+    def flush(self, timeout=None):
+        """Waits until every record appended so far is written, returns False on timeout"""
+
+        with self._cond:
+            target = self.next_seq - 1
+            done = self._cond.wait_for(lambda: self.written_seq >= target or self._writer is None
+                                       or self.error is not None, timeout)
+            if self.error is not None:
+                raise self.error
+            return done
+
+    def close(self):
+        writer = self._writer
+        if writer is not None:
+            with self._cond:
+                self._closing = True
+                self._cond.notify_all()
+            writer.join()
+            self._writer = None
+        for f in (self._file, self._index_file):
+            if f is not None:
+                f.close()
+        self._file = self._index_file = None
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closing)
+                if not self._queue:
+                    return
+                batch, self._queue = self._queue, []
+
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                # disk full, I/O error...: the records can't be written, append and flush raise from now on
+                with self._cond:
+                    self.error = e
+                    self._closing = True
+                    self._writer = None
+                    self._queue = []
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.written_seq = batch[-1][0]
+                self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        segment = self.segments[-1]
+        data = bytearray()
+        index = bytearray()
+        for seq, timestamp, room, payload in batch:
+            offset = segment.size + len(data)
+            if offset >= self.segment_size:
+                self._write(segment, data, index)
+                segment = self._roll(seq)
+                data = bytearray()
+                index = bytearray()
+                offset = 0
+            if not segment.offsets or offset - segment.offsets[-1] >= self.index_interval:
+                segment.add_index(seq, timestamp, offset)
+                index += INDEX_ENTRY.pack(seq, timestamp, offset)
+            body = room + payload
+            data += RECORD.pack(seq, timestamp, zlib.crc32(body), len(room), len(payload))
+            data += body
+        self._write(segment, data, index)
+
+    def _write(self, segment, data, index):
+        if data:
+            self._file.write(data)
+            self._file.flush()
+            self._index_file.write(index)
+            self._index_file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+            self.batches += 1
+            # readers only look at what is written
+            segment.size += len(data)
+
+    def _roll(self, first_seq):
+        self._file.close()
+        self._index_file.close()
+        self.segments.append(Segment(self.directory, first_seq))
+        self._open_last()
+        if self.sync:
+            # make the new file itself durable
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return self.segments[-1]
+
+    # ---- reading ----
+
+    def records(self, since_seq=None, since_time=None, room=None):
+        """
+            Yields (seq, time, room, data) for the written records with a
+        sequence number >= since_seq or a time >= since_time, oldest
+        first, only those of room if given.
+        """
+
+        segments = list(self.segments)
+        first = 0
+        if since_seq is not None:
+            first = max(0, bisect.bisect_right([s.first_seq for s in segments], since_seq) - 1)
+        elif since_time is not None:
+            starts = [s.times[0] if s.times else 0 for s in segments]
+            first = max(0, bisect.bisect_left(starts, since_time) - 1)
+
+        for segment in segments[first:]:
+            for record in self._segment_records(segment, segment.start_offset(since_seq, since_time)):
+                if since_seq is not None and record[0] < since_seq:
+                    continue
+                if since_time is not None and record[1] < since_time:
+                    continue
+                if room is None or record[2] == room:
+                    yield record
+
+    @staticmethod
+    def _segment_records(segment, offset):
+        size = segment.size
+        if size <= offset:
+            return
+        with open(segment.path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as view:
+            for _, seq, timestamp, room, data in scan(view, offset, size):
+                yield seq, timestamp, room, data
+
+    def tail(self, count, room=None):
+        """The last count records (of room if given), oldest first"""
+
+        if count <= 0:
+            return []
+        if room is None:
+            return list(self.records(since_seq=max(1, self.written_seq - count + 1)))
+        found = []
+        for segment in reversed(self.segments):
+            records = [record for record in self._segment_records(segment, 0) if record[2] == room]
+            found[:0] = records[-(count - len(found)):]
+            if len(found) >= count:
+                break
+        return found
+
+
+def decode_message(data):
+    """(username, text) of the v1 frames of a record"""
+
+    try:
+        username, text = FrameDecoder(bufsize=0).feed(data)
+    except (ProtocolError, ValueError):
+        return '?', data.decode('utf-8', 'replace')
+    return username.decode('utf-8', 'replace'), text.decode('utf-8', 'replace')
+
+
+def format_record(record):
+    seq, timestamp, room, data = record
+    username, text = decode_message(data)
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp / 1e9))
+    return f"{seq:>8} {when} #{room.decode('utf-8', 'replace')} <{username}>: {text}"
+
+
+def parse_time(value):
+    """Seconds since the epoch or a local 'YYYY-mm-dd[ HH:MM[:SS]]' time, as ns since the epoch"""
+
+    try:
+        return int(float(value) * 1e9)
+    except ValueError:
+        pass
+    for layout in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(value, layout)) * 1e9)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"invalid time {value!r}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    tail_parser = commands.add_parser("tail", help="print the last messages")
+    tail_parser.add_argument("directory")
+    tail_parser.add_argument("-n", type=int, default=20, help="number of messages")
+    tail_parser.add_argument("--room", default=None)
+    tail_parser.add_argument("-f", "--follow", action="store_true", help="keep printing new messages")
+    search_parser = commands.add_parser("search", help="print the messages matching a regular expression")
+    search_parser.add_argument("directory")
+    search_parser.add_argument("pattern")
+    search_parser.add_argument("--room", default=None)
+    search_parser.add_argument("--since", type=parse_time, default=None)
+    search_parser.add_argument("--until", type=parse_time, default=None)
+    args = parser.parse_args(argv)
+
+    log = ChatLog(args.directory, readonly=True)
+    room = args.room.encode('utf-8') if args.room else None
+
+    if args.command == "search":
+        pattern = re.compile(args.pattern)
+        for record in log.records(since_time=args.since, room=room):
+            if args.until is not None and record[1] > args.until:
+                break
+            if pattern.search(decode_message(record[3])[1]):
+                print(format_record(record))
+        return
+
+    for record in log.tail(args.n, room):
+        print(format_record(record))
+    # resume after the last record read, not the last one printed: the others of a busy log would be read again
+    last_seq = log.written_seq
+    while args.follow:
+        time.sleep(0.5)
+        log.refresh()
+        for record in log.records(since_seq=last_seq + 1):
+            last_seq = record[0]
+            if room is None or record[2] == room:
+                print(format_record(record), flush=True)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
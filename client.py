@@ -1,25 +1,11 @@
 from tkinter import *
 import tkinter.messagebox as mb
 from xtra_widgets import *
-import threading
-import socket
-import select
-import errno
-import sys
+from client_core import IP, PORT, ConnectionManager
+import queue
 import random
 
 
-HEADER_LENGTH = 10
-
-IP = "127.0.0.1"
-PORT = 1234
-
-my_username = None
-username = None
-username_header = None
-client_socket = None
-
-
 class ChatApp(Tk):
 
     def __init__(self, *args, **kwargs):
@@ -33,6 +19,8 @@ class ChatApp(Tk):
         container.grid_columnconfigure(0, weight=1)
 
         self.frames = {}
+        self.username = None
+        self.connection = None
 
         for F in (ConnectionPage, ChatPage):
             frame = F(container, self)
@@ -52,7 +40,7 @@ class ChatApp(Tk):
 
 class ConnectionPage(Frame):
 
-    geometry = "245x100"
+    geometry = "245x125"
 
     def __init__(self, parent, controller):
         Frame.__init__(self, parent)
@@ -61,9 +49,11 @@ class ConnectionPage(Frame):
         self.username_entry = Entry(self)
         self.username_entry.insert(0, str(random.randrange(0, 9999999)))
         self.ip_entry = Entry(self)
-        self.ip_entry.insert(0, "127.0.0.1")
+        self.ip_entry.insert(0, IP)
         self.port_entry = Entry(self)
-        self.port_entry.insert(0, "5000")
+        self.port_entry.insert(0, str(PORT))
+        self.compression_var = BooleanVar(value=False)
+        self.compression_check = Checkbutton(self, text="Compression", variable=self.compression_var)
         self.connect_button = Button(self, text="Connect", command=self.connect, bd=3)
 
         Label(self, text="Username: ").grid(row=0, column=0, sticky='w')
@@ -72,40 +62,56 @@ class ConnectionPage(Frame):
         self.ip_entry.grid(row=1, column=1, sticky='ew')
         Label(self, text="Port: ").grid(row=2, column=0, sticky='w')
         self.port_entry.grid(row=2, column=1, sticky='ew')
-        self.connect_button.grid(row=3, column=0, columnspan=2, sticky='ew')
+        self.compression_check.grid(row=3, column=0, columnspan=2, sticky='w')
+        self.connect_button.grid(row=4, column=0, columnspan=2, sticky='ew')
+
+    poll_interval = 50          # ms between two checks of the connection attempt
 
     def connect(self):
-        global IP, PORT, client_socket, my_username, username, username_header
+        """Starts connecting in the background, the page waits for the outcome without blocking the UI"""
 
         try:
-            IP = self.ip_entry.get()
-            PORT = int(self.port_entry.get())
-
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((IP, PORT))
-            client_socket.setblocking(False)
-
-            my_username = self.username_entry.get()
-            username = my_username.encode('utf-8')
-            username_header = f"{len(username):<{HEADER_LENGTH}}".encode('utf-8')
-            client_socket.send(username_header + username)
-
+            ip = self.ip_entry.get()
+            port = int(self.port_entry.get())
+        except ValueError:
+            mb.showerror("Connection Error", "ERROR: The port must be a number!")
+            return
+        self.controller.username = self.username_entry.get()
+
+        chat_page = self.controller.frames[ChatPage]
+        self.controller.connection = ConnectionManager(ip, port, self.controller.username.encode('utf-8'),
+                                                       compress=self.compression_var.get(),
+                                                       on_messages=chat_page.on_messages, on_state=chat_page.on_state)
+        self.connect_button.config(state=DISABLED, text="Connecting...")
+        self.controller.connection.start()
+        self.after(self.poll_interval, self._wait_connection)
+
+    def _wait_connection(self):
+        connection = self.controller.connection
+        if connection.state == 'connected':
             self.controller.show_frame(ChatPage)
-        except ConnectionRefusedError:
-            mb.showerror("Connection Error", "ERROR: Connection Refused!\n\nTIP: Check if the IP address and port are "
-                                             "correct.")
+        elif connection.state == 'failed':
+            self.connect_button.config(state=NORMAL, text="Connect")
+            if isinstance(connection.error, ConnectionRefusedError):
+                mb.showerror("Connection Error", "ERROR: Connection Refused!\n\nTIP: Check if the IP address and port "
+                                                 "are correct.")
+            else:
+                mb.showerror("Connection Error", f"ERROR: {connection.error or 'Timed out'}")
+        else:
+            self.after(self.poll_interval, self._wait_connection)
 
 
 class ChatPage(Frame):
 
     geometry = "350x425"
+    poll_interval = 50          # ms between two updates of the chat box
 
     def on_enter(self):
-        self.check_thread.start()
+        self.after(self.poll_interval, self._show_incoming)
 
     def __init__(self, parent, controller):
         Frame.__init__(self, parent)
-        self.chat_box = ScrollBox(self, width=40, height=20)
+        self.chat_box = ScrollBox(self, width=40, height=20, max_lines=5000)
         self.txtinvar = StringVar()
         self.text_input_entry = Entry(self, textvariable=self.txtinvar)
         self.text_input_entry.bind("<Return>", lambda _: self.send_msg())
@@ -114,49 +120,49 @@ class ChatPage(Frame):
         self.chat_box.grid(row=0, column=0, columnspan=2, sticky='nsew')
         self.text_input_entry.grid(row=1, column=0, sticky='ew')
         self.send_button.grid(row=1, column=1, sticky='ew')
-        self.check_thread = threading.Thread(target=self.check_messages, daemon=True)
+        self.incoming = queue.SimpleQueue()
+        self.controller = controller
 
     def send_msg(self):
-        global my_username
+        """Sends the input as a message, or runs it if it is a /join room, /leave or /msg user text command"""
+
+        connection = self.controller.connection
+        username = self.controller.username
         txt_input = str(self.txtinvar.get())
         if txt_input:
-            self.chat_box.insert(END, f'<{my_username}>: {txt_input}')
-            message = txt_input.encode('utf-8')
-            message_header = f"{len(message):<{HEADER_LENGTH}}".encode('utf-8')
-            client_socket.send(message_header + message)
+            command, _, argument = txt_input.partition(' ')
+            suffix = '' if connection.connected else ' (offline, sent when reconnected)'
+            if command == '/msg':
+                target, _, text = argument.partition(' ')
+                self.chat_box.insert(END, f'<{username}> to {target}: {text}{suffix}')
+            elif command not in ('/join', '/leave'):
+                self.chat_box.insert(END, f'<{username}>: {txt_input}{suffix}')
+            connection.send(txt_input)
         self.text_input_entry.delete(0, END)
 
-    def check_messages(self):
-        global client_socket, username_header
-        while True:
-            try:
-                while True:
-                    username_header = client_socket.recv(HEADER_LENGTH)
-
-                    if not len(username_header):
-                        print('Connection closed by the server')
-                        sys.exit()
-
-                    username_length = int(username_header.decode('utf-8').strip())
+    def on_messages(self, messages):
+        """Connection listener, runs on the connection's thread so it only queues the lines for the Tk thread"""
+        self.incoming.put([str(message) for message in messages])
 
-                    username = client_socket.recv(username_length).decode('utf-8')
+    def on_state(self, state, detail):
+        if state == 'connected' and detail:
+            self.incoming.put(['*** Reconnected ***'])
+        elif state == 'waiting':
+            self.incoming.put([f'*** Connection lost, reconnecting in {detail:.1f} s ***'])
 
-                    message_header = client_socket.recv(HEADER_LENGTH)
-                    message_length = int(message_header.decode('utf-8').strip())
-                    message = client_socket.recv(message_length).decode('utf-8')
+    def _show_incoming(self):
+        """Moves the lines queued by the reader thread into the chat box with a single insert"""
 
-                    # Print message
-                    self.chat_box.insert(END, f'<{username}>: {message}')
-
-            except IOError as e:
-                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                    mb.showerror('Reading Error', 'Reading error: {}'.format(str(e)))
-                    sys.exit()
-                continue
-
-            except Exception as e:
-                mb.showerror('Reading Error', 'Reading error: {}'.format(str(e)))
-                sys.exit()
+        lines = []
+        try:
+            while True:
+                lines.extend(self.incoming.get_nowait())
+        except queue.Empty:
+            pass
+
+        if lines:
+            self.chat_box.insert(END, *lines)
+        self.after(self.poll_interval, self._show_incoming)
 
 
 if __name__ == "__main__":
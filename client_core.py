@@ -0,0 +1,837 @@
+"""
+    Client library of the chat: everything a client needs to talk to the
+server, without a user interface, so bots, integrations and the load
+generator share it with the Tk client.
+
+    ChatProtocol    -- the state of a connection without any I/O, for event loops of your own
+    Client          -- a blocking connection
+    AsyncClient     -- an asyncio connection
+    ConnectionManager -- a connection kept up from a background thread, reconnecting when lost
+
+    Many clients can live in one process: none of them keeps any global
+state. Run as a script, it is a command line client:
+
+    python client_core.py --username bot --room ops --send "deploy done"
+    python client_core.py --username alice          (stdin lines are sent, messages printed)
+"""
+
+import argparse
+import asyncio
+import contextlib
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import zlib
+from collections import deque
+from time import monotonic
+from protocol import (FrameDecoder, FrameDecoderV2, ProtocolError, ConnectionClosed, encode_frame, encode_hello,
+                      encode_frame_v2, make_compressor, make_decompressor, compress_block, valid_room, VERSION_1,
+                      VERSION_2, V2_HEADER, USER_ID, SERVER_ID, SEQ, HISTORY_TOKEN, FLAG_COMPRESS, WELCOME_SIZE,
+                      DEFAULT_ROOM, MSG_LOGIN, MSG_WELCOME, MSG_MESSAGE, MSG_USER, MSG_USER_LEFT, MSG_JOIN, MSG_LEAVE,
+                      MSG_DIRECT, MSG_ROOM_MESSAGE, MSG_HISTORY, MSG_PING, MSG_PONG)
+
+
+IP = "127.0.0.1"
+PORT = 5000
+SERVER_NAME = "SERVER"
+READ_SIZE = 65536
+
+NEGOTIATION_TIMEOUT = 2     # seconds to wait for a v2 welcome before falling back to v1
+CONNECT_TIMEOUT = 5         # seconds to wait for the TCP connection
+BACKOFF_BASE = 0.5          # seconds, the longest wait before the first reconnection attempt
+BACKOFF_MAX = 30            # seconds, the longest wait between two attempts
+OFFLINE_BUFFER = 1000       # messages kept while the connection is down, the oldest are dropped beyond
+SERVER_SILENCE = 60         # seconds without a frame from a v2 server before pinging it
+PING_WAIT = 10              # seconds the server has to answer the ping before the connection is given up
+
+
+def encode_login(username: bytes, version=VERSION_2, compress=False, since=None):
+    """
+        What a client sends first: the v2 hello and MSG_LOGIN, or the v1
+    username frame. since is a history token (epoch, seq), the v2
+    server then only replays the messages of the lobby that came after
+    it.
+    """
+
+    if version == VERSION_1:
+        return encode_frame(username)
+    payload = username if since is None else username + b'\0' + HISTORY_TOKEN.pack(*since)
+    return encode_hello(FLAG_COMPRESS if compress else 0) + encode_frame_v2(MSG_LOGIN, payload)
+
+
+def parse_welcome(welcome):
+    """(decoder, compressor, frames) of a v2 connection from the WELCOME_SIZE bytes of its welcome, None if it isn't one"""
+
+    length, kind = V2_HEADER.unpack_from(welcome)
+    if kind != MSG_WELCOME or length != WELCOME_SIZE - V2_HEADER.size:
+        return None
+    decoder = FrameDecoderV2()
+    compressor = None
+    if welcome[-1] & FLAG_COMPRESS:
+        decoder.decompressor = make_decompressor()
+        compressor = make_compressor()
+    return decoder, compressor, [(kind, welcome[V2_HEADER.size:])]
+
+
+def login(ip, port, username: bytes, version=VERSION_2, compress=False, since=None, timeout=None):
+    """
+        Connects to the server and logs in with username, trying
+    protocol v2 first and falling back to v1 if the server doesn't
+    answer the v2 hello. Returns (socket, version, decoder, frames,
+    compressor), frames being what the server sent right after the
+    login.
+
+        With compress the v2 hello asks for compression. compressor is
+    None unless the server accepted it, otherwise every frame sent must
+    go through compress_block(compressor, frame); the decoder already
+    decompresses what it reads.
+
+        since is a history token (epoch, seq), see encode_login.
+
+        timeout bounds the wait for the TCP connection, in seconds.
+    """
+
+    if version == VERSION_2:
+        sock = socket.create_connection((ip, port), timeout)
+        sock.sendall(encode_login(username, VERSION_2, compress, since))
+        sock.settimeout(NEGOTIATION_TIMEOUT)
+        try:
+            # read the welcome alone, whatever follows it may be compressed
+            welcome = b''
+            while len(welcome) < WELCOME_SIZE:
+                chunk = sock.recv(WELCOME_SIZE - len(welcome))
+                if not chunk:
+                    raise ConnectionClosed()
+                welcome += chunk
+            negotiated = parse_welcome(welcome)
+            if negotiated is not None:
+                decoder, compressor, frames = negotiated
+                sock.setblocking(False)
+                return sock, VERSION_2, decoder, frames, compressor
+        except (OSError, ConnectionClosed, ProtocolError):
+            pass
+        sock.close()
+
+    sock = socket.create_connection((ip, port), timeout)
+    sock.sendall(encode_login(username, VERSION_1))
+    sock.setblocking(False)
+    return sock, VERSION_1, FrameDecoder(), [], None
+
+
+def encode_input(txt_input, version):
+    """
+        Frame for a line typed by the user: a message, or a /join room,
+    /leave or /msg user text command. v1 clients send the commands as
+    text and the server runs them.
+    """
+
+    if version == VERSION_1:
+        return encode_frame(txt_input.encode('utf-8'))
+    command, _, argument = txt_input.partition(' ')
+    if command == '/join':
+        return encode_frame_v2(MSG_JOIN, argument.strip().encode('utf-8'))
+    if command == '/leave':
+        return encode_frame_v2(MSG_LEAVE)
+    if command == '/msg':
+        target, _, text = argument.partition(' ')
+        return encode_frame_v2(MSG_DIRECT, target.encode('utf-8') + b'\0' + text.encode('utf-8'))
+    return encode_frame_v2(MSG_MESSAGE, txt_input.encode('utf-8'))
+
+
+class Message:
+
+    """
+        Message: a message received from the server, whatever the
+    protocol. sender is a username, SERVER_NAME for the notices of the
+    server. sender_id and seq (the number of the message in the history
+    of its room) are only known with protocol v2.
+    """
+
+    __slots__ = ('sender', 'text', 'room', 'private', 'sender_id', 'seq')
+
+    def __init__(self, sender, text, room=None, private=False, sender_id=None, seq=None):
+        self.sender = sender
+        self.text = text
+        self.room = room
+        self.private = private
+        self.sender_id = sender_id
+        self.seq = seq
+
+    def __repr__(self):
+        return f"Message({self.sender!r}, {self.text!r}, room={self.room!r}, private={self.private})"
+
+    def __str__(self):
+        if self.private:
+            return f"<{self.sender}> (private): {self.text}"
+        return f"<{self.sender}>: {self.text}"
+
+
+class ChatProtocol:
+
+    """
+        Chat Protocol: the state of a client connection, without any
+    I/O, so it can be driven by any event loop.
+
+        encode turns what the user types (see encode_input) into bytes
+    to write, compressed if the connection is; encode_many does it for
+    several lines as a single block. decode turns the frames read from
+    the server into Message objects, and feed / read_from read them
+    first. Along the way it follows:
+
+            users           -- v2: id -> username of every connected user
+            user_id         -- v2: the id the server gave this client
+            room            -- the room the client is in
+            history_token   -- v2: (epoch, seq) of the last message seen in the room
+
+    and answers the pings of the server: control holds the frames the
+    protocol itself has to send, take_control returns them ready to be
+    written. reset starts over for a new login on a new connection,
+    keeping the room and the history token.
+    """
+
+    def __init__(self, username: bytes, version=VERSION_2, decoder=None, compressor=None):
+        self.username = username
+        self.room = DEFAULT_ROOM
+        self.history_token = None
+        self.reset(version, decoder, compressor)
+
+    def reset(self, version, decoder=None, compressor=None):
+        self.version = version
+        if decoder is None:
+            decoder = FrameDecoderV2() if version == VERSION_2 else FrameDecoder()
+        self.decoder = decoder
+        self.compressor = compressor
+        self.user_id = None
+        self.users = {SERVER_ID: SERVER_NAME}
+        self.control = []
+        self._sender = None             # v1: username frame waiting for its message
+
+    def pack(self, data):
+        """Bytes to write for data (frames), compressed as one block if the connection is"""
+        return compress_block(self.compressor, data) if self.compressor is not None else data
+
+    def encode_frame(self, txt_input):
+        """The uncompressed frame of a line typed by the user"""
+
+        if self.version == VERSION_1:
+            command, _, argument = txt_input.partition(' ')
+            if command == '/join' and valid_room(argument.strip().encode('utf-8')):
+                self.room = argument.strip().encode('utf-8')
+            elif command == '/leave':
+                self.room = DEFAULT_ROOM
+        return encode_input(txt_input, self.version)
+
+    def encode(self, txt_input):
+        return self.pack(self.encode_frame(txt_input))
+
+    def encode_many(self, lines):
+        return self.pack(b''.join(self.encode_frame(txt_input) for txt_input in lines))
+
+    def rejoin_frame(self):
+        """Frame going back to the room after a new login, asking only for what was missed"""
+
+        if self.version == VERSION_1:
+            return encode_frame(b'/join ' + self.room)
+        token = self.history_token
+        return encode_frame_v2(MSG_JOIN, self.room if token is None else self.room + b'\0' + HISTORY_TOKEN.pack(*token))
+
+    def take_control(self):
+        """The frames the protocol has to send (pongs...) ready to be written, b'' if there are none"""
+
+        if not self.control:
+            return b''
+        data = b''.join(self.control)
+        self.control = []
+        return self.pack(data)
+
+    def read_from(self, sock):
+        """Messages of a single read on sock, see FrameDecoder.read_from"""
+        return self.decode(self.decoder.read_from(sock))
+
+    def feed(self, data):
+        """Messages of data read from the connection (compressed if the connection is)"""
+
+        if self.decoder.decompressor is not None:
+            try:
+                data = self.decoder.decompressor.decompress(data)
+            except zlib.error as e:
+                raise ProtocolError(f"corrupt compressed stream ({e})")
+        return self.decode(self.decoder.feed(data))
+
+    def decode(self, frames):
+        try:
+            if self.version == VERSION_2:
+                return self._decode_v2(frames)
+            return self._decode_v1(frames)
+        except struct.error:
+            raise ProtocolError("truncated frame")
+
+    def _decode_v1(self, frames):
+        messages = []
+        room = self.room.decode('utf-8', 'replace')
+        for frame in frames:
+            # frames alternate between the sender's username and the message
+            if self._sender is None:
+                self._sender = frame.decode('utf-8', 'replace')
+                continue
+            messages.append(Message(self._sender, frame.decode('utf-8', 'replace'), room))
+            self._sender = None
+        return messages
+
+    def _decode_v2(self, frames):
+        messages = []
+        users = self.users
+        for kind, payload in frames:
+            if kind == MSG_ROOM_MESSAGE:
+                seq = SEQ.unpack_from(payload)[0]
+                sender_id = USER_ID.unpack_from(payload, SEQ.size)[0]
+                if self.history_token is not None:
+                    self.history_token = (self.history_token[0], seq)
+                messages.append(Message(users.get(sender_id, '?'),
+                                        payload[SEQ.size + USER_ID.size:].decode('utf-8', 'replace'),
+                                        self.room.decode('utf-8', 'replace'), False, sender_id, seq))
+            elif kind == MSG_MESSAGE or kind == MSG_DIRECT:
+                sender_id = USER_ID.unpack_from(payload)[0]
+                messages.append(Message(users.get(sender_id, '?'), payload[USER_ID.size:].decode('utf-8', 'replace'),
+                                        None, kind == MSG_DIRECT, sender_id))
+            elif kind == MSG_USER:
+                users[USER_ID.unpack_from(payload)[0]] = payload[USER_ID.size:].decode('utf-8', 'replace')
+            elif kind == MSG_USER_LEFT:
+                users.pop(USER_ID.unpack_from(payload)[0], None)
+            elif kind == MSG_PING:
+                self.control.append(encode_frame_v2(MSG_PONG, payload))
+            elif kind == MSG_HISTORY:
+                self.history_token = HISTORY_TOKEN.unpack(payload)
+            elif kind == MSG_JOIN:
+                self.room = payload
+                self.history_token = None
+            elif kind == MSG_WELCOME:
+                self.user_id = USER_ID.unpack_from(payload)[0]
+        return messages
+
+
+class Client:
+
+    """
+        Client: a blocking connection to the chat server, for scripts
+    and bots.
+
+            with Client(IP, PORT, b'bot') as client:
+                client.join('ops')
+                client.send_many(['one', 'two'])        # a single write
+                for message in client.receive(timeout=1.0):
+                    print(message)
+
+        Sends never wait for the server: they are pipelined behind
+    each other and, inside a batch() block, written together when the
+    block ends. receive does a single read (at most timeout seconds)
+    and returns its messages, iterating the client yields the messages
+    until the connection is closed. Pings are answered on the way.
+    """
+
+    def __init__(self, ip=IP, port=PORT, username=b'', version=VERSION_2, compress=False, since=None,
+                 timeout=CONNECT_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.wanted_version = version
+        self.compress = compress
+        self.since = since
+        self.timeout = timeout
+        self.socket = None
+        self.protocol = None
+        self.backlog = []               # messages that came with the login
+        self._batch = None
+
+    @property
+    def version(self):
+        return self.protocol.version
+
+    @property
+    def users(self):
+        return self.protocol.users
+
+    def connect(self):
+        sock, version, decoder, frames, compressor = login(self.ip, self.port, self.username, self.wanted_version,
+                                                           self.compress, self.since, self.timeout)
+        sock.setblocking(True)
+        self.socket = sock
+        self.protocol = ChatProtocol(self.username, version, decoder, compressor)
+        self.backlog = self.protocol.decode(frames)
+        return self
+
+    def __enter__(self):
+        return self.connect() if self.socket is None else self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Everything sent inside the block goes out in a single write (one compressed block) at its end"""
+
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+        finally:
+            lines, self._batch = self._batch, None
+            if lines:
+                self._write(self.protocol.encode_many(lines))
+
+    def send(self, txt_input):
+        """Sends a message, or a /join room, /leave or /msg user text command"""
+
+        if self._batch is not None:
+            self._batch.append(txt_input)
+        else:
+            self._write(self.protocol.encode(txt_input))
+
+    def send_many(self, lines):
+        with self.batch():
+            for txt_input in lines:
+                self.send(txt_input)
+
+    def join(self, room):
+        self.send(f'/join {room}')
+
+    def leave(self):
+        self.send('/leave')
+
+    def direct(self, target, text):
+        self.send(f'/msg {target} {text}')
+
+    def ping(self, payload=b''):
+        """Asks a v2 server for a MSG_PONG, it counts as traffic for its heartbeat"""
+        if self.protocol.version == VERSION_2:
+            self._write(self.protocol.pack(encode_frame_v2(MSG_PING, payload)))
+
+    def receive(self, timeout=None):
+        """Messages of a single read, [] if nothing came in timeout seconds, ConnectionClosed once closed"""
+
+        if self.backlog:
+            messages, self.backlog = self.backlog, []
+            return messages
+        self.socket.settimeout(timeout)
+        try:
+            messages = self.protocol.read_from(self.socket)
+        except (TimeoutError, BlockingIOError):
+            return []
+        finally:
+            self.socket.settimeout(None)
+        control = self.protocol.take_control()
+        if control:
+            self._write(control)
+        return messages
+
+    def __iter__(self):
+        try:
+            while True:
+                yield from self.receive()
+        except ConnectionClosed:
+            return
+
+    def _write(self, data):
+        self.socket.sendall(data)
+
+
+class AsyncClient:
+
+    """
+        Async Client: the same connection as Client for asyncio.
+
+            async with AsyncClient(IP, PORT, b'bot') as client:
+                await client.send('hello')
+                async for message in client:
+                    print(message)
+
+        send writes at once and only waits when the transport buffer is
+    full (writer.drain); send_nowait doesn't wait at all, so a burst of
+    sends is pipelined, and send_many writes its lines as one block.
+    Iterating the client yields messages until the connection closes.
+    """
+
+    def __init__(self, ip=IP, port=PORT, username=b'', version=VERSION_2, compress=False, since=None,
+                 timeout=CONNECT_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.wanted_version = version
+        self.compress = compress
+        self.since = since
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.protocol = None
+        self.backlog = deque()
+
+    @property
+    def version(self):
+        return self.protocol.version
+
+    @property
+    def users(self):
+        return self.protocol.users
+
+    async def connect(self):
+        if self.wanted_version == VERSION_2:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), self.timeout)
+            writer.write(encode_login(self.username, VERSION_2, self.compress, self.since))
+            try:
+                welcome = await asyncio.wait_for(reader.readexactly(WELCOME_SIZE), NEGOTIATION_TIMEOUT)
+                negotiated = parse_welcome(welcome)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                negotiated = None
+            if negotiated is not None:
+                decoder, compressor, frames = negotiated
+                self._connected(reader, writer, VERSION_2, decoder, compressor, frames)
+                return self
+            writer.close()
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.ip, self.port), self.timeout)
+        writer.write(encode_login(self.username, VERSION_1))
+        self._connected(reader, writer, VERSION_1, None, None, [])
+        return self
+
+    def _connected(self, reader, writer, version, decoder, compressor, frames):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = ChatProtocol(self.username, version, decoder, compressor)
+        self.backlog.extend(self.protocol.decode(frames))
+
+    async def __aenter__(self):
+        return await self.connect() if self.writer is None else self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    def send_nowait(self, txt_input):
+        self.writer.write(self.protocol.encode(txt_input))
+
+    async def send(self, txt_input):
+        self.send_nowait(txt_input)
+        await self.writer.drain()
+
+    async def send_many(self, lines):
+        self.writer.write(self.protocol.encode_many(lines))
+        await self.writer.drain()
+
+    async def join(self, room):
+        await self.send(f'/join {room}')
+
+    async def leave(self):
+        await self.send('/leave')
+
+    async def direct(self, target, text):
+        await self.send(f'/msg {target} {text}')
+
+    async def receive(self):
+        """Messages of a single read, ConnectionClosed once the connection is closed"""
+
+        if self.backlog:
+            messages = list(self.backlog)
+            self.backlog.clear()
+            return messages
+        data = await self.reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionClosed()
+        messages = self.protocol.feed(data)
+        control = self.protocol.take_control()
+        if control:
+            self.writer.write(control)
+        return messages
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.backlog:
+            try:
+                self.backlog.extend(await self.receive())
+            except ConnectionClosed:
+                raise StopAsyncIteration
+        return self.backlog.popleft()
+
+
+class ConnectionManager:
+
+    """
+        Connection Manager: keeps a client logged in to the server from
+    a background thread, so nothing ever blocks the caller.
+
+        start connects with a timeout. If the first attempt fails the
+    state becomes 'failed' and error tells why. Once it has been
+    connected, a lost connection is retried forever, waiting a random
+    time between 0 and BACKOFF_BASE * 2 ** attempt (at most BACKOFF_MAX)
+    seconds between two attempts, so clients that lost the same server
+    don't all come back at once. Every new connection logs in again
+    with the same username and the history token of the last message
+    seen, then goes back to the room the client was in, so the server
+    only replays what was missed.
+
+        The pings of a v2 server are answered right away. A v2 server
+    silent for SERVER_SILENCE seconds is pinged in turn and the
+    connection is given up, and retried, if nothing arrives in PING_WAIT
+    seconds: a half-open connection would otherwise look alive forever.
+
+        send queues a line typed by the user (see encode_input). The
+    lines sent while the connection is down are kept, at most
+    OFFLINE_BUFFER of them, and sent once it is back.
+
+        on_messages(messages) is called with the Message objects of the
+    server and on_state(state, detail) on every change of state:
+
+            ('connected', reconnected)      -- reconnected is False the first time
+            ('waiting', delay)              -- the connection is lost, next attempt in delay seconds
+            ('failed', error)               -- the first connection failed, the manager stopped
+
+    Both run on the thread of the manager. protocol is the ChatProtocol
+    of the connection, its users are those of the current login.
+    """
+
+    def __init__(self, ip, port, username: bytes, version=VERSION_2, compress=False, on_messages=None,
+                 on_state=None, timeout=CONNECT_TIMEOUT):
+        self.ip = ip
+        self.port = port
+        self.username = username
+        self.wanted_version = version
+        self.compress = compress
+        self.timeout = timeout
+        self.on_messages = on_messages or (lambda messages: None)
+        self.on_state = on_state or (lambda state, detail: None)
+
+        self.state = 'connecting'
+        self.error = None
+        self.protocol = ChatProtocol(username, version)
+        self.outgoing = deque(maxlen=OFFLINE_BUFFER)
+        self._inflight = []             # lines whose frames are in _outbuf
+        self._outbuf = b''
+        self._closed = threading.Event()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def connected(self):
+        return self.state == 'connected'
+
+    @property
+    def version(self):
+        return self.protocol.version
+
+    def start(self):
+        self._thread.start()
+
+    def send(self, txt_input):
+        self.outgoing.append(txt_input)
+        self._wake()
+
+    def close(self):
+        self._closed.set()
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass                        # already woken up, or closed
+
+    def _set_state(self, state, detail=None):
+        self.state = state
+        self.on_state(state, detail)
+
+    def _run(self):
+        attempt = 0
+        reconnected = False
+        protocol = self.protocol
+        while not self._closed.is_set():
+            token = protocol.history_token if protocol.room == DEFAULT_ROOM else None
+            try:
+                sock, version, decoder, frames, compressor = login(
+                    self.ip, self.port, self.username, self.wanted_version, self.compress, token, self.timeout)
+            except OSError as e:
+                if not reconnected:
+                    self.error = e
+                    self._set_state('failed', e)
+                    break
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                attempt += 1
+                self._set_state('waiting', delay)
+                self._closed.wait(delay)
+                continue
+
+            attempt = 0
+            protocol.reset(version, decoder, compressor)
+            self._set_state('connected', reconnected)
+            reconnected = True
+            self._deliver(protocol.decode(frames))
+            rejoin = protocol.rejoin_frame() if protocol.room != DEFAULT_ROOM else b''
+            try:
+                self._serve(sock, rejoin)
+            except (OSError, ConnectionClosed, ProtocolError):
+                pass
+            sock.close()
+            # the lines that may not have made it go out again on the next connection
+            self.outgoing.extendleft(reversed(self._inflight))
+            self._inflight = []
+            self._outbuf = b''
+            if not self._closed.is_set():
+                self._set_state('waiting', 0.0)
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def _deliver(self, messages):
+        if messages:
+            self.on_messages(messages)
+
+    def _serve(self, sock, rejoin):
+        """Reads and writes until the connection is lost or the manager is closed, rejoin goes out first"""
+
+        protocol = self.protocol
+        if rejoin:
+            self._outbuf = protocol.pack(rejoin)
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
+        selector.register(sock, selectors.EVENT_READ)
+        writing = False
+        last_received = monotonic()
+        pinged = False
+        try:
+            while not self._closed.is_set():
+                if protocol.version == VERSION_2:
+                    silent = monotonic() - last_received
+                    if silent >= SERVER_SILENCE + PING_WAIT:
+                        raise ConnectionClosed()
+                    if silent >= SERVER_SILENCE and not pinged:
+                        protocol.control.append(encode_frame_v2(MSG_PING))
+                        pinged = True
+                self._fill()
+                if self._outbuf:
+                    try:
+                        sent = sock.send(self._outbuf)
+                        self._outbuf = self._outbuf[sent:]
+                    except BlockingIOError:
+                        pass
+                    if not self._outbuf:
+                        self._inflight = []
+                if bool(self._outbuf) != writing:
+                    writing = not writing
+                    selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE if writing
+                                    else selectors.EVENT_READ)
+
+                for key, mask in selector.select(1.0):
+                    if key.fileobj is self._wakeup_r:
+                        try:
+                            while self._wakeup_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    elif mask & selectors.EVENT_READ:
+                        while True:
+                            try:
+                                messages = protocol.read_from(sock)
+                            except BlockingIOError:
+                                break
+                            last_received = monotonic()
+                            pinged = False
+                            self._deliver(messages)
+        finally:
+            selector.close()
+
+    def _fill(self):
+        """Moves the queued lines and the frames of the protocol into the output buffer, as a single block"""
+
+        protocol = self.protocol
+        if not self.outgoing and not protocol.control:
+            return
+        frames, protocol.control = protocol.control, []
+        while self.outgoing:
+            txt_input = self.outgoing.popleft()
+            self._inflight.append(txt_input)
+            frames.append(protocol.encode_frame(txt_input))
+        # a compressed block can't be cut short, the rest of the stream depends on it
+        self._outbuf += protocol.pack(b''.join(frames))
+
+
+def run_cli(args):
+    """Sends args.send (or the lines of stdin) and prints what comes in, until stdin ends or args.wait is over"""
+
+    version = VERSION_1 if args.v1 else VERSION_2
+    with Client(args.host, args.port, args.username.encode('utf-8'), version, args.compression) as client:
+        with client.batch():
+            if args.room:
+                client.join(args.room)
+            for txt_input in args.send:
+                client.send(txt_input)
+
+        selector = selectors.DefaultSelector()
+        selector.register(client.socket, selectors.EVENT_READ)
+        interactive = not args.send
+        if interactive:
+            selector.register(sys.stdin, selectors.EVENT_READ)
+        deadline = None if interactive else monotonic() + args.wait
+        for message in client.backlog:
+            print(message, flush=True)
+        client.backlog = []
+        while deadline is None or monotonic() < deadline:
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+            for key, _ in selector.select(timeout):
+                if key.fileobj is sys.stdin:
+                    line = sys.stdin.readline()
+                    if not line:
+                        return
+                    if line.strip():
+                        client.send(line.rstrip('\n'))
+                    continue
+                try:
+                    messages = client.receive(0)
+                except ConnectionClosed:
+                    print("*** Connection closed by the server ***", file=sys.stderr)
+                    return
+                for message in messages:
+                    print(message, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Command line chat client")
+    parser.add_argument("--host", default=IP)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--room", default=None, help="join this room after logging in")
+    parser.add_argument("--send", action="append", default=[],
+                        help="send this line (message or command) instead of reading stdin, may be repeated")
+    parser.add_argument("--wait", type=float, default=1.0,
+                        help="seconds to print what comes in after the --send lines before leaving")
+    parser.add_argument("--compression", action="store_true", help="ask the server for compression")
+    parser.add_argument("--v1", action="store_true", help="speak protocol v1")
+    args = parser.parse_args(argv)
+    try:
+        run_cli(args)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        parser.exit(1, f"error: {e}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import multiprocessing
+import selectors
+import signal
+import socket
+from protocol import FrameDecoder, ProtocolError, ConnectionClosed, encode_frame, MSG_ROOM_MESSAGE
+from server_core import (ChatServer, split_encodings, IP, PORT, SERVER_USRNAME, BUS_BROADCAST, BUS_JOIN, BUS_LEAVE,
+                         BUS_ROOM)
+
+
+def _run_worker(server, bus_socket, unused):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)     # the pool shuts the workers down
+    for sock in unused:
+        sock.close()
+    server.attach_bus(bus_socket)
+    server.serve_forever()
+
+
+class WorkerPool:
+
+    """
+        Worker Pool: runs the chat server in several processes, so it
+    isn't limited to a single core.
+
+        Every worker is a ChatServer bound to the same address with
+    SO_REUSEPORT, the kernel spreads the new connections among them.
+    The pool is linked to each worker by a Unix domain socket pair and
+    relays the broadcasts, logins and logouts of one worker to all the
+    others, so a message sent by a client of worker A reaches the
+    clients of worker B and both know every user of the pool.
+
+        Workers also report the logins and logouts of their clients, so
+    the pool can be observed exactly like a single ChatServer: it has
+    the same add_listener / bind / serve_forever / shutdown interface
+    and emits the same events for the clients of all the workers.
+
+        With a log (a chatlog.ChatLog) the pool, which sees every room
+    message of every worker, is its only writer. The workers read it
+    back into their room histories before they are started.
+
+        With metrics_port, worker i serves its metrics on
+    metrics_port + i (see ChatServer).
+
+        A pool can be a node of a federation: attach_bus adds a link
+    that isn't a worker, relayed to like the others (see federation.py).
+    Worker i hands out the user ids id_start + i * id_step, then every
+    workers * id_step, so the pool uses the same ids as a single server
+    with id_start and id_step would.
+    """
+
+    def __init__(self, host=IP, port=PORT, workers=2, log=None, id_start=1, id_step=1, **server_options):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
+
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.server_options = server_options
+        self.log = log
+        self.id_start = id_start
+        self.id_step = id_step
+
+        self.links = []
+        self.listeners = []
+        self.running = False
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _emit(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def bind(self):
+        """Binds one listening socket per worker and starts the worker processes"""
+
+        servers = []
+        pairs = []
+        try:
+            for i in range(self.workers):
+                options = dict(self.server_options)
+                if options.get('metrics_port') is not None:
+                    # every worker has its own metrics, on the next port
+                    options['metrics_port'] += i
+                server = ChatServer(self.host, self.port, reuse_port=True, id_start=self.id_start + i * self.id_step,
+                                    id_step=self.workers * self.id_step, **options)
+                server.bind()
+                if self.log is not None:
+                    server.restore_history(self.log)
+                servers.append(server)
+                pairs.append(socket.socketpair())
+        except OSError:
+            for server in servers:
+                server._close()
+            for pair in pairs:
+                for sock in pair:
+                    sock.close()
+            raise
+
+        context = multiprocessing.get_context('fork')
+        for i, server in enumerate(servers):
+            # a worker must not keep the listening sockets and bus ends of the others open
+            unused = [s.server_socket for s in servers if s is not server]
+            unused += [sock for j, pair in enumerate(pairs) for sock in pair if sock is not pairs[i][1]]
+            process = context.Process(target=_run_worker, args=(server, pairs[i][1], unused), daemon=True)
+            process.start()
+            self.links.append({'socket': pairs[i][0], 'process': process, 'decoder': FrameDecoder(), 'users': {}})
+
+        for server, pair in zip(servers, pairs):
+            server._close()
+            pair[1].close()
+
+    def attach_bus(self, bus_socket):
+        """Links the pool to a bus that isn't one of its workers, must be called before serve_forever"""
+        self.links.append({'socket': bus_socket, 'process': None, 'decoder': FrameDecoder(), 'users': {}})
+
+    def serve_forever(self):
+        if not self._workers():
+            self.bind()
+
+        selector = selectors.DefaultSelector()
+        for link in self.links:
+            selector.register(link['socket'], selectors.EVENT_READ, link)
+
+        self.running = True
+        while self.running and self._workers():
+            for key, _ in selector.select(0.5):
+                link = key.data
+                try:
+                    frames = link['decoder'].read_from(link['socket'])
+                except (OSError, ConnectionClosed, ProtocolError):
+                    selector.unregister(link['socket'])
+                    self._worker_lost(link)
+                    continue
+
+                for payload in frames:
+                    self._dispatch(link, payload)
+
+        selector.close()
+        self._close()
+
+    def shutdown(self):
+        self.running = False
+
+    def _workers(self):
+        return [link for link in self.links if link['process'] is not None]
+
+    def _dispatch(self, link, payload):
+        frame = encode_frame(payload)
+        for other in self.links:
+            if other is not link:
+                try:
+                    other['socket'].sendall(frame)
+                except OSError:
+                    pass    # its read side reports the lost worker
+
+        kind = payload[:1]
+        if kind == BUS_BROADCAST:
+            if self.log is not None:
+                self._log_message(payload)
+            if self.listeners:
+                self._emit_messages(payload)
+        elif kind == BUS_JOIN:
+            host, port, user_id, username = payload[1:].split(b'\0', 3)
+            link['users'][int(user_id)] = username
+            self._emit('connect', username.decode('utf-8', 'replace'), (host.decode('utf-8'), int(port)), int(user_id))
+        elif kind == BUS_LEAVE:
+            user_id = int(payload[1:].split(b'\0', 1)[0])
+            username = link['users'].pop(user_id, None)
+            if username is not None:
+                self._emit('disconnect', username.decode('utf-8', 'replace'), user_id)
+        elif kind == BUS_ROOM:
+            user_id, room = payload[1:].split(b'\0', 1)
+            username = link['users'].get(int(user_id))
+            if username is not None:
+                self._emit('room', username.decode('utf-8', 'replace'), int(user_id), room.decode('utf-8'))
+
+    def _emit_messages(self, payload):
+        room, encoded = split_encodings(payload)
+        frames = FrameDecoder().feed(encoded[1])
+        for username, message in zip(frames[::2], frames[1::2]):
+            username = username.decode('utf-8', 'replace')
+            if username != SERVER_USRNAME:
+                self._emit('message', username, message.decode('utf-8', 'replace'), room.decode('utf-8'))
+
+    def _log_message(self, payload):
+        room, encoded = split_encodings(payload)
+        if room and encoded[2][4] == MSG_ROOM_MESSAGE:
+            self.log.append(room, bytes(encoded[1]))
+
+    def _worker_lost(self, link):
+        """Logs the users of a lost worker out of the others, which would otherwise keep them forever"""
+
+        self.links.remove(link)
+        link['socket'].close()
+        frames = []
+        for user_id, username in link['users'].items():
+            frames.append(encode_frame(BUS_LEAVE + f"{user_id}\0".encode('utf-8') + username))
+            self._emit('disconnect', username.decode('utf-8', 'replace'), user_id)
+        if frames:
+            data = b''.join(frames)
+            for other in self.links:
+                try:
+                    other['socket'].sendall(data)
+                except OSError:
+                    pass    # its read side reports the lost worker
+
+    def _close(self):
+        for link in self.links:
+            link['socket'].close()
+            if link['process'] is not None:
+                link['process'].terminate()
+        for link in self.links:
+            if link['process'] is not None:
+                link['process'].join(1)
+        self.links = []
@@ -0,0 +1,406 @@
+import errno
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+from time import monotonic
+from protocol import FrameDecoder, ProtocolError, ConnectionClosed, encode_frame
+from server_core import BUS_JOIN, BUS_LEAVE, BUS_ROOM
+
+
+FEDERATION_PORT = 5100
+NODES = 256             # node ids are 1 to NODES - 1, the user ids of node n are n, n + NODES, n + 2 * NODES...
+MAX_HOPS = 16           # links a relayed message may cross, a bound on top of the deduplication
+HEARTBEAT = 1.0         # seconds between two heartbeats of a node
+NODE_TIMEOUT = 5.0      # seconds without hearing from a node before its users are dropped
+RETRY_BASE = 0.5        # seconds before dialing a lost peer again, doubled after every failure
+RETRY_MAX = 30.0
+PEER_HIGH_WATER = 16 * 1024 * 1024     # bytes queued for a peer before the link is dropped
+
+# Peer links use the v1 framing. The first frame in each direction is FED_HELLO + HELLO, every other
+# one is ENVELOPE + a bus message (see server_core.py) or FED_HEARTBEAT. A message is identified by
+# the instance id of the node it comes from (origin, random for every run) and the sequence number
+# that node gave it. Sequence number 0 marks a presence snapshot, which is only passed on when it
+# teaches the node something.
+FED_HELLO = b'H'
+HELLO = struct.Struct('!QH')            # instance id, node id
+ENVELOPE = struct.Struct('!QQB')        # origin, sequence number, hops
+FED_HEARTBEAT = b'P'
+PRESENCE = (BUS_JOIN, BUS_LEAVE, BUS_ROOM)
+
+
+def node_options(node_id):
+    """ChatServer / WorkerPool options giving node_id its own slice of the user ids"""
+
+    if not 0 < node_id < NODES:
+        raise ValueError(f"node id {node_id} is not between 1 and {NODES - 1}")
+    return {'id_start': node_id, 'id_step': NODES}
+
+
+def parse_peer(text):
+    """'host:port' -> (host, port)"""
+
+    host, sep, port = text.rpartition(':')
+    if not sep or not host:
+        raise ValueError(f"peer {text!r} is not host:port")
+    return host, int(port)
+
+
+class Link:
+
+    """
+        Link: a connection of the federation, to a peer node or to the
+    local server, with its own decoder and outbox.
+    """
+
+    __slots__ = ('socket', 'decoder', 'outbox', 'peer', 'address', 'connecting', 'ready', 'origin', 'node_id')
+
+    def __init__(self, sock, peer=True, address=None, connecting=False):
+        sock.setblocking(False)
+        self.socket = sock
+        self.decoder = FrameDecoder()
+        self.outbox = bytearray()
+        self.peer = peer
+        self.address = address          # what to dial again when the link is lost, None for accepted links
+        self.connecting = connecting
+        self.ready = not peer           # a peer is ready once its hello is in
+        self.origin = None
+        self.node_id = None
+
+
+class Federation:
+
+    """
+        Federation: links chat server nodes on different hosts, so the
+    number of users isn't bounded by what one node can serve.
+
+        A node is a ChatServer or a WorkerPool attached to a Federation.
+    The federation takes the place of the worker bus for it (attach
+    calls its attach_bus): the node publishes the broadcasts, direct
+    messages, logins, logouts and room changes of its clients, the
+    federation relays them to its peers and hands what the peers send
+    to the node. Every node therefore reaches the clients of the whole
+    federation and lists its users, while it only does the work for its
+    own clients: adding a node adds capacity.
+
+        Peer links are TCP connections speaking the v1 framing. A node
+    listens for peers on port and dials every address of peers, again
+    with a growing delay whenever the link is lost, so the nodes may be
+    started in any order. Any connected topology works: a message is
+    flooded on every link but the one it came from, and dropped by a
+    node that has already seen it. Messages are identified by the
+    instance id of their origin and a sequence number; every link
+    keeps the order of the messages, so the first copy of a message
+    always arrives after the first copy of the previous one, and
+    remembering the last sequence number of each origin is enough to
+    recognise the copies. A node ignores its own messages coming back
+    and no message crosses more than MAX_HOPS links.
+
+        Presence is kept per origin: every node sends a heartbeat each
+    HEARTBEAT seconds and the users of a node not heard from for
+    NODE_TIMEOUT seconds are logged out. A new link starts with a
+    snapshot of every user the two nodes know of, passed on to the
+    other peers as far as it is news.
+
+        User ids must be unique across the federation: every node needs
+    its own node_id, and its server the ids node_options(node_id)
+    gives it. A peer with the same node id is refused.
+
+        The federation runs on its own thread (start) and stops when its
+    node is shut down.
+    """
+
+    def __init__(self, node_id, host='0.0.0.0', port=FEDERATION_PORT, peers=()):
+        node_options(node_id)           # validates it
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+        self.origin = int.from_bytes(os.urandom(8), 'big') or 1
+        self.seq = 0
+        self.last_seq = {}              # origin -> last sequence number seen
+        self.heard = {}                 # origin -> when it was last heard from
+        self.users = {}                 # user id -> [join message, room message or None, origin]
+
+        self.server_socket = None
+        self.local = None
+        self.links = []
+        self.dial = {parse_peer(peer) if isinstance(peer, str) else peer: [0.0, RETRY_BASE] for peer in peers}
+        self.selector = None
+        self.running = False
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server_socket.getsockname() if self.server_socket is not None else None
+
+    @property
+    def peers(self):
+        """(node id, address) of the peers linked right now"""
+        return [(link.node_id, link.socket.getpeername()) for link in self.links if link.peer and link.ready]
+
+    def bind(self):
+        if self.port is not None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.server_socket.setblocking(False)
+
+    def attach(self, server):
+        """Becomes the bus of server (ChatServer or WorkerPool), must be called before it serves"""
+
+        pair = socket.socketpair()
+        server.attach_bus(pair[1])
+        self.local = Link(pair[0], peer=False)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="federation", daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        self.running = False
+
+    def serve_forever(self):
+        if self.server_socket is None and self.port is not None:
+            self.bind()
+
+        self.selector = selectors.DefaultSelector()
+        if self.server_socket is not None:
+            self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self._register(self.local)
+
+        self.running = True
+        next_heartbeat = 0.0
+        while self.running:
+            now = monotonic()
+            if now >= next_heartbeat:
+                self._heartbeat(now)
+                next_heartbeat = now + HEARTBEAT
+            for address, retry in self.dial.items():
+                if retry[0] is not None and now >= retry[0]:
+                    self._connect(address)
+
+            for key, mask in self.selector.select(min(HEARTBEAT, max(0.0, next_heartbeat - monotonic()))):
+                link = key.data
+                if link is None:
+                    self._accept()
+                    continue
+                if link.socket.fileno() < 0:
+                    continue        # dropped earlier in this iteration
+                if mask & selectors.EVENT_WRITE:
+                    self._write(link)
+                if mask & selectors.EVENT_READ and link.socket.fileno() >= 0:
+                    self._read(link)
+
+        self._close()
+
+    def _register(self, link):
+        events = selectors.EVENT_WRITE if link.connecting else selectors.EVENT_READ
+        self.selector.register(link.socket, events, link)
+        self.links.append(link)
+
+    def _accept(self):
+        try:
+            sock, _ = self.server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = Link(sock)
+        self._register(link)
+        self._hello(link)
+
+    def _connect(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._retry(address)
+            return
+        self.dial[address][0] = None    # until the link is lost
+        link = Link(sock, address=address, connecting=True)
+        self._register(link)
+
+    def _retry(self, address):
+        retry = self.dial[address]
+        retry[0] = monotonic() + random.uniform(0, retry[1])
+        retry[1] = min(retry[1] * 2, RETRY_MAX)
+
+    def _hello(self, link):
+        self._queue(link, encode_frame(FED_HELLO + HELLO.pack(self.origin, self.node_id)))
+
+    def _drop(self, link):
+        """Closes a link and forgets it, a peer that was dialed is dialed again"""
+
+        if link.socket.fileno() < 0:
+            return                      # already dropped
+        self.selector.unregister(link.socket)
+        link.socket.close()
+        self.links.remove(link)
+        if link is self.local:
+            # the node is gone, there is no one left to relay for
+            self.running = False
+        elif link.address is not None:
+            self._retry(link.address)
+
+    def _queue(self, link, frame):
+        if link.socket.fileno() < 0:
+            return                      # dropped, by an earlier frame that went over PEER_HIGH_WATER...
+        link.outbox += frame
+        if link.peer and len(link.outbox) > PEER_HIGH_WATER:
+            # a peer that can't keep up is dropped, it gets a fresh snapshot when it is back
+            self._drop(link)
+        elif not link.connecting and len(link.outbox) == len(frame):
+            self._write(link)
+
+    def _write(self, link):
+        if link.connecting:
+            err = link.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._drop(link)
+                return
+            link.connecting = False
+            self.dial[link.address][1] = RETRY_BASE
+            self.selector.modify(link.socket, selectors.EVENT_READ, link)
+            self._hello(link)
+            return
+
+        try:
+            sent = link.socket.send(link.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(link)
+            return
+        del link.outbox[:sent]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if link.outbox else selectors.EVENT_READ
+        if self.selector.get_key(link.socket).events != events:
+            self.selector.modify(link.socket, events, link)
+
+    def _read(self, link):
+        try:
+            frames = link.decoder.read_from(link.socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ConnectionClosed, ProtocolError):
+            self._drop(link)
+            return
+
+        now = monotonic()
+        for frame in frames:
+            if link.socket.fileno() < 0:
+                return
+            if link is self.local:
+                self._from_local(frame)
+            elif link.ready:
+                self._from_peer(link, frame, now)
+            else:
+                self._peer_hello(link, frame)
+
+    def _peer_hello(self, link, frame):
+        if frame[:1] != FED_HELLO or len(frame) != 1 + HELLO.size:
+            self._drop(link)
+            return
+        link.origin, link.node_id = HELLO.unpack_from(frame, 1)
+        if link.origin == self.origin or link.node_id == self.node_id:
+            # a link to itself, or a node that would hand out the same user ids
+            self._drop(link)
+            if link.address is not None:
+                self.dial[link.address][0] = None
+            return
+        link.ready = True
+        self._snapshot(link)
+
+    def _snapshot(self, link):
+        """Sends the new peer every user this node knows of"""
+
+        for user_id, (join, room, origin) in self.users.items():
+            self._queue(link, encode_frame(ENVELOPE.pack(origin, 0, 0) + join))
+            if room is not None:
+                self._queue(link, encode_frame(ENVELOPE.pack(origin, 0, 0) + room))
+            if link.socket.fileno() < 0:
+                break                   # over PEER_HIGH_WATER, dropped
+
+    def _flood(self, data, source):
+        frame = encode_frame(data)
+        for link in list(self.links):
+            if link.peer and link.ready and link is not source:
+                self._queue(link, frame)
+
+    def _heartbeat(self, now):
+        self.seq += 1
+        self._flood(ENVELOPE.pack(self.origin, self.seq, 0) + FED_HEARTBEAT, None)
+        for origin, heard in list(self.heard.items()):
+            if now - heard > NODE_TIMEOUT:
+                del self.heard[origin]
+                self._node_lost(origin)
+
+    def _node_lost(self, origin):
+        for user_id, (join, _, user_origin) in list(self.users.items()):
+            if user_origin == origin:
+                del self.users[user_id]
+                username = join[1:].split(b'\0', 3)[3]
+                self._queue(self.local, encode_frame(BUS_LEAVE + f"{user_id}\0".encode('utf-8') + username))
+
+    def _from_local(self, payload):
+        if payload[:1] in PRESENCE:
+            self._presence(payload, self.origin)
+        self.seq += 1
+        self._flood(ENVELOPE.pack(self.origin, self.seq, 0) + payload, None)
+
+    def _from_peer(self, link, frame, now):
+        origin, seq, hops = ENVELOPE.unpack_from(frame)
+        if origin == self.origin:
+            return
+        payload = frame[ENVELOPE.size:]
+        if seq:
+            if seq <= self.last_seq.get(origin, 0):
+                return
+            self.last_seq[origin] = seq
+            self.heard[origin] = now
+
+        if payload[:1] in PRESENCE:
+            if not self._presence(payload, origin):
+                return
+            if not seq:
+                # a user learnt from a snapshot keeps its node alive until it is heard from
+                self.heard.setdefault(origin, now)
+        elif not seq:
+            return
+        if payload != FED_HEARTBEAT:
+            self._queue(self.local, encode_frame(payload))
+        if hops + 1 < MAX_HOPS:
+            self._flood(ENVELOPE.pack(origin, seq, hops + 1) + payload, link)
+
+    def _presence(self, payload, origin):
+        """Applies a login, logout or room change, returns False if it changes nothing"""
+
+        kind = payload[:1]
+        if kind == BUS_JOIN:
+            user_id = int(payload[1:].split(b'\0', 3)[2])
+            if user_id in self.users:
+                return False
+            self.users[user_id] = [payload, None, origin]
+        elif kind == BUS_LEAVE:
+            user_id = int(payload[1:].split(b'\0', 1)[0])
+            if self.users.pop(user_id, None) is None:
+                return False
+        else:
+            user_id = int(payload[1:].split(b'\0', 1)[0])
+            user = self.users.get(user_id)
+            if user is None or user[1] == payload:
+                return False
+            user[1] = payload
+        return True
+
+    def _close(self):
+        for link in self.links:
+            link.socket.close()
+        self.links = []
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+        self.selector.close()
@@ -0,0 +1,109 @@
+import random
+from collections import OrderedDict
+
+
+HISTORY_MESSAGES = 500          # messages kept per room
+HISTORY_BYTES = 256 * 1024      # bytes of frames kept per room
+HISTORY_ROOMS = 1024            # rooms with a history, the least recently used one is forgotten
+
+
+class RoomHistory:
+
+    """
+        Room History: the last messages of a room, as the frames that
+    were fanned out to its members, in a ring of at most capacity
+    messages and max_bytes bytes of frames.
+
+        Every message gets the next sequence number, starting at 1.
+    The frames are stored as they are, replaying them queues the same
+    objects again so nothing is copied. epoch is random, it tells apart
+    the sequence numbers of two histories of the same room (a restarted
+    server, another worker of a pool...).
+    """
+
+    __slots__ = ('epoch', 'max_bytes', 'size', 'next_seq', '_entries', '_first')
+
+    def __init__(self, capacity=HISTORY_MESSAGES, max_bytes=HISTORY_BYTES):
+        self.epoch = random.getrandbits(32)
+        self.max_bytes = max_bytes
+        self.size = 0               # bytes of the frames kept
+        self.next_seq = 1
+        self._entries = [None] * capacity
+        self._first = 1             # sequence number of the oldest message kept
+
+    def __len__(self):
+        return self.next_seq - self._first
+
+    @property
+    def last_seq(self):
+        """Sequence number of the newest message, 0 if there is none yet"""
+        return self.next_seq - 1
+
+    def append(self, frames):
+        """Stores frames, a (None, v1 frames, v2 frame) tuple numbered self.next_seq"""
+
+        capacity = len(self._entries)
+        if len(self) == capacity:
+            self._evict()
+        self._entries[self.next_seq % capacity] = frames
+        self.size += len(frames[1]) + len(frames[2])
+        self.next_seq += 1
+        while self.size > self.max_bytes and len(self) > 1:
+            self._evict()
+
+    def _evict(self):
+        capacity = len(self._entries)
+        frames = self._entries[self._first % capacity]
+        self._entries[self._first % capacity] = None
+        self.size -= len(frames[1]) + len(frames[2])
+        self._first += 1
+
+    def last(self, count):
+        """The frames of the last count messages, oldest first"""
+
+        capacity = len(self._entries)
+        start = max(self._first, self.next_seq - count)
+        return [self._entries[seq % capacity] for seq in range(start, self.next_seq)]
+
+    def since(self, epoch, seq):
+        """
+            The frames of the messages after seq, oldest first, or None if
+        the token is from another history. If some of the messages after
+        seq are no longer kept, all those that are kept.
+        """
+
+        if epoch != self.epoch or seq > self.last_seq:
+            return None
+        capacity = len(self._entries)
+        return [self._entries[s % capacity] for s in range(max(seq + 1, self._first), self.next_seq)]
+
+
+class HistoryStore:
+
+    """
+        History Store: the RoomHistory of every room a message was sent
+    to, forgetting the least recently used room once more than max_rooms
+    have one, so the memory it takes is bounded by
+    max_rooms * max_bytes.
+    """
+
+    def __init__(self, capacity=HISTORY_MESSAGES, max_bytes=HISTORY_BYTES, max_rooms=HISTORY_ROOMS):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()
+
+    def get(self, room):
+        return self.rooms.get(room)
+
+    def history_of(self, room):
+        """The history of room, a new one if it has none"""
+
+        history = self.rooms.get(room)
+        if history is None:
+            history = self.rooms[room] = RoomHistory(self.capacity, self.max_bytes)
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        return history
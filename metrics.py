@@ -0,0 +1,227 @@
+import bisect
+import cProfile
+import io
+import pstats
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+# upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0)
+# upper bounds of the buckets of the queue depth histogram, in bytes
+QUEUE_BUCKETS = (0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+
+    """
+        Histogram: counts of observed values per bucket, with the
+    cumulative buckets, sum and count of a Prometheus histogram.
+
+        observe is a bisect and two additions, cheap enough for every
+    iteration of the event loop.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)      # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, 0 without observations"""
+
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name, help_text):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {seen}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum:.9g}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+
+    """
+        Metrics: the counters and histograms a ChatServer keeps about
+    itself. They are plain attributes updated by the event loop thread,
+    at most a few times per read, write or broadcast, so they are always
+    on. Values that can be derived from the state of the server (clients,
+    queue depths...) are only computed when the metrics are read, see
+    ChatServer.metrics_text.
+    """
+
+    COUNTERS = (
+        ('accepts', "Connections accepted"),
+        ('disconnects', "Clients disconnected"),
+        ('messages_in', "Frames received from the clients"),
+        ('messages_out', "Messages queued for the clients"),
+        ('bytes_in', "Bytes received from the clients"),
+        ('bytes_out', "Bytes written to the clients and to the worker bus"),
+        ('throttled', "Frames dropped by the rate limits"),
+        ('timeouts', "Connections dropped for not logging in or not answering a ping in time"),
+    )
+
+    def __init__(self):
+        self.accepts = 0
+        self.disconnects = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0                   # of the disconnected clients, the others count in their decoder
+        self.bytes_out = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.loop_time = Histogram()        # seconds an iteration of the event loop works, waiting excluded
+        self.fan_out_time = Histogram()     # seconds to number, record and queue a room message for its room
+
+
+def render_counter(name, help_text, value, kind='counter'):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+class Profiler:
+
+    """
+        Profiler: cProfile hook that can be switched on and off while
+    the server runs.
+
+        cProfile only profiles the thread that enables it, so start and
+    stop only ask for it: the event loop calls apply once per iteration,
+    which is a single attribute test while nothing was asked. stop waits
+    until the loop has stopped the profiler and returns the report.
+    """
+
+    def __init__(self):
+        self.requested = None       # True / False when the loop must start / stop profiling
+        self.profile = None
+        self.report = ''
+        self._sort = 'cumulative'
+        self._lines = 40
+        self._stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        self.requested = True
+
+    def stop(self, timeout=2.0, sort='cumulative', lines=40):
+        """Asks the loop to stop profiling, returns the report (None on timeout)"""
+
+        self._sort = sort
+        self._lines = lines
+        self._stopped.clear()
+        self.requested = False
+        if not self._stopped.wait(timeout):
+            return None
+        return self.report
+
+    def apply(self):
+        """Starts or stops profiling as requested, on the thread to profile"""
+
+        requested, self.requested = self.requested, None
+        if requested and self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif requested is False:
+            if self.profile is not None:
+                self.profile.disable()
+                out = io.StringIO()
+                pstats.Stats(self.profile, stream=out).sort_stats(self._sort).print_stats(self._lines)
+                self.report = out.getvalue()
+                self.profile = None
+            else:
+                self.report = "not profiling\n"
+            self._stopped.set()
+
+
+class MetricsEndpoint:
+
+    """
+        Metrics Endpoint: a small HTTP server on its own thread for a
+    ChatServer:
+
+            GET /metrics          -- the metrics, Prometheus text format
+            GET /profile/start    -- starts profiling the event loop
+            GET /profile/stop     -- stops it and returns the report
+                                     (?sort=tottime for another order)
+
+        It is meant for localhost: anyone who can reach it can profile
+    the server.
+    """
+
+    def __init__(self, server, host, port):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                endpoint._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = server
+        self.http = HTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.http.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.http.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.http.shutdown()
+            self.thread = None
+        self.http.server_close()
+
+    def _handle(self, request):
+        path, _, query = request.path.partition('?')
+        status = 200
+        if path == '/metrics':
+            body = self.server.metrics_text()
+        elif path == '/profile/start':
+            self.server.profiler.start()
+            body = "profiling\n"
+        elif path == '/profile/stop':
+            sort = query[5:] if query.startswith('sort=') else 'cumulative'
+            if sort not in pstats.Stats.sort_arg_dict_default:
+                status, body = 400, f"unknown sort order {sort!r}\n"
+            else:
+                body = self.server.profiler.stop(sort=sort)
+                if body is None:
+                    status, body = 503, "the event loop did not answer\n"
+        else:
+            status, body = 404, "not found\n"
+
+        data = body.encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,271 @@
+import struct
+import zlib
+
+
+HEADER_LENGTH = 10
+
+# Protocol v2: negotiated by starting the connection with V2_MAGIC + version + flags instead of a
+# v1 header (which always starts with an ASCII digit). Every v2 frame is a 4 byte big endian length
+# and a type byte followed by length bytes of payload. Users are referred to by numeric ids
+# assigned by the server at login, id 0 is the server itself.
+VERSION_1 = 1
+VERSION_2 = 2
+V2_MAGIC = b'\x00CHT'
+HELLO_LENGTH = len(V2_MAGIC) + 2
+V2_HEADER = struct.Struct('!IB')
+USER_ID = struct.Struct('!I')
+SERVER_ID = 0
+
+MSG_LOGIN = 1           # c->s  username
+MSG_WELCOME = 2         # s->c  id of the client + accepted flags (1 byte)
+MSG_MESSAGE = 3         # c->s  text / s->c  sender id + text
+MSG_USER = 4            # s->c  id + username of a connected user
+MSG_USER_LEFT = 5       # s->c  id of a user that left
+MSG_JOIN = 6            # c->s  room to move to / s->c  room the client is now in
+MSG_LEAVE = 7           # c->s  go back to DEFAULT_ROOM
+MSG_DIRECT = 8          # c->s  username NUL text / s->c  sender id + text
+MSG_ROOM_MESSAGE = 9    # s->c  sequence number (SEQ) + sender id + text of a message of the client's room
+MSG_HISTORY = 10        # c->s  HISTORY_TOKEN, replay the room since then / s->c  HISTORY_TOKEN after a replay
+MSG_PING = 11           # c->s / s->c  any payload, the other side answers with a MSG_PONG carrying it
+MSG_PONG = 12           # c->s / s->c  the payload of the MSG_PING it answers
+
+# Room history. The server numbers the messages of every room and keeps the last ones, a room joined
+# with MSG_JOIN or MSG_LOGIN is replayed to the client. A client that remembers the HISTORY_TOKEN
+# (epoch of the room history, last sequence number seen) can append NUL + token to the room name of
+# MSG_JOIN or to the username of MSG_LOGIN, or send it in a MSG_HISTORY, to only get what it missed.
+# The epoch changes whenever the server starts a new history, a stale token gets the usual replay.
+SEQ = struct.Struct('!I')
+HISTORY_TOKEN = struct.Struct('!II')
+
+# Heartbeats. The server pings a v2 client that has been silent for a while and drops it if nothing
+# arrives before the ping times out, so half-open connections don't stay around forever. A client can
+# ping the server the same way. v1 has no room for them: v1 clients can only be dropped when idle.
+
+# Every client is in exactly one room, messages only reach the members of the sender's room.
+# v1 clients change rooms and send direct messages with the /join, /leave and /msg commands.
+DEFAULT_ROOM = b'lobby'
+ROOM_NAME_MAX = 32
+
+# Hello flags. With FLAG_COMPRESS accepted (echoed in the welcome) everything after the welcome
+# is a raw deflate stream in each direction, primed with COMPRESSION_DICT and flushed with
+# Z_SYNC_FLUSH after every block of frames.
+FLAG_COMPRESS = 0x01
+WELCOME_SIZE = V2_HEADER.size + USER_ID.size + 1
+COMPRESSION_LEVEL = 6
+INFLATE_LIMIT = 4 * 1024 * 1024     # bytes a single read may decompress to, for decoders with a max_length
+COMPRESSION_DICT = (b'thanks hello what when where there the and you for that this with have are not '
+                    b'lol yes no ok :) ' + b'\x00' * 8 +
+                    b' has disconnected! has entered the room!SERVER')
+
+
+class ProtocolError(Exception):
+
+    def __init__(self, reason=None):
+        self.reason = reason
+
+    def __str__(self):
+        return "Malformed frame: {}".format(self.reason)
+
+
+class ConnectionClosed(Exception):
+
+    def __str__(self):
+        return "Connection closed by the peer"
+
+
+def encode_frame(data: bytes):
+    return f"{len(data):<{HEADER_LENGTH}}".encode('utf-8') + data
+
+
+def encode_hello(flags=0):
+    return V2_MAGIC + bytes((VERSION_2, flags))
+
+
+def encode_frame_v2(kind, payload=b''):
+    return V2_HEADER.pack(len(payload), kind) + payload
+
+
+def split_token(data: bytes):
+    """Splits name NUL HISTORY_TOKEN into (name, (epoch, seq)), the token is None if there is none"""
+
+    name, sep, token = data.partition(b'\0')
+    if sep and len(token) == HISTORY_TOKEN.size:
+        return name, HISTORY_TOKEN.unpack(token)
+    return name, None
+
+
+def valid_room(name: bytes):
+    """Room names are 1 to ROOM_NAME_MAX bytes of UTF-8 without spaces or control characters"""
+
+    if not 0 < len(name) <= ROOM_NAME_MAX:
+        return False
+    try:
+        text = name.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return text.isprintable() and not any(c.isspace() for c in text)
+
+
+def make_compressor():
+    return zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=COMPRESSION_DICT)
+
+
+def make_decompressor():
+    return zlib.decompressobj(-15, zdict=COMPRESSION_DICT)
+
+
+def compress_block(compressor, data):
+    """Compresses data as one block the peer can decompress as soon as it arrives"""
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def detect_version(data):
+    """
+        Tells the protocol of a connection from its first bytes:
+    VERSION_1, VERSION_2 or None if more data is needed to decide.
+    Raises ProtocolError for an unsupported v2 hello.
+    """
+
+    if not data:
+        return None
+    if data[:1] != V2_MAGIC[:1]:
+        return VERSION_1                # malformed v1 headers are left to the v1 decoder
+    if len(data) < HELLO_LENGTH:
+        return None
+    if data[:len(V2_MAGIC)] != V2_MAGIC or data[len(V2_MAGIC)] != VERSION_2:
+        raise ProtocolError(f"unsupported hello {bytes(data[:HELLO_LENGTH])!r}")
+    return VERSION_2
+
+
+class FrameDecoder:
+
+    """
+        Frame Decoder: incremental decoder for the length prefixed
+    frames of the chat protocol.
+
+        Every frame is a HEADER_LENGTH bytes, space padded, ASCII
+    length followed by that many bytes of data. TCP may split a frame
+    over several reads or put many frames in a single one, so the
+    decoder keeps the incomplete tail of the stream between calls and
+    returns every complete frame it has seen.
+
+            decoder = FrameDecoder()
+            frames = decoder.feed(b'5         hello3   ')   -> [b'hello']
+            frames = decoder.feed(b'      abc')             -> [b'abc']
+
+        read_from(sock) reads straight into a preallocated buffer with
+    recv_into and decodes in place, so a single call may return many
+    frames. Data that ends on a frame boundary is never copied into
+    the internal buffer. If decompressor is set, what read_from reads
+    goes through it before being decoded. received counts the bytes it
+    has read.
+
+        Decoders that are only read from one thread can share the read
+    buffer, passed as chunk (a memoryview of a bytearray), instead of
+    allocating bufsize bytes each: nothing is kept in it between two
+    calls.
+
+        With max_length, a frame longer than that raises ProtocolError
+    as soon as its header is seen, so at most max_length bytes of an
+    incomplete frame are ever buffered, and a single read may not
+    decompress to more than INFLATE_LIMIT bytes.
+    """
+
+    def __init__(self, bufsize=65536, chunk=None, max_length=None):
+        self.max_length = max_length
+        self.decompressor = None
+        self.received = 0
+        self._buffer = bytearray()
+        self._view = memoryview(bytearray(bufsize)) if chunk is None else chunk
+
+    @property
+    def buffered(self):
+        """Number of bytes of incomplete frames waiting for more data"""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Adds data to the stream, returns a list with the complete frames (bytes)"""
+
+        if self._buffer:
+            self._buffer += data
+            data = self._buffer
+
+        frames = []
+        with memoryview(data) as view:
+            end = self._split(view, frames, self.max_length)
+
+        if data is self._buffer:
+            del self._buffer[:end]
+        elif end < len(data):
+            self._buffer += data[end:]
+        return frames
+
+    def read_from(self, sock):
+        """
+            Does a single recv_into on sock and returns the complete
+        frames. Raises ConnectionClosed when the peer has closed the
+        connection and lets BlockingIOError through for non-blocking
+        sockets.
+        """
+
+        n = sock.recv_into(self._view)
+        if not n:
+            raise ConnectionClosed()
+        self.received += n
+        if self.decompressor is not None:
+            limit = INFLATE_LIMIT if self.max_length is not None else 0
+            try:
+                data = self.decompressor.decompress(self._view[:n], limit)
+            except zlib.error as e:
+                raise ProtocolError(f"corrupt compressed stream ({e})")
+            if self.decompressor.unconsumed_tail:
+                raise ProtocolError(f"{n} compressed bytes expand to more than {limit} bytes")
+            return self.feed(data)
+        return self.feed(self._view[:n])
+
+    @staticmethod
+    def _split(view, frames, max_length=None):
+        start = 0
+        size = len(view)
+        while size - start >= HEADER_LENGTH:
+            header = bytes(view[start:start + HEADER_LENGTH])
+            try:
+                length = int(header)
+            except ValueError:
+                raise ProtocolError(f"invalid header {header!r}")
+            if length < 0:
+                raise ProtocolError(f"negative length {length}")
+            if max_length is not None and length > max_length:
+                raise ProtocolError(f"frame of {length} bytes, the limit is {max_length}")
+
+            body_end = start + HEADER_LENGTH + length
+            if body_end > size:
+                break
+            frames.append(bytes(view[start + HEADER_LENGTH:body_end]))
+            start = body_end
+        return start
+
+
+class FrameDecoderV2(FrameDecoder):
+
+    """
+        Frame Decoder for protocol v2, same interface as FrameDecoder
+    but every frame is returned as a (type, payload) tuple.
+    """
+
+    @staticmethod
+    def _split(view, frames, max_length=None):
+        start = 0
+        size = len(view)
+        header_size = V2_HEADER.size
+        unpack_from = V2_HEADER.unpack_from
+        while size - start >= header_size:
+            length, kind = unpack_from(view, start)
+            if max_length is not None and length > max_length:
+                raise ProtocolError(f"frame of {length} bytes, the limit is {max_length}")
+            body_end = start + header_size + length
+            if body_end > size:
+                break
+            frames.append((kind, bytes(view[start + header_size:body_end])))
+            start = body_end
+        return start
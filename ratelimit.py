@@ -0,0 +1,48 @@
+RATE = 50.0             # frames per second a connection may send in the long run
+BURST = 100             # frames a connection may send at once after being quiet
+USER_RATE = 100.0       # frames per second all the connections of a username may send together
+USER_BURST = 200
+
+
+class TokenBucket:
+
+    """
+        Token Bucket: allows burst events at once and rate events per
+    second in the long run.
+
+        The bucket holds up to burst tokens and refills at rate tokens
+    per second, lazily: take works out the refill since the last call
+    from the time it is given, so there is no timer and an idle bucket
+    costs nothing.
+
+            bucket = TokenBucket(rate=2, burst=3, now=0.0)
+            bucket.take(0.0, 5)     -> 3        the burst
+            bucket.take(0.5, 5)     -> 1        refilled by 0.5 * 2
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now, count=1):
+        """Takes up to count tokens, returns how many it got"""
+
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.stamp = now
+        granted = min(count, int(tokens))
+        self.tokens = tokens - granted
+        return granted
+
+    def give_back(self, count):
+        """Returns tokens taken for events that didn't happen after all"""
+        self.tokens = min(self.burst, self.tokens + count)
+
+    def refill_time(self, now):
+        """Seconds until the bucket is full again"""
+        return max(0.0, (self.burst - self.tokens - (now - self.stamp) * self.rate) / self.rate)
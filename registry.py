@@ -0,0 +1,182 @@
+from protocol import encode_frame, VERSION_1, USER_ID, DEFAULT_ROOM
+
+
+class Session:
+
+    """
+        Session: the state the server keeps for one connection.
+
+        Slots instead of a dict keep the per-connection overhead small
+    when tens of thousands of clients are connected.
+
+        Frames are queued in pending, which is the outbox itself unless
+    the client compresses (see ChatServer._start_compression). The
+    outbox is a list, not a deque: an empty deque costs more than ten
+    times as much and the sent buffers are removed in one slice anyway.
+
+        last_seen is when the client last sent something, timer its
+    heartbeat timer and pinged when it was last pinged (0 if it
+    answered), see ChatServer._check_alive.
+    """
+
+    __slots__ = ('socket', 'fd', 'address', 'username', 'prefix', 'id', 'id_bytes', 'version', 'decoder',
+                 'room', 'outbox', 'pending', 'compressor', 'queued', 'shed', 'bucket', 'throttled', 'writing',
+                 'dead', 'last_seen', 'timer', 'pinged')
+
+    handshake = False
+
+    def __init__(self, sock, username, decoder, version=VERSION_1, user_id=0, address=None):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.username = username
+        self.prefix = encode_frame(username)
+        self.id = user_id
+        self.id_bytes = USER_ID.pack(user_id)
+        self.version = version
+        self.decoder = decoder
+        self.room = DEFAULT_ROOM
+        self.outbox = []
+        self.pending = self.outbox
+        self.compressor = None
+        self.queued = 0
+        self.shed = 0
+        self.bucket = None
+        self.throttled = 0
+        self.writing = False
+        self.dead = False
+        self.last_seen = 0.0
+        self.timer = None
+        self.pinged = 0.0
+
+
+class Handshake:
+
+    """
+        Handshake: a connection that hasn't logged in yet.
+
+        The server reads the login as it arrives instead of waiting for
+    it: data holds the first bytes until the protocol version can be
+    told, then the decoder of that version takes over. timer is the
+    deadline of the login.
+    """
+
+    __slots__ = ('socket', 'fd', 'address', 'data', 'version', 'flags', 'decoder', 'timer', 'dead')
+
+    handshake = True
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.data = b''
+        self.version = None
+        self.flags = 0
+        self.decoder = None
+        self.timer = None
+        self.dead = False
+
+
+class ClientRegistry:
+
+    """
+        Client Registry: the sessions of the connected clients, indexed
+    by socket fd, by user id and by username.
+
+        Several clients may log in with the same username, so
+    by_username maps a username to the list of its sessions. Adding a
+    session and every lookup are O(1), removing one only scans the few
+    sessions that share its username. Iterating the registry yields the
+    sessions in login order.
+    """
+
+    def __init__(self):
+        self.by_fd = {}
+        self.by_id = {}
+        self.by_username = {}
+
+    def __len__(self):
+        return len(self.by_fd)
+
+    def __iter__(self):
+        return iter(self.by_fd.values())
+
+    def __contains__(self, fd):
+        return fd in self.by_fd
+
+    def add(self, session):
+        self.by_fd[session.fd] = session
+        self.by_id[session.id] = session
+        self.by_username.setdefault(session.username, []).append(session)
+
+    def remove(self, session):
+        """Removes session, returns False if it wasn't registered"""
+
+        if self.by_fd.pop(session.fd, None) is None:
+            return False
+        del self.by_id[session.id]
+        namesakes = self.by_username[session.username]
+        namesakes.remove(session)
+        if not namesakes:
+            del self.by_username[session.username]
+        return True
+
+    def get(self, fd, default=None):
+        return self.by_fd.get(fd, default)
+
+    def sessions_of(self, username):
+        """Sessions logged in as username (bytes), oldest first"""
+        return list(self.by_username.get(username, ()))
+
+    def clear(self):
+        self.by_fd.clear()
+        self.by_id.clear()
+        self.by_username.clear()
+
+
+class RowIndex:
+
+    """
+        Row Index: stable handles (user ids, ...) for the rows of a list
+    widget, so a row is found without scanning the widget.
+
+        remove(handle) moves the last row into the place of the removed
+    one instead of shifting every row below it, and returns
+    (row, moved) so the widget can do the same: moved is the handle of
+    the row that now sits at row, or None if the removed row was the
+    last one.
+
+            rows = RowIndex()
+            rows.add(7)     -> 0
+            rows.add(9)     -> 1
+            rows.add(4)     -> 2
+            rows.remove(7)  -> (0, 4)       rows are now 4, 9
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.handles = []
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, handle):
+        return handle in self.rows
+
+    def add(self, handle):
+        row = self.rows[handle] = len(self.handles)
+        self.handles.append(handle)
+        return row
+
+    def remove(self, handle):
+        row = self.rows.pop(handle)
+        last = self.handles.pop()
+        if row == len(self.handles):
+            return row, None
+        self.handles[row] = last
+        self.rows[last] = row
+        return row, last
+
+    def clear(self):
+        self.rows.clear()
+        self.handles.clear()
@@ -1,20 +1,20 @@
-import socket
-import select
+import argparse
+import logging
+import queue
 import threading
+import time
 from tkinter import *
 import tkinter.messagebox as mb
 from xtra_widgets import *
-
-
-HEADER_LENGTH = 10
-IP = "127.0.0.1"
-PORT = 5000
-SERVER_USRNAME = "SERVER"
-SERVER_HEADER = f"{len(SERVER_USRNAME):<{HEADER_LENGTH}}"
-server_socket = None
-sockets_list = None
-clients = None
-client_username_list = []
+from server_core import (ChatServer, IP, PORT, SERVER_USRNAME, HIGH_WATER, REPLAY, MAX_MESSAGE, HANDSHAKE_TIMEOUT,
+                         PING_INTERVAL, PING_TIMEOUT)
+from ratelimit import RATE, BURST, USER_RATE, USER_BURST
+from history import HISTORY_MESSAGES, HISTORY_BYTES
+from protocol import DEFAULT_ROOM
+from cluster import WorkerPool
+from registry import RowIndex
+from chatlog import ChatLog
+from federation import Federation, node_options
 
 
 class ChatServerApp(Tk):
@@ -30,6 +30,7 @@ class ChatServerApp(Tk):
         container.grid_columnconfigure(0, weight=1)
 
         self.frames = {}
+        self.server = None
 
         for F in (CreationPage, ManagerFrame):
             frame = F(container, self)
@@ -49,7 +50,7 @@ class ChatServerApp(Tk):
 
 class CreationPage(Frame):
 
-    geometry = "205x80"
+    geometry = "260x200"
 
     def __init__(self, parent, controller):
         Frame.__init__(self, parent)
@@ -61,51 +62,81 @@ class CreationPage(Frame):
         self.port_var = StringVar()
         self.port_entry = Entry(self, textvariable=self.port_var)
         self.port_var.set("5000")
+        self.compression_var = BooleanVar(value=False)
+        self.compression_check = Checkbutton(self, text="Allow compression", variable=self.compression_var)
+        self.node_var = StringVar()
+        self.node_entry = Entry(self, textvariable=self.node_var)
+        self.federation_port_var = StringVar()
+        self.federation_port_entry = Entry(self, textvariable=self.federation_port_var)
+        self.peers_var = StringVar()
+        self.peers_entry = Entry(self, textvariable=self.peers_var)
         self.start_button = Button(self, text="Start Server!", command=self.start)
 
         Label(self, text="IP: ").grid(row=0, column=0, sticky='w')
         self.ip_entry.grid(row=0, column=1, sticky='ew')
         Label(self, text="Port: ").grid(row=1, column=0, sticky='w')
         self.port_entry.grid(row=1, column=1, sticky='ew')
-        self.start_button.grid(row=3, column=0, columnspan=2, sticky='ew')
+        self.compression_check.grid(row=2, column=0, columnspan=2, sticky='w')
+        Label(self, text="Node id: ").grid(row=3, column=0, sticky='w')
+        self.node_entry.grid(row=3, column=1, sticky='ew')
+        Label(self, text="Peer port: ").grid(row=4, column=0, sticky='w')
+        self.federation_port_entry.grid(row=4, column=1, sticky='ew')
+        Label(self, text="Peers: ").grid(row=5, column=0, sticky='w')
+        self.peers_entry.grid(row=5, column=1, sticky='ew')
+        self.start_button.grid(row=6, column=0, columnspan=2, sticky='ew')
 
     def start(self):
-        global server_socket, sockets_list, clients, IP, PORT
-
         try:
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            IP = self.ip_var.get()
-            PORT = int(self.port_var.get())
-            server_socket.bind((IP, PORT))
-            server_socket.listen()
-
-            sockets_list = [server_socket]
-
-            clients = {}
+            port = self.federation_port_var.get().strip()
+            peers = self.peers_var.get().replace(',', ' ').split()
+            federated = bool(port or peers)
+            options = node_options(int(self.node_var.get())) if federated else {}
+            # no worker pool here: its processes are forked, and forking the Tk process isn't safe
+            server = ChatServer(self.ip_var.get(), int(self.port_var.get()),
+                                compression=self.compression_var.get(), **options)
+            if federated:
+                start_federation(server, int(self.node_var.get()), self.ip_var.get(), int(port) if port else None,
+                                 peers)
+            else:
+                server.bind()
         except Exception as e:
             mb.showerror("Server not created", f"Error while creating server:\n{str(e)}")
         else:
+            self.controller.server = server
             self.controller.show_frame(ManagerFrame)
             mb.showinfo("Server Created", "The server was created successfully!")
 
 
 class ManagerFrame(Frame):
 
-    geometry = "650x660"
+    geometry = "650x760"
+    poll_interval = 50          # ms between two updates of the widgets
+    stats_interval = 1000       # ms between two updates of the statistics
+    max_batch = 10000           # events applied per update, the rest waits for the next one
 
     def on_enter(self):
+        server = self.controller.server
+        self.ip_var.set(server.host)
+        self.port_var.set(server.port)
+        server.add_listener(self.on_server_event)
+        self.server_runner_thread = threading.Thread(target=server.serve_forever, daemon=True)
         self.server_runner_thread.start()
+        self.after(self.poll_interval, self._apply_events)
+        if hasattr(server, 'stats'):
+            self.last_stats = (server.stats(), time.monotonic())
+            self.profile_check.config(state=NORMAL)
+            self.after(self.stats_interval, self._update_stats)
 
     def __init__(self, parent, controller):
         Frame.__init__(self, parent)
+        self.controller = controller
 
-        self.server_runner_thread = threading.Thread(target=self.run_server, daemon=True)
+        self.server_runner_thread = None
 
-        self.evnt_box = ScrollBox(self, width=50, height=35)
+        self.evnt_box = ScrollBox(self, width=50, height=35, max_lines=100000, virtual=True)
         self.info_frame = LabelFrame(self, text="Server Info")
-        self.clients_box = ScrollBox(self.info_frame, height=30)
+        self.clients_box = ScrollBox(self.info_frame, height=20)
+        self.rooms_box = ScrollBox(self.info_frame, height=8)
 
         self.evnt_box.grid(row=0, column=0, sticky='nsew')
         self.info_frame.grid(row=0, column=1, sticky='nsew')
@@ -115,81 +146,281 @@ class ManagerFrame(Frame):
         Label(self.info_frame, textvariable=self.connected_clients_var, font=("Arial", 11, "italic")).grid(row=0, column=1,
                                                                                                            sticky='e')
         self.clients_box.grid(row=1, column=0, columnspan=2, sticky='nsew')
+        self.ip_var = StringVar()
+        self.port_var = StringVar()
         Label(self.info_frame, text="IP: ", font=("Arial", 11, "bold")).grid(row=2, column=0, sticky='w')
-        Label(self.info_frame, text=IP, font=("Arial", 11, "italic")).grid(row=2, column=1, sticky='e')
+        Label(self.info_frame, textvariable=self.ip_var, font=("Arial", 11, "italic")).grid(row=2, column=1, sticky='e')
         Label(self.info_frame, text="Port: ", font=("Arial", 11, "bold")).grid(row=3, column=0, sticky='w')
-        Label(self.info_frame, text=PORT, font=("Arial", 11, "italic")).grid(row=3, column=1, sticky='e')
-
-    def run_server(self):
-        global server_socket, sockets_list, clients, client_username_list
-        while True:
-            read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
-
-            for notified_socket in read_sockets:
-                if notified_socket == server_socket:
-                    client_socket, client_address = server_socket.accept()
-                    user = self._receive_message(client_socket)
-                    if user is False:
-                        continue
-                    sockets_list.append(client_socket)
-
-                    clients[client_socket] = user
-
-                    nusrn = user['data'].decode('utf-8')
-                    client_username_list.append(nusrn)
-                    self.clients_box.insert(END, nusrn)
-                    self.evnt_box.insert(END, f"Accepted new connection from {client_address[0]}:{client_address[1]} "
-                                              f"username:{nusrn}")
-                    msg = f"{user['data'].decode('utf-8')} has entered the room!"''
-                    self.evnt_box.insert(END, f"<{SERVER_USRNAME}> {msg}")
-                    self.connected_clients_var.set(int(self.connected_clients_var.get()) + 1)
-                    for client_socket in clients:
-                        if client_socket != notified_socket:
-                            client_socket.send(
-                                (SERVER_HEADER + SERVER_USRNAME + f'{len(msg) + 1:<{HEADER_LENGTH}}' + f'{msg}').encode(
-                                    'utf-8'))
-
-                else:
-                    message = self._receive_message(notified_socket)
-                    if message is False:
-                        usr = clients[notified_socket]['data'].decode('utf-8')
-                        self.evnt_box.insert(END, f"<{SERVER_USRNAME}> {usr} has disconnected!")
-                        self.connected_clients_var.set(int(self.connected_clients_var.get()) - 1)
-                        self.clients_box.list_box.delete(client_username_list.index(usr))
-                        client_username_list.remove(usr)
-                        for client_socket in clients:
-                            if client_socket != notified_socket:
-                                msg = f'{usr} has disconnected!'
-                                client_socket.send((SERVER_HEADER + SERVER_USRNAME + f'{len(msg) + 1:<{HEADER_LENGTH}}'
-                                                    + f'{msg}').encode('utf-8'))
-                        sockets_list.remove(notified_socket)
-                        del clients[notified_socket]
-                        continue
-                    user = clients[notified_socket]
-                    self.evnt_box.insert(END, f"<{user['data'].decode('utf-8')}>: {message['data'].decode('utf-8')}")
-
-                    for client_socket in clients:
-                        if client_socket != notified_socket:
-                            client_socket.send(user['header'] + user['data'] + message['header'] + message['data'])
-
-                for notified_socket in exception_sockets:
-                    sockets_list.remove(notified_socket)
-                    del clients[notified_socket]
-
-    @staticmethod
-    def _receive_message(client_socket):
+        Label(self.info_frame, textvariable=self.port_var, font=("Arial", 11, "italic")).grid(row=3, column=1, sticky='e')
+        Label(self.info_frame, text="Rooms: ", font=("Arial", 11, "bold")).grid(row=4, column=0, sticky='w')
+        self.rooms_box.grid(row=5, column=0, columnspan=2, sticky='nsew')
+        Label(self.info_frame, text="Statistics: ", font=("Arial", 11, "bold")).grid(row=6, column=0, sticky='w')
+        self.stats_var = StringVar()
+        self.stats_var.set("(not available with several workers)")
+        Label(self.info_frame, textvariable=self.stats_var, justify=LEFT, font=("Courier", 9)).grid(row=7, column=0,
+                                                                                                  columnspan=2,
+                                                                                                  sticky='w')
+        self.profile_var = BooleanVar(value=False)
+        self.profile_check = Checkbutton(self.info_frame, text="Profile the event loop", variable=self.profile_var,
+                                         command=self._toggle_profile, state=DISABLED)
+        self.profile_check.grid(row=8, column=0, columnspan=2, sticky='w')
+        self.last_stats = None
+        self.profile_stopping = False
+
+        self.client_rows = RowIndex()      # user id -> row of clients_box
+        self.client_rooms = {}              # user id -> room
+        self.room_members = {}              # room -> number of members
+        self.rooms_changed = False
+        self.events = queue.SimpleQueue()
+
+    def on_server_event(self, event, *args):
+        """Server listener, runs on the server thread so it only queues the event for the Tk thread"""
+
+        self.events.put((event, args))
+
+    def _apply_events(self):
+        """Applies the queued server events in batches, one insert per widget"""
+
+        lines = []
+        new_clients = []
         try:
-            message_header = client_socket.recv(HEADER_LENGTH)
-
-            if not len(message_header):
-                return False
-
-            message_length = int(message_header.decode('utf-8').strip())
-            return {"header": message_header, "data": client_socket.recv(message_length)}
-        except:
-            return False
+            for _ in range(self.max_batch):
+                event, args = self.events.get_nowait()
+                if event == 'connect':
+                    username, client_address, user_id = args
+                    new_clients.append((user_id, username))
+                    self._move_client(user_id, DEFAULT_ROOM.decode('utf-8'))
+                    lines.append(f"Accepted new connection from {client_address[0]}:{client_address[1]} "
+                                 f"username:{username}")
+                    lines.append(f"<{SERVER_USRNAME}> {username} has entered the room!")
+                elif event == 'message':
+                    lines.append("#{2} <{0}>: {1}".format(*args))
+                elif event == 'room':
+                    username, user_id, room = args
+                    self._move_client(user_id, room)
+                    lines.append(f"<{SERVER_USRNAME}> {username} has joined #{room}")
+                elif event == 'disconnect':
+                    username, user_id = args
+                    lines.append(f"<{SERVER_USRNAME}> {username} has disconnected!")
+                    self._add_clients(new_clients)
+                    new_clients = []
+                    self._remove_client(user_id)
+                    self._move_client(user_id, None)
+        except queue.Empty:
+            pass
+
+        self._add_clients(new_clients)
+        if lines:
+            self.evnt_box.insert(END, *lines)
+        self.connected_clients_var.set(len(self.client_rows))
+        if self.rooms_changed:
+            self.rooms_changed = False
+            self.rooms_box.list_box.delete(0, END)
+            self.rooms_box.insert(END, *(f"#{room} ({count})" for room, count in sorted(self.room_members.items())))
+        self.after(self.poll_interval, self._apply_events)
+
+    def _update_stats(self):
+        """Shows the rates since the last update and the latencies of the server's metrics"""
+
+        server = self.controller.server
+        stats, now = server.stats(), time.monotonic()
+        last, then = self.last_stats
+        self.last_stats = (stats, now)
+        elapsed = max(now - then, 1e-6)
+
+        def rate(name):
+            return (stats[name] - last[name]) / elapsed
+
+        metrics = server.metrics
+        self.stats_var.set(f"in   {rate('messages_in'):8.0f} msg/s {rate('bytes_in') / 1024:8.1f} KiB/s\n"
+                           f"out  {rate('messages_out'):8.0f} msg/s {rate('bytes_out') / 1024:8.1f} KiB/s\n"
+                           f"accepts {rate('accepts'):5.1f}/s    queued {stats['queued'] / 1024:8.1f} KiB\n"
+                           f"loop p99    {metrics.loop_time.quantile(0.99) * 1e3:8.3f} ms\n"
+                           f"fan-out p99 {metrics.fan_out_time.quantile(0.99) * 1e3:8.3f} ms")
+
+        profiler = server.profiler
+        if self.profile_stopping and profiler.requested is None and not profiler.running:
+            self.profile_stopping = False
+            self.evnt_box.insert(END, *profiler.report.splitlines())
+        self.after(self.stats_interval, self._update_stats)
+
+    def _toggle_profile(self):
+        """Starts or stops profiling the event loop, the report goes to the event box once the loop stopped it"""
+
+        profiler = self.controller.server.profiler
+        if self.profile_var.get():
+            profiler.start()
+        else:
+            profiler.stop(timeout=0)
+            self.profile_stopping = True
+
+    def _add_clients(self, clients):
+        if clients:
+            for user_id, _ in clients:
+                self.client_rows.add(user_id)
+            self.clients_box.insert(END, *(username for _, username in clients))
+
+    def _move_client(self, user_id, room):
+        """Moves user_id to room (None when it disconnects) in the member counts"""
+
+        old_room = self.client_rooms.pop(user_id, None)
+        if old_room is not None:
+            self.room_members[old_room] -= 1
+            if not self.room_members[old_room]:
+                del self.room_members[old_room]
+        if room is not None:
+            self.client_rooms[user_id] = room
+            self.room_members[room] = self.room_members.get(room, 0) + 1
+        self.rooms_changed = True
+
+    def _remove_client(self, user_id):
+        """Removes the row of user_id, the last row takes its place so no other row moves"""
+
+        list_box = self.clients_box.list_box
+        row, moved = self.client_rows.remove(user_id)
+        if moved is not None:
+            last = list_box.get(END)
+            list_box.delete(END)
+            list_box.delete(row)
+            list_box.insert(row, last)
+        else:
+            list_box.delete(row)
+
+
+def create_server(host, port, workers=1, **server_options):
+    """Returns a ChatServer, or a WorkerPool of them if more than one worker is asked for"""
+
+    if workers > 1:
+        return WorkerPool(host, port, workers, **server_options)
+    return ChatServer(host, port, **server_options)
+
+
+def start_federation(server, node_id, host, port, peers):
+    """Binds server as a node of a federation, listening for peers on host:port (if not None)"""
+
+    # the federation port first: the workers of a pool serve as soon as it is bound
+    federation = Federation(node_id, host, port, peers)
+    federation.bind()
+    try:
+        server.bind()
+    except OSError:
+        if federation.server_socket is not None:
+            federation.server_socket.close()
+        raise
+    try:
+        federation.attach(server)
+        federation.start()
+    except Exception:
+        server._close()
+        if federation.server_socket is not None:
+            federation.server_socket.close()
+        raise
+    return federation
+
+
+def log_listener(event, *args):
+    if event == 'connect':
+        username, client_address, _ = args
+        logging.info("Accepted new connection from %s:%s username:%s", client_address[0], client_address[1], username)
+    elif event == 'message':
+        logging.info("#%s <%s>: %s", args[2], args[0], args[1])
+    elif event == 'room':
+        logging.info("<%s> %s has joined #%s", SERVER_USRNAME, args[0], args[2])
+    elif event == 'disconnect':
+        logging.info("<%s> %s has disconnected!", SERVER_USRNAME, args[0])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="LAN Chat Server")
+    parser.add_argument("--headless", action="store_true", help="run the server without the Tk interface")
+    parser.add_argument("--host", default=IP)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT (headless only)")
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER,
+                        help="bytes that may be queued for a client before the overflow policy applies")
+    parser.add_argument("--overflow", choices=("drop", "shed"), default="drop",
+                        help="disconnect slow clients (drop) or discard their new messages (shed)")
+    parser.add_argument("--max-message", type=int, default=MAX_MESSAGE,
+                        help="bytes of the longest frame a client may send, longer ones disconnect it")
+    parser.add_argument("--rate", type=float, default=RATE, help="frames/sec a connection may send, 0 disables")
+    parser.add_argument("--burst", type=int, default=BURST, help="frames a connection may send at once")
+    parser.add_argument("--user-rate", type=float, default=USER_RATE,
+                        help="frames/sec all the connections of a username may send, 0 disables")
+    parser.add_argument("--user-burst", type=int, default=USER_BURST,
+                        help="frames all the connections of a username may send at once")
+    parser.add_argument("--flood", choices=("throttle", "drop"), default="throttle",
+                        help="drop the frames over the rate limits (throttle) or disconnect the sender (drop)")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="seconds a new connection has to log in")
+    parser.add_argument("--ping-interval", type=float, default=PING_INTERVAL,
+                        help="seconds of silence before a v2 client is pinged, 0 disables the pings")
+    parser.add_argument("--ping-timeout", type=float, default=PING_TIMEOUT,
+                        help="seconds a pinged client has to answer before it is dropped")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="drop v1 clients silent for this many seconds (they can't be pinged)")
+    parser.add_argument("--history", type=int, default=HISTORY_MESSAGES,
+                        help="messages kept per room for the clients that join it, 0 disables the history")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES, help="bytes of messages kept per room")
+    parser.add_argument("--replay", type=int, default=REPLAY, help="messages of the history sent to a joining client")
+    parser.add_argument("--log", metavar="DIR", default=None,
+                        help="append every room message to a chat log in DIR and restore the histories from it")
+    parser.add_argument("--log-no-fsync", action="store_true",
+                        help="don't fsync the chat log, faster but a crash may lose the last messages")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the metrics and the profiling switch over HTTP on this localhost port "
+                             "(worker i uses port + i)")
+    parser.add_argument("--node-id", type=int, default=None,
+                        help="id of this node in a federation, unique among its nodes (1-255)")
+    parser.add_argument("--federation-port", type=int, default=None,
+                        help="listen for the other nodes of the federation on this port")
+    parser.add_argument("--peer", metavar="HOST:PORT", action="append", default=[],
+                        help="federation port of another node to link to, may be repeated")
+    parser.add_argument("--compression", action="store_true",
+                        help="compress the traffic of the v2 clients that ask for it")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every server event (headless only)")
+    args = parser.parse_args(argv)
+    if (args.federation_port is not None or args.peer) and args.node_id is None:
+        parser.error("a node of a federation needs a --node-id")
+    if args.workers > 1 and not args.headless:
+        parser.error("--workers needs --headless, the worker processes are forked and the Tk process can't be")
+    return args
+
+
+def run_headless(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    log = ChatLog(args.log, sync=not args.log_no_fsync) if args.log else None
+    federated = args.federation_port is not None or bool(args.peer)
+    server = create_server(args.host, args.port, args.workers, high_water=args.high_water, overflow=args.overflow,
+                           compression=args.compression, history=args.history, history_bytes=args.history_bytes,
+                           replay=args.replay, log=log, metrics_port=args.metrics_port,
+                           max_message=args.max_message, rate=args.rate, burst=args.burst, user_rate=args.user_rate,
+                           user_burst=args.user_burst, flood=args.flood, handshake_timeout=args.handshake_timeout,
+                           ping_interval=args.ping_interval, ping_timeout=args.ping_timeout,
+                           idle_timeout=args.idle_timeout,
+                           **(node_options(args.node_id) if federated else {}))
+    if args.verbose:
+        server.add_listener(log_listener)
+    if federated:
+        start_federation(server, args.node_id, args.host, args.federation_port, args.peer)
+        logging.info("Node %s, peers on port %s, linking to %s", args.node_id, args.federation_port,
+                     ", ".join(args.peer) or "nobody")
+    else:
+        server.bind()
+    logging.info("Serving on %s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log is not None:
+            log.close()
 
 
 if __name__ == "__main__":
-    a = ChatServerApp()
-    a.mainloop()
+    args = parse_args()
+    if args.headless:
+        run_headless(args)
+    else:
+        a = ChatServerApp()
+        a.mainloop()
@@ -0,0 +1,987 @@
+import errno
+import logging
+import os
+import socket
+import selectors
+from itertools import islice
+from time import perf_counter, monotonic
+from protocol import (FrameDecoder, FrameDecoderV2, ProtocolError, ConnectionClosed, encode_frame, encode_frame_v2,
+                      detect_version, valid_room, make_compressor, make_decompressor, compress_block, VERSION_1,
+                      VERSION_2, HELLO_LENGTH, V2_HEADER, USER_ID, SERVER_ID, FLAG_COMPRESS, DEFAULT_ROOM, ROOM_NAME_MAX,
+                      MSG_LOGIN, MSG_WELCOME, MSG_MESSAGE, MSG_USER, MSG_USER_LEFT, MSG_JOIN, MSG_LEAVE, MSG_DIRECT,
+                      MSG_ROOM_MESSAGE, MSG_HISTORY, MSG_PING, MSG_PONG, SEQ, HISTORY_TOKEN, split_token)
+from registry import Session, Handshake, ClientRegistry
+from history import HistoryStore, HISTORY_MESSAGES, HISTORY_BYTES
+from ratelimit import TokenBucket, RATE, BURST, USER_RATE, USER_BURST
+from metrics import Metrics, Profiler, MetricsEndpoint, Histogram, QUEUE_BUCKETS, render_counter
+from timers import TimerWheel
+
+
+logger = logging.getLogger(__name__)
+
+
+IP = "127.0.0.1"
+PORT = 5000
+SERVER_USRNAME = "SERVER"
+HIGH_WATER = 1024 * 1024
+REPLAY = 50             # messages of the room history sent to a client that joins it
+RESTORE = 10000         # messages of the chat log read back into the room histories when the server starts
+READ_SIZE = 65536       # bytes read from a socket at once, the buffer is shared by all the connections
+MAX_MESSAGE = 16384     # bytes of the longest frame (message, username...) a client may send
+ACCEPT_BATCH = 64       # connections accepted at most per readable event of the listening socket
+ACCEPT_BACKOFF = 0.5    # seconds the listening socket is left out of the loop when the server runs out of descriptors
+HANDSHAKE_TIMEOUT = 10.0    # seconds a new connection has to log in
+PING_INTERVAL = 30.0    # seconds of silence before a v2 client is pinged
+PING_TIMEOUT = 10.0     # seconds a pinged client has to send something
+
+# Messages on the bus between the workers of a WorkerPool (cluster.py), also relayed between the nodes of a
+# federation (federation.py), one type byte + data.
+# Broadcasts and direct messages carry both encodings: length of the v1 frames (USER_ID) + v1 frames + v2 frame.
+BUS_BROADCAST = b'B'    # room (empty for every client) NUL encodings, for the clients of the other workers
+BUS_DIRECT = b'D'       # username NUL encodings, for the clients of the other workers with that username
+BUS_JOIN = b'J'         # host NUL port NUL id NUL username of a client that logged in to a worker
+BUS_LEAVE = b'L'        # id NUL username of a client that left a worker
+BUS_ROOM = b'R'         # id NUL room a client moved to
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+def write_buffers(sock, buffers):
+    """Writes as many of the queued buffers as the socket takes in a single call, returns the bytes sent"""
+
+    if len(buffers) == 1:
+        return sock.send(buffers[0])
+    if HAS_SENDMSG:
+        return sock.sendmsg(islice(buffers, IOV_MAX))
+    return sock.send(b''.join(islice(buffers, IOV_MAX)))
+
+
+def split_encodings(payload):
+    """Splits a BUS_BROADCAST or BUS_DIRECT payload into (target, (None, v1 frames, v2 frame))"""
+
+    data = memoryview(payload)
+    end = payload.index(b'\0', 1)
+    start = end + 1 + USER_ID.size
+    split = start + USER_ID.unpack_from(data, end + 1)[0]
+    return payload[1:end], (None, data[start:split], data[split:])
+
+
+SERVER_PREFIX = encode_frame(SERVER_USRNAME.encode('utf-8'))
+SERVER_ID_BYTES = USER_ID.pack(SERVER_ID)
+PING_FRAME = encode_frame_v2(MSG_PING)
+
+
+class ChatServer:
+
+    """
+        Chat Server: the connection handling engine of the chat server,
+    independent of any user interface.
+
+        Observers are registered with add_listener and are called as
+    listener(event, *args) for every event of the server:
+
+            ('connect', username, address, user_id)
+            ('message', username, text, room)
+            ('room', username, user_id, room)
+            ('disconnect', username, user_id)
+
+        Listeners run on the thread of serve_forever, so GUI observers
+    must hand the events over to their own thread.
+
+        Sockets are never written to with a blocking call. Outbound
+    frames are encoded once, the same bytes object is queued in the
+    outbox of every recipient, and every outbox that got data during a
+    loop iteration is flushed at its end with a single scatter-gather
+    sendmsg. Whatever a client can't take right away stays in its
+    outbox and is flushed when the socket becomes writable. Once more
+    than high_water bytes are waiting for a client, overflow decides
+    what happens:
+
+            'drop' -- the client is disconnected
+            'shed' -- new messages for that client are discarded
+                      until its outbox drains
+
+        With reuse_port several servers, usually in different processes,
+    can bind the same address and the kernel spreads the connections
+    among them. attach_bus links such a server to the other workers, so
+    its broadcasts reach their clients too (see cluster.WorkerPool), or
+    to the other nodes of a federation (see federation.py). The users of
+    the other end of the bus are known too, and reported to the
+    listeners like the server's own clients. User ids are id_start,
+    id_start + id_step, ... so the workers of a pool or the nodes of a
+    federation never hand out the same id.
+
+        Connected clients are Session objects (see registry.py) kept in
+    the clients ClientRegistry, indexed by fd, id and username. The
+    user id passed to the listeners tells apart clients that share a
+    username.
+
+        Every client is in one room, DEFAULT_ROOM after the login, and
+    its messages are only fanned out to the members of that room, so
+    traffic grows with the size of the rooms instead of the square of
+    the number of clients. rooms maps every non-empty room name to the
+    set of its sessions. Direct messages go to the sessions logged in
+    with the target username.
+
+        The last history messages of every room (at most history_bytes
+    bytes of frames) are kept in a HistoryStore, as the frames that were
+    fanned out. A client joining a room gets the last replay of them,
+    or only those it missed if it sends a history token (see
+    protocol.py), queued at once so they go out in a single write.
+    history=0 disables it.
+
+        With a log (a chatlog.ChatLog), every room message is also
+    appended to it as its v1 frames. append only queues the record for
+    the writer thread of the log, so the loop never waits for the disk.
+    bind reads the last messages of the log back into the room
+    histories, so the clients joining a restarted server still get them.
+
+        Clients may speak protocol v1 or v2 (see protocol.py), the
+    version is detected from the first bytes of the connection. Every
+    broadcast is encoded once per version.
+
+        Everything a client sends goes through its rate limits before
+    any work is done for it: a token bucket of rate frames per second
+    (burst at once) for the connection and one of user_rate (user_burst)
+    shared by all the connections of its username, 0 disables either.
+    The frames the buckets don't allow are dropped and, with
+    flood='throttle', the client is warned the first time; flood='drop'
+    disconnects it. A frame longer than max_message bytes disconnects
+    the client as soon as its header is read. In a pool the username
+    limit applies per worker. The bucket of a username outlives its
+    connections until it has refilled, so reconnecting doesn't reset it.
+
+        With compression, v2 clients that ask for it in their hello get
+    a zlib stream in both directions. The frames queued for such a
+    client during a loop iteration are compressed together as one block
+    when its outbox is flushed, so a burst costs a single sync flush.
+    It is off by default: on a fast link it costs more CPU than it saves.
+
+        Nothing waits for a client either. A readable listening socket
+    is drained of up to ACCEPT_BATCH connections at once, and the login
+    of each one is read as it arrives, by a Handshake state (see
+    registry.py) registered in the loop like a session, with
+    handshake_timeout seconds to complete. When the server runs out of
+    file descriptors, the listening socket, which would stay readable,
+    is left out of the loop for ACCEPT_BACKOFF seconds. After the
+    login, a v2 client silent for ping_interval seconds gets a MSG_PING
+    and is dropped if it is still silent ping_timeout seconds later; a
+    v1 client can't be pinged and is only dropped after idle_timeout
+    seconds of silence, if set (it is off by default, a v1 client that
+    only reads is quiet).
+    These deadlines are timers of a TimerWheel (see timers.py): reads
+    only update the last_seen of the session, a timer that fires early
+    is pushed back by the time the client wasn't silent.
+
+        The server keeps counters and latency histograms in metrics (see
+    metrics.py), cheap enough to be always on, and metrics_text renders
+    them with the gauges of its current state in the Prometheus text
+    format. With metrics_port they are served over HTTP on localhost,
+    along with a switch for profiling the event loop with cProfile (the
+    profiler attribute).
+    """
+
+    def __init__(self, host=IP, port=PORT, high_water=HIGH_WATER, overflow='drop', reuse_port=False,
+                 id_start=1, id_step=1, compression=False, history=HISTORY_MESSAGES, history_bytes=HISTORY_BYTES,
+                 replay=REPLAY, log=None, metrics_port=None, max_message=MAX_MESSAGE, rate=RATE, burst=BURST,
+                 user_rate=USER_RATE, user_burst=USER_BURST, flood='throttle', handshake_timeout=HANDSHAKE_TIMEOUT,
+                 ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, idle_timeout=None):
+        if overflow not in ('drop', 'shed'):
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        if flood not in ('throttle', 'drop'):
+            raise ValueError(f"unknown flood policy {flood!r}")
+
+        self.host = host
+        self.port = port
+        self.high_water = high_water
+        self.overflow = overflow
+        self.reuse_port = reuse_port
+        self.compression = compression
+        self.max_message = max_message
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.flood = flood
+        self.handshake_timeout = handshake_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.idle_timeout = idle_timeout
+        self.user_buckets = {}
+        self.history = HistoryStore(history, history_bytes) if history else None
+        self.replay = replay
+        self.log = log
+        self.metrics_port = metrics_port
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+        self.metrics_endpoint = None
+        self.id_step = id_step
+        self._next_id = id_start
+
+        self.server_socket = None
+        self.selector = None
+        self.bus = None
+        self.bus_session = None
+        self.remote_users = {}
+        self.remote_names = {}
+        self.clients = ClientRegistry()
+        self.handshakes = {}
+        self.rooms = {}
+        self.now = monotonic()
+        self.timers = TimerWheel(now=self.now)
+        self.listeners = []
+        self.running = False
+        self._dead = []
+        self._pending = {}
+        self._read_buffer = memoryview(bytearray(READ_SIZE))
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _emit(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def bind(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.server_socket.setblocking(False)
+        self.clients.clear()
+        if self.log is not None:
+            self.restore_history(self.log)
+
+    def restore_history(self, log, count=RESTORE):
+        """
+            Fills the room histories with the last count messages of log.
+        Their senders' ids didn't survive the restart, so v2 clients get
+        them from the SERVER user, with the username in the text.
+        """
+
+        if self.history is None:
+            return
+        decoder = FrameDecoder(bufsize=0)
+        for _, _, room, data in log.records(since_seq=max(1, log.written_seq - count + 1)):
+            username, message = decoder.feed(data)
+            history = self.history.history_of(room)
+            text = username + b': ' + message
+            history.append((None, data,
+                            V2_HEADER.pack(SEQ.size + USER_ID.size + len(text), MSG_ROOM_MESSAGE)
+                            + SEQ.pack(history.next_seq) + SERVER_ID_BYTES + text))
+
+    def attach_bus(self, bus_socket):
+        """Links the server to the worker bus, must be called before serve_forever"""
+
+        bus_socket.setblocking(False)
+        self.bus = bus_socket
+        self.bus_session = Session(bus_socket, b'', FrameDecoder())
+
+    def new_decoder(self, version=VERSION_1):
+        """A decoder for a client connection, reading into the buffer shared by all of them"""
+
+        if version == VERSION_2:
+            return FrameDecoderV2(chunk=self._read_buffer, max_length=self.max_message)
+        return FrameDecoder(chunk=self._read_buffer, max_length=self.max_message)
+
+    def serve_forever(self):
+        if self.server_socket is None:
+            self.bind()
+
+        # created here, not in bind, so a bound server can be handed to a forked worker
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        if self.bus is not None:
+            self.selector.register(self.bus, selectors.EVENT_READ, self.bus_session)
+        if self.metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(self, IP, self.metrics_port)
+            self.metrics_endpoint.start()
+
+        self.running = True
+        select = self.selector.select
+        profiler = self.profiler
+        loop_time = self.metrics.loop_time
+        timers = self.timers
+        while self.running:
+            events = select(0.5)
+            start = perf_counter()
+            self.now = monotonic()
+            for key, mask in events:
+                session = key.data
+                if session is None:
+                    self._accept()
+                    continue
+                if session.dead:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(session)
+                if mask & selectors.EVENT_READ:
+                    if session.handshake:
+                        self._handle_handshake(session)
+                    elif session is self.bus_session:
+                        self._handle_bus()
+                    else:
+                        self._handle_readable(session)
+            timers.advance(self.now)
+            self._flush_pending()
+            if events:
+                loop_time.observe(perf_counter() - start)
+            if profiler.requested is not None:
+                profiler.apply()
+
+        if profiler.running:
+            profiler.requested = False
+            profiler.apply()
+        self._close()
+
+    def _flush_pending(self):
+        """Flushes the outboxes filled during this iteration, then drops the clients that failed"""
+
+        while self._pending or self._dead:
+            pending, self._pending = self._pending, {}
+            for session in pending.values():
+                if not session.dead:
+                    self._flush(session)
+            while self._dead:
+                self._disconnect(self._dead.pop())
+
+    def shutdown(self):
+        self.running = False
+
+    def _accept(self):
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionAbortedError:
+                continue        # reset by the client before it was accepted
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # the pending connections stay queued and the socket readable, don't spin on it
+                    logger.warning("Not accepting connections for %.1f s: %s", ACCEPT_BACKOFF, e)
+                    self.selector.unregister(self.server_socket)
+                    self.timers.schedule(ACCEPT_BACKOFF, self._resume_accept)
+                else:
+                    logger.warning("Accepting a connection failed: %s", e)
+                return
+            client_socket.setblocking(False)
+            handshake = Handshake(client_socket, client_address)
+            handshake.timer = self.timers.schedule(self.handshake_timeout, self._handshake_expired, handshake)
+            self.handshakes[handshake.fd] = handshake
+            self.selector.register(client_socket, selectors.EVENT_READ, handshake)
+            # the login often comes with the connection, don't wait for another loop iteration
+            self._handle_handshake(handshake)
+
+    def _resume_accept(self):
+        if self.server_socket is not None:
+            self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+    def _handle_handshake(self, handshake):
+        """Reads what arrived of the login of a new connection, logs it in once it is complete"""
+
+        client_socket = handshake.socket
+        try:
+            if handshake.version is None:
+                chunk = client_socket.recv(4096)
+                if not chunk:
+                    raise ConnectionClosed()
+                # what the decoder reads later counts in its received
+                self.metrics.bytes_in += len(chunk)
+                handshake.data += chunk
+                handshake.version = version = detect_version(handshake.data)
+                if version is None:
+                    return
+                handshake.decoder = self.new_decoder(version)
+                data = handshake.data
+                if version == VERSION_2:
+                    handshake.flags = data[HELLO_LENGTH - 1]
+                    data = data[HELLO_LENGTH:]
+                handshake.data = b''
+                frames = handshake.decoder.feed(data)
+            else:
+                frames = handshake.decoder.read_from(client_socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ConnectionClosed, ProtocolError):
+            self._abort_handshake(handshake)
+            return
+        if frames:
+            self._login(handshake, frames)
+
+    def _handshake_expired(self, handshake):
+        handshake.timer = None
+        if not handshake.dead:
+            self.metrics.timeouts += 1
+            self._abort_handshake(handshake)
+
+    def _abort_handshake(self, handshake):
+        self._end_handshake(handshake)
+        if handshake.decoder is not None:
+            self.metrics.bytes_in += handshake.decoder.received
+        handshake.socket.close()
+
+    def _end_handshake(self, handshake):
+        handshake.dead = True
+        if handshake.timer is not None:
+            self.timers.cancel(handshake.timer)
+            handshake.timer = None
+        del self.handshakes[handshake.fd]
+        self.selector.unregister(handshake.socket)
+
+    def _login(self, handshake, frames):
+        self._end_handshake(handshake)
+        client_socket = handshake.socket
+        version = handshake.version
+        since = None
+        if version == VERSION_2:
+            kind, username = frames[0]
+            if kind != MSG_LOGIN:
+                self.metrics.bytes_in += handshake.decoder.received
+                client_socket.close()
+                return
+            username, since = split_token(username)
+        else:
+            username = frames[0]
+
+        client_address = handshake.address
+        session = self._register(client_socket, username, handshake.decoder, version, client_address)
+        self.metrics.accepts += 1
+        self._emit('connect', username.decode('utf-8', 'replace'), client_address, session.id)
+        if version == VERSION_2:
+            accepted = handshake.flags & FLAG_COMPRESS if self.compression else 0
+            # the welcome itself is never compressed, it tells the client whether what follows is
+            self._send(session, encode_frame_v2(MSG_WELCOME, session.id_bytes + bytes((accepted,))))
+            if accepted:
+                self._start_compression(session)
+            self._send(session, self._roster())
+        self._replay(session, since)
+        self._announce_join(session)
+        self.broadcast_notice(f"{username.decode('utf-8', 'replace')} has entered the room!", DEFAULT_ROOM)
+
+        # messages sent right after the login may arrive in the same read
+        self._handle_frames(session, frames[1:])
+
+    def _register(self, client_socket, username, decoder, version=VERSION_1, address=None):
+        client_socket.setblocking(False)
+        session = Session(client_socket, username, decoder, version, self._next_id, address)
+        self._next_id += self.id_step
+        now = monotonic()
+        if self.rate:
+            session.bucket = TokenBucket(self.rate, self.burst, now)
+        if self.user_rate and username not in self.user_buckets:
+            self.user_buckets[username] = TokenBucket(self.user_rate, self.user_burst, now)
+        session.last_seen = self.now
+        interval = self.ping_interval if version == VERSION_2 else self.idle_timeout
+        if interval:
+            session.timer = self.timers.schedule(interval, self._check_alive, session)
+        self.selector.register(client_socket, selectors.EVENT_READ, session)
+        self.clients.add(session)
+        self.rooms.setdefault(DEFAULT_ROOM, set()).add(session)
+        return session
+
+    def _start_compression(self, session):
+        """Compresses everything sent to and received from the client from now on"""
+
+        session.compressor = make_compressor()
+        session.pending = []
+        session.decoder.decompressor = make_decompressor()
+
+    def _roster(self):
+        """MSG_USER frames for every user of the server (and of the other workers)"""
+
+        frames = [encode_frame_v2(MSG_USER, session.id_bytes + session.username) for session in self.clients]
+        frames += [encode_frame_v2(MSG_USER, USER_ID.pack(user_id) + username)
+                   for user_id, username in self.remote_users.items()]
+        return b''.join(frames)
+
+    def _announce_join(self, session):
+        self._notify_v2(encode_frame_v2(MSG_USER, session.id_bytes + session.username), session)
+        if self.bus is not None:
+            host, port = session.address or ('', 0)
+            self._publish(BUS_JOIN, f"{host}\0{port}\0{session.id}\0".encode('utf-8') + session.username)
+
+    def _handle_readable(self, session):
+        frames = self._receive_frames(session.socket, session.decoder)
+        if frames is False:
+            self._disconnect(session)
+            return
+
+        session.last_seen = self.now
+        self._handle_frames(session, frames)
+
+    def _check_alive(self, session):
+        """
+            Heartbeat timer of a client: pings a v2 client that has been
+        silent for ping_interval and drops it if it didn't answer in
+        ping_timeout, drops a v1 client silent for idle_timeout. A client
+        that sent something meanwhile gets a timer for the rest of the
+        interval.
+        """
+
+        session.timer = None
+        if session.dead:
+            return
+        silent = self.now - session.last_seen
+        if session.version == VERSION_2:
+            if session.pinged:
+                if session.last_seen < session.pinged:
+                    self.metrics.timeouts += 1
+                    self._mark_dead(session)
+                    return
+                session.pinged = 0.0
+            if silent < self.ping_interval:
+                delay = self.ping_interval - silent
+            else:
+                session.pinged = self.now
+                self._send(session, PING_FRAME)
+                delay = self.ping_timeout
+        else:
+            if silent >= self.idle_timeout:
+                self.metrics.timeouts += 1
+                self._mark_dead(session)
+                return
+            delay = self.idle_timeout - silent
+        session.timer = self.timers.schedule(delay, self._check_alive, session)
+
+    def _handle_frames(self, session, frames):
+        self.metrics.messages_in += len(frames)
+        if frames and (self.rate or self.user_rate):
+            frames = self._rate_limit(session, frames)
+        if session.version == VERSION_2:
+            for kind, payload in frames:
+                if kind == MSG_MESSAGE:
+                    self._broadcast_message(session, payload)
+                elif kind == MSG_JOIN:
+                    self._join_room(session, *split_token(payload))
+                elif kind == MSG_LEAVE:
+                    self._join_room(session, DEFAULT_ROOM)
+                elif kind == MSG_DIRECT:
+                    target, _, text = payload.partition(b'\0')
+                    self._direct_message(session, target, text)
+                elif kind == MSG_HISTORY and len(payload) == HISTORY_TOKEN.size:
+                    self._replay(session, HISTORY_TOKEN.unpack(payload))
+                elif kind == MSG_PING:
+                    self._send(session, encode_frame_v2(MSG_PONG, payload))
+        else:
+            for message in frames:
+                if message[:1] == b'/' and self._handle_command(session, message):
+                    continue
+                self._broadcast_message(session, message)
+
+    def _rate_limit(self, session, frames):
+        """The frames the buckets of the session and of its username allow, the rest are dropped"""
+
+        now = monotonic()
+        count = len(frames)
+        allowed = count
+        if session.bucket is not None:
+            allowed = session.bucket.take(now, count)
+        user_bucket = self.user_buckets.get(session.username)
+        if user_bucket is not None:
+            granted = user_bucket.take(now, allowed)
+            if session.bucket is not None:
+                session.bucket.give_back(allowed - granted)
+            allowed = granted
+        if allowed == count:
+            return frames
+
+        self.metrics.throttled += count - allowed
+        if self.flood == 'drop':
+            self._mark_dead(session)
+            return []
+        if not session.throttled:
+            self._tell(session, "You are sending too fast, some of your messages were dropped")
+        session.throttled += count - allowed
+        return frames[:allowed]
+
+    def _handle_command(self, session, message):
+        """Runs the /join, /leave and /msg commands of the v1 clients, returns False for anything else"""
+
+        command, _, argument = message.partition(b' ')
+        if command == b'/join':
+            self._join_room(session, argument.strip())
+        elif command == b'/leave':
+            self._join_room(session, DEFAULT_ROOM)
+        elif command == b'/msg':
+            target, _, text = argument.partition(b' ')
+            self._direct_message(session, target, text)
+        else:
+            return False
+        return True
+
+    def _broadcast_message(self, session, message, exclude=True):
+        """Sends message from session to its room, but not to the sender unless exclude is False"""
+
+        start = perf_counter()
+        room = session.room
+        if self.listeners:
+            self._emit('message', session.username.decode('utf-8', 'replace'), message.decode('utf-8', 'replace'),
+                       room.decode('utf-8'))
+
+        history = self.history.history_of(room) if self.history is not None else None
+        frames = (None,
+                  session.prefix + encode_frame(message),
+                  V2_HEADER.pack(SEQ.size + USER_ID.size + len(message), MSG_ROOM_MESSAGE)
+                  + SEQ.pack(history.next_seq if history is not None else 0) + session.id_bytes + message)
+        if history is not None:
+            history.append(frames)
+        if self.log is not None:
+            self._log_record(room, frames[1])
+        self._fan_out(frames, session if exclude else None, room)
+        self.metrics.fan_out_time.observe(perf_counter() - start)
+
+    def _log_record(self, room, data):
+        try:
+            self.log.append(room, data)
+        except OSError as e:
+            # the writer of the log stopped (disk full...), the chat goes on without it
+            logger.error("Chat log disabled: %s", e)
+            self.log = None
+
+    def _replay(self, session, since=None):
+        """Queues the history of the client's room, only the messages after the since token if it is valid"""
+
+        if self.history is None:
+            return
+        history = self.history.history_of(session.room)
+        entries = history.since(*since) if since is not None else None
+        if entries is None:
+            entries = history.last(self.replay)
+        version = session.version
+        for frames in entries:
+            self._send(session, frames[version])
+        if version == VERSION_2:
+            self._send(session, encode_frame_v2(MSG_HISTORY, HISTORY_TOKEN.pack(history.epoch, history.last_seq)))
+
+    def _join_room(self, session, room, since=None):
+        if not valid_room(room):
+            self._tell(session, f"Room names are 1 to {ROOM_NAME_MAX} characters without spaces")
+            return
+        if room == session.room:
+            return
+
+        username = session.username.decode('utf-8', 'replace')
+        old_room = session.room
+        self._leave_room(session)
+        self.rooms.setdefault(room, set()).add(session)
+        session.room = room
+
+        self._emit('room', username, session.id, room.decode('utf-8'))
+        if self.bus is not None:
+            self._publish(BUS_ROOM, f"{session.id}\0".encode('utf-8') + room)
+        if session.version == VERSION_2:
+            self._send(session, encode_frame_v2(MSG_JOIN, room))
+        self._replay(session, since)
+        self.broadcast_notice(f"{username} has left #{old_room.decode('utf-8')}", old_room)
+        self.broadcast_notice(f"{username} has joined #{room.decode('utf-8')}", room)
+
+    def _leave_room(self, session):
+        members = self.rooms[session.room]
+        members.discard(session)
+        if not members and session.room != DEFAULT_ROOM:
+            del self.rooms[session.room]
+
+    def _direct_message(self, session, target, text):
+        """Sends text from session to every client logged in as target, on this worker or any other"""
+
+        if not text:
+            return
+        frames = (None,
+                  session.prefix + encode_frame(b'(private) ' + text),
+                  encode_frame_v2(MSG_DIRECT, session.id_bytes + text))
+        recipients = self.clients.sessions_of(target)
+        for recipient in recipients:
+            self._send(recipient, frames[recipient.version])
+        self.metrics.messages_out += len(recipients)
+
+        remote = target in self.remote_names
+        if remote:
+            self._publish(BUS_DIRECT, target + b'\0' + USER_ID.pack(len(frames[VERSION_1])) + frames[VERSION_1]
+                          + frames[VERSION_2])
+        elif not recipients:
+            self._tell(session, f"{target.decode('utf-8', 'replace')} is not connected")
+
+    def _disconnect(self, session):
+        if not self.clients.remove(session):
+            return
+        if session.username not in self.clients.by_username:
+            self._release_user_bucket(session.username)
+        session.dead = True
+        if session.timer is not None:
+            self.timers.cancel(session.timer)
+            session.timer = None
+        self._leave_room(session)
+        self.selector.unregister(session.socket)
+        session.socket.close()
+        self.metrics.disconnects += 1
+        self.metrics.bytes_in += session.decoder.received
+
+        username = session.username.decode('utf-8', 'replace')
+        self._emit('disconnect', username, session.id)
+        self._notify_v2(encode_frame_v2(MSG_USER_LEFT, session.id_bytes))
+        if self.bus is not None:
+            self._publish(BUS_LEAVE, f"{session.id}\0".encode('utf-8') + session.username)
+        self.broadcast_notice(f"{username} has disconnected!", session.room)
+
+    def _release_user_bucket(self, username):
+        """
+            Drops the bucket of a username that has no connection left,
+        once it is full again: reconnecting doesn't give a flooder a
+        fresh bucket.
+        """
+
+        bucket = self.user_buckets.get(username)
+        if bucket is None or username in self.clients.by_username:
+            return
+        delay = bucket.refill_time(monotonic())
+        if delay:
+            self.timers.schedule(delay, self._release_user_bucket, username)
+        else:
+            del self.user_buckets[username]
+
+    def broadcast_notice(self, msg, room=None):
+        """Sends msg, as the SERVER user, to the members of room or, without a room, to every client"""
+
+        msg = msg.encode('utf-8')
+        self._fan_out((None, SERVER_PREFIX + encode_frame(msg), encode_frame_v2(MSG_MESSAGE, SERVER_ID_BYTES + msg)),
+                      room=room)
+
+    def _tell(self, session, msg):
+        """Sends msg, as the SERVER user, to a single client"""
+
+        msg = msg.encode('utf-8')
+        self._send(session, SERVER_PREFIX + encode_frame(msg) if session.version == VERSION_1
+                   else encode_frame_v2(MSG_MESSAGE, SERVER_ID_BYTES + msg))
+
+    def _fan_out(self, frames, exclude=None, room=None):
+        """
+            Queues frames[version] for every local member of room (every
+        local client without a room) but exclude, and publishes the
+        frames to the clients of the other workers.
+        """
+
+        members = self.clients if room is None else self.rooms.get(room, ())
+        for session in members:
+            if session is not exclude:
+                self._send(session, frames[session.version])
+        self.metrics.messages_out += len(members) - (exclude is not None)
+        if self.bus is not None:
+            self._publish(BUS_BROADCAST, (room or b'') + b'\0' + USER_ID.pack(len(frames[VERSION_1]))
+                          + frames[VERSION_1] + frames[VERSION_2])
+
+    def _notify_v2(self, frame, exclude=None):
+        """Queues a v2 only frame (presence, ...) for the v2 clients"""
+
+        for session in self.clients:
+            if session.version == VERSION_2 and session is not exclude:
+                self._send(session, frame)
+
+    def _publish(self, kind, data):
+        bus_session = self.bus_session
+        frame = encode_frame(kind + data)
+        bus_session.outbox.append(frame)
+        bus_session.queued += len(frame)
+        if not bus_session.writing:
+            self._pending[bus_session.fd] = bus_session
+
+    def _handle_bus(self):
+        frames = self._receive_frames(self.bus, self.bus_session.decoder)
+        if frames is False:
+            # the pool is gone, there is no one left to relay to
+            self.running = False
+            return
+
+        for payload in frames:
+            kind = payload[:1]
+            if kind == BUS_BROADCAST or kind == BUS_DIRECT:
+                target, encoded = split_encodings(payload)
+                if kind == BUS_DIRECT:
+                    recipients = self.clients.sessions_of(target)
+                else:
+                    recipients = self.rooms.get(target, ()) if target else self.clients
+                    if target and encoded[2][4] == MSG_ROOM_MESSAGE:
+                        if self.log is not None:
+                            self._log_record(target, bytes(encoded[1]))
+                        if self.history is not None:
+                            encoded = self._record_remote(target, encoded)
+                for session in recipients:
+                    self._send(session, encoded[session.version])
+                self.metrics.messages_out += len(recipients)
+            elif kind == BUS_JOIN:
+                host, port, user_id, username = payload[1:].split(b'\0', 3)
+                self.remote_users[int(user_id)] = username
+                self.remote_names[username] = self.remote_names.get(username, 0) + 1
+                self._notify_v2(encode_frame_v2(MSG_USER, USER_ID.pack(int(user_id)) + username))
+                if self.listeners:
+                    self._emit('connect', username.decode('utf-8', 'replace'), (host.decode('utf-8'), int(port)),
+                               int(user_id))
+            elif kind == BUS_LEAVE:
+                user_id, username = payload[1:].split(b'\0', 1)
+                if self.remote_users.pop(int(user_id), None) is not None:
+                    self.remote_names[username] -= 1
+                    if not self.remote_names[username]:
+                        del self.remote_names[username]
+                    if self.listeners:
+                        self._emit('disconnect', username.decode('utf-8', 'replace'), int(user_id))
+                self._notify_v2(encode_frame_v2(MSG_USER_LEFT, USER_ID.pack(int(user_id))))
+            elif kind == BUS_ROOM and self.listeners:
+                user_id, room = payload[1:].split(b'\0', 1)
+                username = self.remote_users.get(int(user_id))
+                if username is not None:
+                    self._emit('room', username.decode('utf-8', 'replace'), int(user_id), room.decode('utf-8'))
+
+    def _record_remote(self, room, encoded):
+        """Numbers a room message of another worker in the history of this one, returns the frames to send"""
+
+        history = self.history.history_of(room)
+        v2 = encoded[2]
+        encoded = (None, encoded[1],
+                   b''.join((v2[:V2_HEADER.size], SEQ.pack(history.next_seq), v2[V2_HEADER.size + SEQ.size:])))
+        history.append(encoded)
+        return encoded
+
+    def _send(self, session, data):
+        """Queues data for the client, it is written when the current loop iteration ends"""
+
+        if session.dead:
+            return
+
+        if session.queued and session.queued + len(data) > self.high_water:
+            if self.overflow == 'shed':
+                session.shed += 1
+            else:
+                self._mark_dead(session)
+            return
+
+        session.pending.append(data)
+        session.queued += len(data)
+        if not session.writing or session.compressor is not None:
+            # a compressing client waiting for the socket still gets the new frames compressed with the next block
+            self._pending[session.fd] = session
+
+    def _flush(self, session):
+        outbox = session.outbox
+        if session.compressor is not None and session.pending:
+            pending = session.pending
+            data = b''.join(pending)
+            block = compress_block(session.compressor, data)
+            session.queued += len(block) - len(data)
+            pending.clear()
+            outbox.append(block)
+        try:
+            while outbox:
+                sent = write_buffers(session.socket, outbox)
+                session.queued -= sent
+                self.metrics.bytes_out += sent
+                done = 0
+                while done < len(outbox) and sent >= len(outbox[done]):
+                    sent -= len(outbox[done])
+                    done += 1
+                del outbox[:done]
+                if sent:
+                    # the kernel buffer is full, keep the unsent part of the frame
+                    outbox[0] = memoryview(outbox[0])[sent:]
+                    break
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._mark_dead(session)
+            return
+
+        if outbox and not session.writing:
+            session.writing = True
+            self.selector.modify(session.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+        elif not outbox and session.writing:
+            session.writing = False
+            self.selector.modify(session.socket, selectors.EVENT_READ, session)
+
+    def _mark_dead(self, session):
+        session.dead = True
+        session.outbox.clear()
+        session.pending.clear()
+        session.queued = 0
+        if session is self.bus_session:
+            self.running = False
+            return
+        self._dead.append(session)
+
+    def stats(self):
+        """A snapshot of the counters and of the gauges of the current state, safe from any thread"""
+
+        metrics = self.metrics
+        # a single C level copy, safe while the loop thread changes the registry
+        sessions = list(self.clients.by_fd.values())
+        stats = {name: getattr(metrics, name) for name, _ in Metrics.COUNTERS}
+        stats['bytes_in'] += sum(session.decoder.received for session in sessions)
+        stats['shed'] = sum(session.shed for session in sessions)
+        stats['clients'] = len(sessions)
+        stats['handshakes'] = len(self.handshakes)
+        stats['queue_depth'] = queue_depth = Histogram(QUEUE_BUCKETS)
+        for session in sessions:
+            queue_depth.observe(session.queued)
+        stats['queued'] = int(queue_depth.sum)
+        return stats
+
+    def metrics_text(self):
+        """The metrics in the Prometheus text format, safe from any thread"""
+
+        stats = self.stats()
+        lines = []
+        for name, help_text in Metrics.COUNTERS:
+            lines += render_counter(f"chat_{name}_total", help_text, stats[name])
+        lines += render_counter("chat_shed_messages_total", "Messages discarded for the connected slow clients",
+                                stats['shed'])
+        lines += render_counter("chat_clients", "Connected clients", stats['clients'], 'gauge')
+        lines += render_counter("chat_handshakes", "Connections that haven't logged in yet", stats['handshakes'],
+                                'gauge')
+        lines += render_counter("chat_remote_clients", "Clients of the other workers and nodes", len(self.remote_users),
+                                'gauge')
+        lines += render_counter("chat_rooms", "Rooms with members", len(self.rooms), 'gauge')
+        lines += render_counter("chat_queued_bytes", "Bytes waiting in the outboxes", stats['queued'], 'gauge')
+        lines += stats['queue_depth'].render("chat_client_queue_bytes", "Bytes waiting in the outbox of each client")
+        lines += self.metrics.loop_time.render("chat_loop_seconds", "Work time of the event loop iterations")
+        lines += self.metrics.fan_out_time.render("chat_fan_out_seconds", "Time to record and queue a room message")
+        lines += render_counter("chat_profiling", "1 while the event loop is profiled", int(self.profiler.running),
+                                'gauge')
+        return '\n'.join(lines) + '\n'
+
+    def _close(self):
+        if self.metrics_endpoint is not None:
+            self.metrics_endpoint.close()
+            self.metrics_endpoint = None
+        for session in self.clients:
+            session.socket.close()
+        self.clients.clear()
+        for handshake in self.handshakes.values():
+            handshake.socket.close()
+        self.handshakes.clear()
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = self.bus_session = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+
+    @staticmethod
+    def _receive_frames(client_socket, decoder):
+        """Returns the complete frames of a single read, or False if the connection is lost or malformed"""
+
+        try:
+            return decoder.read_from(client_socket)
+        except BlockingIOError:
+            return []
+        except (OSError, ConnectionClosed, ProtocolError):
+            return False
@@ -0,0 +1,93 @@
+from math import ceil
+from time import monotonic
+
+
+TICK = 0.25             # seconds per slot of the wheel, the precision of the timers
+SLOTS = 512             # slots of the wheel, timers further than SLOTS * TICK go around several times
+DUE = -1                # slot of a timer taken out of the wheel to fire
+
+
+class Timer:
+
+    __slots__ = ('callback', 'args', 'slot', 'rounds')
+
+    def __init__(self, callback, args, slot, rounds):
+        self.callback = callback
+        self.args = args
+        self.slot = slot                # None once it has fired or was cancelled, DUE while firing
+        self.rounds = rounds
+
+
+class TimerWheel:
+
+    """
+        Timer Wheel: a hashed timing wheel for the many timers of an
+    event loop (login deadlines, heartbeats...), most of which are
+    cancelled or pushed back before they fire.
+
+        The wheel is a ring of SLOTS sets of timers, one per TICK
+    seconds. schedule puts a timer in the slot its deadline falls in,
+    with the number of turns of the wheel it has to wait, and cancel
+    removes it from there: both are O(1), whatever the number of
+    timers. advance, called by the loop with the current time, moves
+    the wheel one slot per elapsed tick and runs the callbacks of the
+    timers of those slots that have no turn left to wait.
+
+        A timer fires at most two ticks late and never early. Callbacks
+    run on the thread calling advance and may schedule new timers.
+
+            wheel = TimerWheel(tick=1, now=0)
+            timer = wheel.schedule(2.5, print, "late")
+            wheel.advance(3.0)              -> nothing yet
+            wheel.advance(4.0)              -> prints late
+    """
+
+    def __init__(self, tick=TICK, slots=SLOTS, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.cursor = 0
+        self.time = monotonic() if now is None else now     # when the slot at cursor was reached
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) in delay seconds, returns the Timer"""
+
+        # the wheel may be up to a tick behind, one more tick makes sure the timer isn't early
+        ticks = max(0, ceil(delay / self.tick)) + 1
+        slot = (self.cursor + ticks) % len(self.slots)
+        timer = Timer(callback, args, slot, (ticks - 1) // len(self.slots))
+        self.slots[slot].add(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            if timer.slot != DUE:
+                self.slots[timer.slot].discard(timer)
+            timer.slot = None
+
+    def advance(self, now):
+        """Runs the timers that are due at now"""
+
+        slots = self.slots
+        while now - self.time >= self.tick:
+            self.time += self.tick
+            self.cursor = (self.cursor + 1) % len(slots)
+            slot = slots[self.cursor]
+            if not slot:
+                continue
+            due = []
+            for timer in slot:
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    due.append(timer)
+            for timer in due:
+                slot.discard(timer)
+                timer.slot = DUE
+            for timer in due:
+                # an earlier callback may have cancelled it
+                if timer.slot == DUE:
+                    timer.slot = None
+                    timer.callback(*timer.args)
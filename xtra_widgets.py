@@ -1,7 +1,23 @@
+import queue
+import re
+import string
+import threading
+from collections import OrderedDict
+
 try:
     import tkinter as tk
+    import tkinter.font as tkfont
 except ImportError:
     import Tkinter as tk
+    import tkFont as tkfont
+
+
+SEARCH_DELAY = 150          # ms without a keystroke before a DBSearchBox searches
+SEARCH_CACHE = 32           # search strings whose rows a DBSearchBox keeps
+SEARCH_POLL = 20            # ms between two checks for the rows of a search
+FETCH_SIZE = 1000           # rows fetched at once, a stale search is given up between two fetches
+PAGE_CACHE = 64             # pages of a lazy NavigationBox kept compiled
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)     # SQLite's LIKE only folds ASCII
 
 
 class UnsupportedType(Exception):
@@ -14,59 +30,708 @@ class UnsupportedType(Exception):
                "Supported data types include int, str, float, list, tuple and bytes.".format(self.ft)
 
 
+class RingBuffer:
+
+    """
+        Ring Buffer: fixed capacity sequence, appending to a full buffer
+    overwrites the oldest item. Indexing and appending are O(1).
+    """
+
+    __slots__ = ('_items', '_start', '_len', 'dropped')
+
+    def __init__(self, capacity):
+        self._items = [None] * capacity
+        self._start = 0
+        self._len = 0
+        self.dropped = 0            # items overwritten since the buffer was created
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if not -self._len <= index < self._len:
+            raise IndexError("ring buffer index out of range")
+        return self._items[(self._start + index % self._len) % len(self._items)]
+
+    def append(self, item):
+        capacity = len(self._items)
+        if self._len < capacity:
+            self._items[(self._start + self._len) % capacity] = item
+            self._len += 1
+        else:
+            self._items[self._start] = item
+            self._start = (self._start + 1) % capacity
+            self.dropped += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def window(self, start, stop):
+        """Items from start up to stop (clamped), as a list"""
+        return [self[i] for i in range(max(0, start), min(stop, self._len))]
+
+    def clear(self):
+        self.dropped += self._len
+        self._items = [None] * len(self._items)
+        self._start = 0
+        self._len = 0
+
+
+class StaticLines:
+
+    """
+        Static Lines: read only view of a sequence with the interface
+    of a RingBuffer, for a virtual ScrollBox to show lines it doesn't
+    own without copying them.
+    """
+
+    __slots__ = ('_items',)
+
+    dropped = 0
+
+    def __init__(self, items):
+        self._items = items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def window(self, start, stop):
+        return list(self._items[max(0, start):min(stop, len(self._items))])
+
+
 class ScrollBox(tk.LabelFrame):
 
-    def __init__(self, master, relief='sunken', bd=2, width=20, height=10, **kwargs):
+    """
+        Scroll Box: a Listbox with vertical and horizontal scrollbars.
+
+        + max_lines +
+            Keeps at most max_lines lines. Once the box holds a tenth
+        more than that, the oldest lines are deleted in a single call.
+
+        + virtual +
+            The lines are kept in a RingBuffer of max_lines
+        (VIRTUAL_MAX_LINES if not given) and only the visible window is
+        rendered into the Listbox, so the Listbox never holds more
+        than a screenful. The vertical scrollbar and the mouse wheel
+        page the lines in from the buffer. While the view is at the
+        bottom it follows the new lines.
+            In this mode insert only appends (the index is ignored)
+        and list_box indexes refer to the visible window, line_index
+        turns them into the number of the line. show(lines) shows a
+        sequence of lines from the top without copying it, in O(1)
+        whatever its length.
+    """
+
+    VIRTUAL_MAX_LINES = 100000
+
+    def __init__(self, master, relief='sunken', bd=2, width=20, height=10, max_lines=None, virtual=False, **kwargs):
         super().__init__(master, relief=relief, bd=bd, **kwargs)
 
+        self.max_lines = max_lines
+        self.virtual = virtual
+
         self.list_box = tk.Listbox(self, width=width, height=height)
-        self.v_scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.list_box.yview)
+        self.v_scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL,
+                                        command=self._yview if virtual else self.list_box.yview)
         self.h_scrollbar = tk.Scrollbar(self, orient=tk.HORIZONTAL, command=self.list_box.xview)
 
+        if virtual:
+            self.lines = RingBuffer(max_lines or self.VIRTUAL_MAX_LINES)
+            self.rows = height
+            self.top = 0                # absolute number of the first visible line
+            self.follow = True
+            self.list_box.bind('<Configure>', self._on_configure)
+            self.list_box.bind('<MouseWheel>', lambda e: self._yview('scroll', -1 if e.delta > 0 else 1, 'units'))
+            self.list_box.bind('<Button-4>', lambda e: self._yview('scroll', -1, 'units'))
+            self.list_box.bind('<Button-5>', lambda e: self._yview('scroll', 1, 'units'))
+
     def grid(self, **kwargs):
         super().grid(**kwargs)
         self.list_box.grid(row=0, column=0, sticky='nsew')
         self.v_scrollbar.grid(row=0, column=1, sticky='nse')
         self.h_scrollbar.grid(row=1, column=0, sticky='new')
-        self.list_box['yscrollcommand'] = self.v_scrollbar.set
+        if not self.virtual:
+            self.list_box['yscrollcommand'] = self.v_scrollbar.set
         self.list_box['xscrollcommand'] = self.h_scrollbar.set
 
     def insert(self, index, *args):
+        if self.virtual:
+            if isinstance(self.lines, StaticLines):
+                shown, self.lines = self.lines, RingBuffer(self.max_lines or self.VIRTUAL_MAX_LINES)
+                self.lines.extend(shown.window(0, len(shown)))
+            self.lines.extend(args)
+            self._render()
+            return
+
         self.list_box.insert(index, *args)
+        if self.max_lines:
+            size = self.list_box.size()
+            if size > self.max_lines + self.max_lines // 10:
+                self.list_box.delete(0, size - self.max_lines - 1)
 
     def special_insert(self, index, args: tuple):
-        self.list_box.insert(index, *args)
+        self.insert(index, *args)
+
+    def show(self, lines):
+        """Replaces the lines with lines (a sequence), from the top, virtual mode only"""
+
+        self.lines = StaticLines(lines)
+        self.top = 0
+        self.follow = False
+        self._render()
+
+    def line_index(self, index):
+        """Number of the line at index of list_box"""
+        return self.top - self.lines.dropped + index if self.virtual else index
 
     def clear(self):
+        if self.virtual:
+            if isinstance(self.lines, StaticLines):
+                self.lines = RingBuffer(self.max_lines or self.VIRTUAL_MAX_LINES)
+            self.lines.clear()
+            self.top = 0
+            self.follow = True
+            self._render()
+            return
+
+        self.list_box.delete(0, tk.END)
+
+    def _yview(self, *args):
+        total = len(self.lines)
+        first = self.top - self.lines.dropped
+        if args[0] == 'moveto':
+            first = int(float(args[1]) * total)
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            first += step * self.rows if args[2] == 'pages' else step
+
+        first = max(0, min(first, total - self.rows))
+        self.top = first + self.lines.dropped
+        self.follow = first >= total - self.rows
+        self._render()
+
+    def _on_configure(self, event):
+        linespace = tkfont.Font(font=self.list_box['font']).metrics('linespace')
+        rows = max(1, event.height // max(1, linespace))
+        if rows != self.rows:
+            self.rows = rows
+            self._render()
+
+    def _render(self):
+        lines = self.lines
+        total = len(lines)
+        if self.follow:
+            first = max(0, total - self.rows)
+        else:
+            first = max(0, min(self.top - lines.dropped, total - self.rows))
+        self.top = first + lines.dropped
+
         self.list_box.delete(0, tk.END)
+        window = lines.window(first, first + self.rows)
+        if window:
+            self.list_box.insert(tk.END, *window)
+        if total:
+            self.v_scrollbar.set(first / total, (first + len(window)) / total)
+        else:
+            self.v_scrollbar.set(0, 1)
+
+
+def like_pattern(text):
+    """LIKE pattern (with ESCAPE '\\') matching text anywhere, the wildcards of text match themselves"""
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def compile_filter(pfilter):
+    """
+        Turns a filter written with {sv} into a parameterized one.
+    Returns (sql, templates): every {sv}, and every quoted SQL string
+    holding one, becomes a ? parameter, whose value is its template with
+    {sv} replaced by the search string.
+
+            compile_filter("WHERE name LIKE '%{sv}%'")  -> ('WHERE name LIKE ?', ['%{sv}%'])
+    """
+
+    templates = []
+
+    def parameter(match):
+        literal = match.group(0)
+        if literal == '{sv}':
+            templates.append('{sv}')
+        elif '{sv}' in literal:
+            templates.append(literal[1:-1].replace("''", "'"))
+        else:
+            return literal
+        return '?'
+
+    return re.sub(r"'(?:[^']|'')*'|\{sv\}", parameter, pfilter), templates
+
+
+def create_fts_index(connection, table, column):
+    """
+        Builds, unless it exists, the FTS5 index of column of table: an
+    external content FTS5 table named {table}_fts with the trigram
+    tokenizer, which answers LIKE '%text%' without scanning the table
+    for texts of 3 characters or more, and the triggers keeping it up
+    to date. Returns the name of the FTS5 table. Indexing a large table
+    takes a while, it is only done once.
+    """
+
+    fts = '{}_fts'.format(table)
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,)).fetchone() is None:
+        connection.executescript("""
+            CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', tokenize='trigram');
+            INSERT INTO {fts}({fts}) VALUES ('rebuild');
+            CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column});
+            END;
+            CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+            END;
+            CREATE TRIGGER {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column});
+            END;
+        """.format(fts=fts, table=table, column=column))
+        connection.commit()
+    return fts
+
+
+class SearchRows:
+
+    __slots__ = ('rows', 'complete', 'cursor')
+
+    def __init__(self, rows=None, complete=False):
+        self.rows = [] if rows is None else rows
+        self.complete = complete        # False while more rows may follow
+        self.cursor = None              # open cursor of a search paged with fetchmany
+
+
+class SearchWorker:
+
+    """
+        Search Worker: runs the queries of a DBSearchBox on a thread of
+    its own, so a slow query never blocks the Tk thread.
+
+        submit asks for the rows of a search string and returns the
+    number of the request. Only the last request counts: one that
+    hasn't started yet when a newer one comes in is dropped, a running
+    one is interrupted (connection.interrupt, for SQLite) or given up
+    between two fetchmany calls. The lines of a finished search, or
+    the exception it raised, are put in results as (request, text,
+    start, lines, more): start is the number of the first line, more
+    tells whether the search has more rows.
+
+        query(text, after) returns the (sql, params) of a search and
+    format(row) its line. The rows of the last cache_size searches are
+    kept in an LRU cache. With matcher, matcher(text) returning a
+    predicate telling whether a row matches text, a search string that
+    extends a cached (complete) one is answered by filtering the cached
+    rows in memory, without a query.
+
+        With page_size, a search only fetches page_size rows at first,
+    and more(request) asks for the next page_size. With keyset, the
+    first column of the rows is a key the rows are sorted by and every
+    page is a query of its own, query(text, after) asking for the rows
+    after the key after (keyset pagination, nothing stays open between
+    two pages). Otherwise the statement of the search stays open on a
+    cursor of its own and the pages are read with fetchmany.
+
+        The connection is only used from the worker thread: a SQLite
+    connection must be opened with check_same_thread=False, a
+    connection that can't be used from another thread is a ValueError.
+    connection may also be a function opening it, which is then called
+    on the worker thread, and setup(connection) is called there before
+    the first search. If either fails, every search gets its exception.
+    """
+
+    def __init__(self, connection, query, format=str, matcher=None, cache_size=SEARCH_CACHE, page_size=None,
+                 keyset=False, setup=None):
+        if hasattr(connection, 'cursor'):
+            check_thread(connection)
+        self.connection = connection
+        self.query = query
+        self.format = format
+        self.matcher = matcher
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.keyset = keyset
+        self.setup = setup
+        self.cache = OrderedDict()              # text -> SearchRows, least recently used first
+        self.results = queue.SimpleQueue()
+
+        self.request = 0
+        self._pending = None                    # (request, text) not started yet
+        self._more = None                       # request whose next page is wanted
+        self._current = None                    # (request, text, SearchRows) of the last search
+        self._running = False
+        self._db = None
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="db-search", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        with self._cond:
+            self.request += 1
+            self._pending = (self.request, text)
+            self._more = None
+            if self._running and hasattr(self._db, 'interrupt'):
+                self._db.interrupt()
+            self._cond.notify()
+            return self.request
+
+    def more(self, request):
+        """Asks for the next page of the search request"""
+
+        with self._cond:
+            if request == self.request:
+                self._more = request
+                self._cond.notify()
+
+    def clear_cache(self):
+        """Forgets the cached rows, for when the table changed"""
+        with self._cond:
+            self.cache = OrderedDict()
+
+    def close(self, wait=False):
+        """Stops the worker thread, interrupting the running search, with wait returns once it has stopped"""
+
+        with self._cond:
+            self._closing = True
+            if self._running and hasattr(self._db, 'interrupt'):
+                self._db.interrupt()
+            self._cond.notify()
+        if wait:
+            self._thread.join()
+
+    def _stale(self, request):
+        return request != self.request or self._closing
+
+    def _run(self):
+        opened = not hasattr(self.connection, 'cursor')
+        db = failure = None
+        try:
+            db = self._db = self.connection() if opened else self.connection
+            if self.setup is not None:
+                self.setup(db)
+        except Exception as e:
+            failure = e
+        try:
+            while True:
+                with self._cond:
+                    while self._pending is None and self._more is None and not self._closing:
+                        self._cond.wait()
+                    if self._closing:
+                        return
+                    pending, self._pending = self._pending, None
+                    more, self._more = self._more, None
+                    if pending is None and (self._current is None or self._current[0] != more):
+                        continue
+                    self._running = True
+                if failure is not None:
+                    # the connection couldn't be opened or set up, every search fails with it
+                    (request, text), start, result = pending, 0, (failure, False)
+                else:
+                    try:
+                        if pending is not None:
+                            request, text = pending
+                            start = 0
+                            entry = self._search(request, text)
+                        else:
+                            request, text, entry = self._current
+                            start = len(entry.rows)
+                            if not entry.complete and not self._fetch(request, text, entry):
+                                entry = None
+                        result = None if entry is None else \
+                            ([self.format(row) for row in entry.rows[start:]], not entry.complete)
+                    except Exception as e:
+                        result = (e, False)
+                with self._cond:
+                    self._running = False
+                    if result is not None and not self._stale(request):
+                        self.results.put((request, text, start) + result)
+        finally:
+            if self._current is not None and self._current[2].cursor is not None:
+                self._current[2].cursor.close()
+            if opened and db is not None:
+                db.close()
+
+    def _search(self, request, text):
+        """The rows of text (the first page of them), None if a newer request came in meanwhile"""
+
+        if self._current is not None and self._current[2].cursor is not None:
+            self._current[2].cursor.close()
+            self._current[2].cursor = None
+        self._current = None
+
+        cache = self.cache
+        entry = cache.get(text)
+        if entry is not None:
+            cache.move_to_end(text)
+        else:
+            if self.matcher is not None:
+                for end in range(len(text) - 1, 0, -1):
+                    cached = cache.get(text[:end])
+                    if cached is not None and cached.complete:
+                        matches = self.matcher(text)
+                        entry = SearchRows([row for row in cached.rows if matches(row)], True)
+                        break
+            if entry is None:
+                entry = SearchRows()
+                if not self._fetch(request, text, entry):
+                    return None
+            # an open cursor can't be shared, such a search is only cached once it is complete
+            if entry.cursor is None:
+                cache[text] = entry
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+        self._current = (request, text, entry)
+        return entry
+
+    def _fetch(self, request, text, entry):
+        """Adds the next page of rows to entry (all of them without page_size), False if a newer request came in"""
+
+        source = entry.cursor
+        if source is None:
+            sql, params = self.query(text, entry.rows[-1][0] if self.keyset and entry.rows else None)
+            source = self._db.cursor()
+            source.execute(sql, params)
+        wanted = self.page_size or float('inf')
+        fetched = 0
+        try:
+            while fetched < wanted:
+                rows = source.fetchmany(min(FETCH_SIZE, wanted - fetched))
+                if self._stale(request):
+                    return False
+                if not rows:
+                    entry.complete = True
+                    break
+                entry.rows.extend(rows)
+                fetched += len(rows)
+        finally:
+            if entry.complete or self.keyset or self._stale(request):
+                source.close()
+                entry.cursor = None
+            else:
+                entry.cursor = source
+        if self.keyset and fetched < wanted:
+            entry.complete = True
+        return True
+
+
+def check_thread(connection):
+    """Raises ValueError unless connection can be used from another thread than the one that opened it"""
+
+    errors = []
+
+    def probe():
+        try:
+            connection.cursor().close()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=probe)
+    thread.start()
+    thread.join()
+    if errors:
+        raise ValueError("the connection can't be used from the search thread, open it with "
+                         "check_same_thread=False or pass a function opening it") from errors[0]
+
+
+class SQLQuery:
+
+    """
+        SQL Query: the queries of a DBSearchBox given its SQL: sql,
+    with pfilter appended once something is typed. In pfilter {sv}
+    stands for the text typed, passed to the query as a parameter (see
+    compile_filter). With params, pfilter is already written with ?
+    placeholders and {sv} is replaced in the str items of params
+    instead.
+    """
+
+    matcher = None
+    keyset = False
+
+    def __init__(self, sql, pfilter=None, params=None):
+        self.sql = sql
+        self.params = params
+        self.filter, self.templates = (pfilter, None) if params is not None else compile_filter(pfilter or '')
+
+    def __call__(self, text, after=None):
+        if not text:
+            return self.sql, ()
+        if self.templates is None:
+            params = tuple(p.replace('{sv}', text) if isinstance(p, str) else p for p in self.params)
+        else:
+            params = tuple(t.replace('{sv}', text) for t in self.templates)
+        return self.sql + ' ' + self.filter, params
+
+    @staticmethod
+    def format(row):
+        return ' | '.join(str(i) for i in row)
+
+
+class TableQuery:
+
+    """
+        Table Query: the queries of a DBSearchBox listing show_fields
+    of the rows of table whose search_field contains the text typed
+    (LIKE '%text%').
+
+        The rows start with their rowid, the key of the pages with
+    page_size (keyset pagination), and end with search_field, for them
+    to be filtered in memory by matcher.
+
+        With fts, the text is looked up in the FTS5 index built by
+    create_fts_index (in setup) instead of scanning the table. The
+    trigram index only serves LIKE without ESCAPE for 3 characters or
+    more: shorter texts, or texts holding a wildcard, still scan.
+    """
+
+    def __init__(self, table, search_field, show_fields, page_size=None, fts=False):
+        self.table = table
+        self.search_field = search_field
+        self.page_size = page_size
+        self.keyset = page_size is not None
+        self.fts = '{}_fts'.format(table) if fts else None
+        fields = show_fields if isinstance(show_fields, str) else ', '.join(show_fields)
+        self.select = "SELECT rowid, {}, {} FROM {}".format(fields, search_field, table)
+        self.limit = " ORDER BY rowid LIMIT {}".format(page_size) if page_size else ""
+
+    def setup(self, connection):
+        if self.fts is not None:
+            create_fts_index(connection, self.table, self.search_field)
+
+    def __call__(self, text, after=None):
+        conditions = []
+        params = []
+        if text and self.fts is not None and len(text) >= 3 and '%' not in text and '_' not in text:
+            conditions.append("rowid IN (SELECT rowid FROM {} WHERE {} LIKE ?{}{})".format(
+                self.fts, self.search_field, "" if after is None else " AND rowid > ?", self.limit))
+            params.append('%' + text + '%')
+            if after is not None:
+                params.append(after)
+        elif text:
+            conditions.append("{} LIKE ? ESCAPE '\\'".format(self.search_field))
+            params.append(like_pattern(text))
+        if after is not None:
+            conditions.append("rowid > ?")
+            params.append(after)
+        sql = self.select
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql + self.limit, tuple(params)
+
+    @staticmethod
+    def format(row):
+        return ' | '.join(str(i) for i in row[1:-1])
+
+    @staticmethod
+    def matcher(text):
+        """Predicate of the rows whose search field contains text, like SQLite's LIKE"""
+
+        needle = text.translate(ASCII_LOWER)
+        return lambda row: row[-1] is not None and needle in str(row[-1]).translate(ASCII_LOWER)
 
 
 class DBSearchBox(tk.LabelFrame):
 
+    """
+        DB Search Box: an Entry over a ScrollBox listing the rows of a
+    database table that match what is typed in the Entry.
+
+        + table, search_field, show_fields +
+            Lists show_fields of the rows of table whose search_field
+        contains the text typed, see TableQuery.
+
+        + sql, pfilter, params +
+            Lists the rows of the query sql, with pfilter appended
+        once something is typed, see SQLQuery. The text typed is always
+        passed as a parameter, never put in the SQL.
+
+        + paged, page_size +
+            Only fetches page_size rows at first, and the next
+        page_size once the list is scrolled near its end. In the table
+        mode the pages are read in rowid order with keyset pagination,
+        so the table must have a rowid. With sql, the query stays open
+        and the pages are read from its cursor with fetchmany.
+
+        + fts +
+            Table mode, SQLite only: searches through an FTS5 index of
+        search_field instead of scanning the table. The index is built
+        on the first search unless it exists, see create_fts_index.
+
+        The queries run on a SearchWorker thread once no key has been
+        pressed for delay ms, the rows of a search that a newer one made
+        stale are never shown, and the results go into the ScrollBox
+        with a single insert. The rows of the last cache_size searches
+        are cached: in the table mode, typing more after a cached search
+        filters its rows without querying.
+
+        The error of a failed search is listed as a single line and
+        kept in error.
+
+        connection is used from the worker thread only, see
+        SearchWorker: a SQLite connection opened with a plain
+        sqlite3.connect(path) is a ValueError, pass
+        sqlite3.connect(path, check_same_thread=False) or
+        lambda: sqlite3.connect(path) instead. refresh searches again
+        without the cache, after the table changed.
+    """
+
+    PAGE_SIZE = 200
+    PAGE_AHEAD = 0.9            # part of the list scrolled past when the next page is fetched
+
     def __init__(self, master, connection, table=None, search_field=None,
                  show_fields=None, sql=None, pfilter=None, params=None,  # in pfilter use {sv} for the string var
-                 relief='sunken', bd=2, width=20, height=10, **kwargs):
+                 relief='sunken', bd=2, width=20, height=10, delay=SEARCH_DELAY, cache_size=SEARCH_CACHE,
+                 paged=False, page_size=PAGE_SIZE, fts=False, **kwargs):
         super().__init__(master, relief=relief, bd=bd, **kwargs)
 
-        self.cursor = connection.cursor()
-
         self.sql = sql
         self.pfilter = pfilter
+        self.params = params
 
         self.table = table
         self.search_field = search_field
         self.show_fields = show_fields
+        self.delay = delay
+        self.paged = paged
+        self.error = None               # exception of the last search, None if it worked
 
         self.sv = tk.StringVar(value='')
         self.scroll_box = ScrollBox(self, width=width, height=height)
         self.entry = tk.Entry(self, textvariable=self.sv)
 
+        page_size = page_size if paged else None
+        if sql:
+            self.query = SQLQuery(sql, pfilter, params)
+            setup = None
+        else:
+            self.query = TableQuery(table, search_field, show_fields, page_size, fts)
+            setup = self.query.setup if fts else None
+        self.worker = SearchWorker(connection, self.query, self.query.format, self.query.matcher, cache_size,
+                                   page_size, self.query.keyset, setup)
+        self._request = 0
+        self._waiting = False           # for rows of the worker
+        self._shown = 0                 # lines of the search in the ScrollBox
+        self._more = False              # the search has more rows than shown
+        self._debounce = None
+        self._poll = None
+        self.bind('<Destroy>', lambda e: self.close() if e.widget is self else None)
+
     def grid(self, **kwargs):
         super().grid(**kwargs)
         self.entry.grid(row=0, column=0, sticky='ew')
         self.scroll_box.grid(row=1, column=0)
+        if self.paged:
+            self.scroll_box.list_box['yscrollcommand'] = self._on_scroll
 
-        self.sv.trace('w', lambda name, index, mode: self.search())
+        self.sv.trace('w', lambda name, index, mode: self._on_change())
         self.search()
 
     def insert(self, *args):
@@ -76,26 +741,168 @@ class DBSearchBox(tk.LabelFrame):
         self.scroll_box.clear()
 
     def search(self):
-        sql = ""
-        pfilter = ""
+        """Searches for the text of the Entry right away"""
 
-        if self.sql:
-            sql = self.sql
-            pfilter = ' ' + self.pfilter.replace('{sv}', self.sv.get())
-        else:
-            sql = "SELECT {} FROM {}".format(str(self.show_fields).strip("()").replace("'", ''), self.table)
-            # print(sql)
-            pfilter = " WHERE {} LIKE '%{}%'".format(self.search_field, self.sv.get())
-            # print(where)
+        if self._debounce is not None:
+            self.after_cancel(self._debounce)
+            self._debounce = None
+        self._request = self.worker.submit(self.sv.get())
+        self._wait()
 
-        if self.sv.get():
-            self.cursor.execute(sql + pfilter)
-        else:
-            self.cursor.execute(sql)
+    def refresh(self):
+        self.worker.clear_cache()
+        self.search()
+
+    def close(self):
+        self.worker.close()
+
+    def _wait(self):
+        self._waiting = True
+        if self._poll is None:
+            self._poll = self.after(SEARCH_POLL, self._show_results)
+
+    def _on_change(self):
+        if self._debounce is not None:
+            self.after_cancel(self._debounce)
+        self._debounce = self.after(self.delay, self.search)
+
+    def _on_scroll(self, first, last):
+        self.scroll_box.v_scrollbar.set(first, last)
+        if self._more and not self._waiting and float(last) >= self.PAGE_AHEAD:
+            self.worker.more(self._request)
+            self._wait()
+
+    def _show_results(self):
+        """Shows the rows of the last search once the worker has them"""
+
+        self._poll = None
+        # checked first: the results of a stopped worker are all in the queue already
+        alive = self.worker._thread.is_alive()
+        try:
+            while True:
+                request, text, start, lines, more = self.worker.results.get_nowait()
+                if request != self._request:
+                    continue
+                self._waiting = False
+                if isinstance(lines, Exception):
+                    self._show_error(lines)
+                    continue
+                if start == 0:
+                    self.clear()
+                    self._shown = 0
+                    self.error = None
+                if start == self._shown and lines:
+                    self.insert(tk.END, *lines)
+                    self._shown += len(lines)
+                self._more = more
+        except queue.Empty:
+            pass
+        if self._waiting and alive:
+            self._poll = self.after(SEARCH_POLL, self._show_results)
+        elif self._waiting:
+            self._waiting = False
+            if not self.worker._closing:
+                self._show_error(RuntimeError("the search worker has stopped"))
+
+    def _show_error(self, error):
+        """Lists the error of the last search instead of its rows, an after callback has no caller to raise it to"""
 
         self.clear()
-        for value in self.cursor:
-            self.insert(tk.END, ' | '.join(str(i) for i in value))
+        self.insert(tk.END, f"Error: {error}")
+        self._shown, self._more = 0, False
+        self.error = error
+
+
+def convert(type_, value):
+    """value (a str) converted to the type named type_, see NavigationBox"""
+
+    if type_ == 'str':
+        return value                # There's no need to convert to str
+    if type_ == 'int':
+        return int(value)
+    if type_ == 'float':
+        return float(value)
+    if type_ == 'list':
+        return list(value)
+    if type_ == 'tuple':
+        return tuple(value)
+    if type_ == 'bytes':
+        return bytes(value)
+    raise UnsupportedType(type_)
+
+
+class Command:
+
+    """
+        Command: a command of a NavigationBox resolved once, when its
+    page is compiled: the command to run and its argument, already
+    converted (the id of the page for goto, the value for set_var).
+
+        Page providers can build them directly instead of writing
+    command strings: Command.goto(page_id), Command.set_var(value).
+    A command string that can't be resolved is a Command.error(e),
+    raising e when it is run, so only its own entry fails.
+    """
+
+    __slots__ = ('name', 'arg')
+
+    def __init__(self, name, arg):
+        self.name = name
+        self.arg = arg
+
+    def __repr__(self):
+        return "Command({!r}, {!r})".format(self.name, self.arg)
+
+    @classmethod
+    def goto(cls, page_id):
+        return cls('goto', page_id)
+
+    @classmethod
+    def set_var(cls, value):
+        return cls('set_var', value)
+
+    @classmethod
+    def error(cls, exception):
+        return cls('error', exception)
+
+    @classmethod
+    def parse(cls, statement):
+        """Command of a command string, 'goto@*id*' or 'set_var@*type*, *value*'"""
+
+        name, parameters = statement.split('@', 1)
+        parameters = parameters.split(', ')
+        if name == 'goto':
+            return cls(name, int(parameters[0]))
+        if name == 'set_var':
+            type_, value = parameters
+            return cls(name, convert(type_, value))
+        return cls(name, tuple(parameters))         # a command added to known_commands gets the parameters
+
+
+class Page:
+
+    """
+        Page: a page of a NavigationBox compiled once, the labels to
+    show and the Command of each label, in the same order.
+    """
+
+    __slots__ = ('labels', 'commands')
+
+    def __init__(self, entries):
+        """entries: a dict {label: command} or (label, command) pairs, commands being strings or Commands"""
+
+        if isinstance(entries, dict):
+            entries = entries.items()
+        self.labels = []
+        self.commands = []
+        for label, command in entries:
+            self.labels.append(label)
+            if not isinstance(command, Command):
+                try:
+                    command = Command.parse(command)
+                except Exception as e:
+                    command = Command.error(e)      # raised when the entry is clicked, the others still work
+            self.commands.append(command)
 
 
 class NavigationBox(tk.LabelFrame):
@@ -181,21 +988,51 @@ class NavigationBox(tk.LabelFrame):
       is equal to that). A way to get around that is using
       the pickle module, as seen above.
 
+    ++++++++++++++++++++++++++++++++++++++++++++++++++++
+    ============== Large structures ====================
+    ++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+        Every page is compiled into a Page the first time it is
+    shown: the command strings are parsed and their parameters
+    converted once, not on every click. A page may also give its
+    commands as Command objects (Command.goto(*id*),
+    Command.set_var(*value*)), which need no parsing at all, and be a
+    list of (*str_to_be_shown*, *command*) pairs instead of a dict.
+
+        Instead of the whole structure, a provider can be given:
+    a function called with a page_id that returns that page. Only the
+    cache_size pages used last are kept (LRU), so a tree of any size
+    (a directory fetched from a server, for instance) is browsed with
+    a bounded memory. Page ids are then whatever the provider takes.
+
+        The pages are shown in a virtual ScrollBox, which only renders
+    the visible lines: switching to a page of a hundred thousand lines
+    takes as long as to one of ten.
+
     """
 
-    def __init__(self, master, structure: dict, size: tuple=(20, 10), **kwargs):
+    def __init__(self, master, structure: dict = None, size: tuple=(20, 10), provider=None, cache_size=PAGE_CACHE,
+                 **kwargs):
         super().__init__(master, **kwargs)
 
-        self.known_commands = {'goto': self.goto,
-                               'set_var': self.set_var}
+        self.known_commands = {'goto': self._goto,
+                               'set_var': self._set,
+                               'error': self._raise}
 
+        if structure is None and provider is None:
+            raise ValueError("a NavigationBox needs a structure or a provider")
         self.structure = structure
+        self.provider = provider if provider is not None else structure.__getitem__
+        # the compiled pages of a structure are all kept, those of a provider are fetched again once dropped
+        self.cache_size = cache_size if provider is not None else None
+        self.pages = OrderedDict()
 
-        self.scrollbox = ScrollBox(self, width=size[0], height=size[1])
+        self.scrollbox = ScrollBox(self, width=size[0], height=size[1], virtual=True)
         self.back_button = tk.Button(self, text=u'\u2b05',     # Unicode for <-
                                      command=self._back)
 
         self.cur_page_id = 0
+        self.cur_page = None
         self.prev_page_history = []
         self.var = None
 
@@ -209,17 +1046,32 @@ class NavigationBox(tk.LabelFrame):
         self.back_button.grid(row=0, column=0, sticky='nsw')
         self.back_button.config(state='disabled')
 
-    def _on_select(self, event):
-        if event.widget.curselection():
-            index = event.widget.curselection()[0]
-            selection = event.widget.get(index)
-            statement = self.structure[self.cur_page_id][selection]
+    def page(self, page_id):
+        """The compiled Page of page_id, from the cache or the provider"""
 
-            command_str, parameters = statement.split('@')  # Separates command
-            parameters = tuple(parameters.split(', '))      # Converts parameters to a tuple of STRs
-            command = self.known_commands[command_str]      # Gets callable
+        pages = self.pages
+        page = pages.get(page_id)
+        if page is not None:
+            pages.move_to_end(page_id)
+            return page
+        page = pages[page_id] = Page(self.provider(page_id))
+        if self.cache_size is not None and len(pages) > self.cache_size:
+            pages.popitem(last=False)
+        return page
 
-            command(parameters)
+    def invalidate(self, page_id=None):
+        """Forgets the compiled page_id (every page without it), for when the provider's data changed"""
+
+        if page_id is None:
+            self.pages.clear()
+        else:
+            self.pages.pop(page_id, None)
+
+    def _on_select(self, event):
+        if event.widget.curselection():
+            index = self.scrollbox.line_index(event.widget.curselection()[0])
+            command = self.cur_page.commands[index]
+            self.known_commands[command.name](command.arg)
 
     def goto(self, args: tuple):
         """
@@ -232,14 +1084,20 @@ class NavigationBox(tk.LabelFrame):
         be registered in self.prev_page_history
         """
 
-        page_id = int(args[0]) if type(args[0]) == str else args[0]         # For external calls
+        if type(args[0]) == str and self.structure is not None:
+            page_id = int(args[0])                                          # For external calls
+        else:
+            page_id = args[0]                                               # Any id a provider takes
         if len(args) > 1:                                                   # For external calls
             register = args[1]
         else:
             register = True                                                 # If the command is called from inside
 
-        self.scrollbox.clear()
-        self.scrollbox.special_insert(tk.END, tuple(self.structure[page_id].keys()))
+        self._goto(page_id, register)
+
+    def _goto(self, page_id, register=True):
+        self.cur_page = self.page(page_id)
+        self.scrollbox.show(self.cur_page.labels)
         self.cur_page_id = page_id
         if register:
             self.prev_page_history.append(page_id)
@@ -255,25 +1113,16 @@ class NavigationBox(tk.LabelFrame):
         """
 
         type_, value = args
+        self._set(convert(type_, value))
 
-        if type_ == 'str':
-            pass                     # There's no need to convert to str
-        elif type_ == 'int':
-            value = int(value)
-        elif type_ == 'float':
-            value = float(value)
-        elif type_ == 'list':
-            value = list(value)
-        elif type_ == 'tuple':
-            value = tuple(value)
-        elif type_ == 'bytes':
-            value = bytes(value)
-        else:
-            raise UnsupportedType(type_)
-
+    def _set(self, value):
         self.var = value
         print(self.var) # TODO: comment this line
 
+    @staticmethod
+    def _raise(exception):
+        raise exception
+
     def _back(self):
         pid = self.prev_page_history[-2]
         self.prev_page_history.pop(-1)